@@ -1,53 +1,139 @@
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
+import tensorflow as tf
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
-from tensorflow.keras.models import Model, save_model
+from tensorflow.keras.models import Model, save_model, load_model
 from tensorflow.keras.layers import Input, LSTM, Dense, Concatenate
+from tensorflow.keras.callbacks import BackupAndRestore, EarlyStopping
 import joblib
 
+# The storage and instrumentation layers shared with the data pipeline in src/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+from DataStore import TableWriter, iter_batches
+from Profiling import profiled, record_read, record_write
+from NasaPower_DataPreprocessing import MONTH_COLUMNS, PRIMARY_PARAMETER, parameter_columns
+
+# Memory-mapped, unscaled training arrays written by DroughtPredictionSystem.write_training_arrays
+TRAINING_ARRAYS = ('static', 'temporal', 'target')
+
 class DroughtPredictionSystem:
-    def __init__(self):
+    coordinate_features = ['LAT', 'LON', 'BOTTOM_LEFT_LAT', 'BOTTOM_LEFT_LON', 
+                           'UPPER_RIGHT_LAT', 'UPPER_RIGHT_LON']
+    normalized_static_features = ['DRAIN', 'CFRAG', 'SDTO', 'STPC', 'CLPC', 'PSCL', 
+                                  'BULK', 'TAWC', 'CECS', 'BSAT', 'CECC', 'PHAQ', 
+                                  'TCEQ', 'GYPS', 'ELCO', 'TOTC', 'TOTN', 'ECEC', 
+                                  'ALSA', 'ESP']
+    target = 'ANN'
+
+    def __init__(self, temporal_parameters=(PRIMARY_PARAMETER,)):
+        """
+        temporal_parameters lists the NASA POWER parameters whose monthly
+        columns of the wide table (see pivot_nasa_power) form the temporal
+        input, which then has the shape (12, len(temporal_parameters))
+        """
         self.coordinates_scaler = StandardScaler()
         self.temporal_scaler = StandardScaler()
         self.lstm_model = None
-        
-    def prepare_data(self, df):
-        coordinate_features = ['LAT', 'LON', 'BOTTOM_LEFT_LAT', 'BOTTOM_LEFT_LON', 
-                             'UPPER_RIGHT_LAT', 'UPPER_RIGHT_LON']
-        normalized_static_features = ['DRAIN', 'CFRAG', 'SDTO', 'STPC', 'CLPC', 'PSCL', 
-                                    'BULK', 'TAWC', 'CECS', 'BSAT', 'CECC', 'PHAQ', 
-                                    'TCEQ', 'GYPS', 'ELCO', 'TOTC', 'TOTN', 'ECEC', 
-                                    'ALSA', 'ESP']
-        temporal_features = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
-                           'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
-        
-        X_coordinates = df[coordinate_features].values
-        X_coordinates_scaled = self.coordinates_scaler.fit_transform(X_coordinates)
-        X_normalized = df[normalized_static_features].values
+        self.set_temporal_parameters(temporal_parameters)
+
+    def set_temporal_parameters(self, temporal_parameters):
+        """
+        Use the monthly columns of these parameters (the primary one gives JAN..DEC) as temporal features
+        """
+        self.temporal_parameters = list(temporal_parameters)
+        self.temporal_features = [
+            col for parameter in self.temporal_parameters for col in parameter_columns(parameter)
+        ]
+        self._serving_functions = {}
+
+    def load_temporal_parameters(self, path):
+        # Models and arrays saved before multi-parameter support only use the primary parameter
+        self.set_temporal_parameters(joblib.load(path) if os.path.exists(path) else [PRIMARY_PARAMETER])
+
+    def temporal_shape(self):
+        return (len(MONTH_COLUMNS), len(self.temporal_parameters))
+
+    def temporal_tensor(self, values):
+        """
+        Rows of the temporal columns (all months of one parameter, then the
+        next) as (rows, 12, n_params) sequences, by a reshape and a transpose
+        """
+        return values.reshape(len(values), len(self.temporal_parameters), len(MONTH_COLUMNS)).transpose(0, 2, 1)
+
+    def feature_columns(self):
+        return self.coordinate_features + self.normalized_static_features + self.temporal_features
+
+    @profiled()
+    def load_data(self, path):
+        """
+        Load only the model columns from a Parquet table (memory-mapped) or a CSV file
+        """
+        columns = self.feature_columns() + [self.target]
+        if str(path).lower().endswith('.csv'):
+            df = pd.read_csv(path, usecols=columns)
+        else:
+            df = pd.read_parquet(path, columns=columns, memory_map=True)
+        record_read(path, rows=len(df))
+        return df
+
+    @profiled()
+    def transform_features(self, df):
+        """
+        Scale the features of df with the fitted scalers into the static and temporal model inputs
+        """
+        X_coordinates = df[self.coordinate_features].values
+        X_coordinates_scaled = self.coordinates_scaler.transform(X_coordinates)
+        X_normalized = df[self.normalized_static_features].values
         X_static = np.hstack([X_coordinates_scaled, X_normalized])
-        X_temporal = df[temporal_features].values
-        X_temporal_scaled = self.temporal_scaler.fit_transform(X_temporal)
-        X_temporal_reshaped = X_temporal_scaled.reshape(-1, 12, 1)
-        y = df['ANN'].values
+        X_temporal = df[self.temporal_features].values
+        X_temporal_scaled = self.temporal_scaler.transform(X_temporal)
+        X_temporal_reshaped = self.temporal_tensor(X_temporal_scaled)
+        return X_static, X_temporal_reshaped
+
+    @profiled()
+    def prepare_data(self, df):
+        self.coordinates_scaler.fit(df[self.coordinate_features].values)
+        self.temporal_scaler.fit(df[self.temporal_features].values)
+        X_static, X_temporal_reshaped = self.transform_features(df)
+        y = df[self.target].values
         
         return X_static, X_temporal_reshaped, y
     
     def build_hybrid_model(self, static_input_dim):
         static_input = Input(shape=(static_input_dim,))
-        temporal_input = Input(shape=(12, 1))
+        temporal_input = Input(shape=self.temporal_shape())
         lstm_out = LSTM(64, return_sequences=False)(temporal_input)
         combined = Concatenate()([static_input, lstm_out])
         dense1 = Dense(128, activation='relu')(combined)
         dense2 = Dense(64, activation='relu')(dense1)
         output = Dense(1)(dense2)
         self.lstm_model = Model(inputs=[static_input, temporal_input], outputs=output)
+        # Serving functions traced for the previous model would keep its weights
+        self._serving_functions = {}
         self.lstm_model.compile(optimizer='adam', loss='mean_squared_error')  # Changed from 'mse' to 'mean_squared_error'
         
-    def train(self, df, validation_split=0.2):
+    @profiled()
+    def train(self, df, validation_split=0.2, split=None):
+        """
+        Train on a DataFrame. split is an optional (train_idx, val_idx) pair of
+        row positions, e.g. from model_validation.spatial_split; by default rows
+        are split at random.
+        """
         X_static, X_temporal, y = self.prepare_data(df)
-        X_static_train, X_static_val, X_temporal_train, X_temporal_val, y_train, y_val = \
-            train_test_split(X_static, X_temporal, y, test_size=validation_split, random_state=42)
+        if split is None:
+            X_static_train, X_static_val, X_temporal_train, X_temporal_val, y_train, y_val = \
+                train_test_split(X_static, X_temporal, y, test_size=validation_split, random_state=42)
+        else:
+            train_idx, val_idx = split
+            X_static_train, X_static_val = X_static[train_idx], X_static[val_idx]
+            X_temporal_train, X_temporal_val = X_temporal[train_idx], X_temporal[val_idx]
+            y_train, y_val = y[train_idx], y[val_idx]
         self.build_hybrid_model(X_static.shape[1])
         history = self.lstm_model.fit(
             [X_static_train, X_temporal_train],
@@ -58,28 +144,265 @@ class DroughtPredictionSystem:
         )
         return history
     
+    @profiled()
+    def write_training_arrays(self, path, output_dir, chunk_size=100000):
+        """
+        Prepare a CSV or Parquet table once into memory-mapped float32 .npy arrays
+        (static.npy, temporal.npy, target.npy) for train_from_arrays.
+
+        The arrays hold the model inputs before scaling: the scalers are fitted
+        by train_from_arrays on the training rows of each split only, so the
+        same arrays serve every split without leaking validation statistics.
+        A first pass counts the rows, the second writes every chunk in place,
+        so the table never has to fit in memory.
+        """
+        columns = self.feature_columns() + [self.target]
+        n_rows = sum(len(chunk) for chunk in iter_batches(path, columns=[self.target], batch_size=chunk_size))
+
+        os.makedirs(output_dir, exist_ok=True)
+        static_dim = len(self.coordinate_features) + len(self.normalized_static_features)
+        shapes = {
+            'static': (n_rows, static_dim),
+            'temporal': (n_rows,) + self.temporal_shape(),
+            'target': (n_rows,)
+        }
+        arrays = {
+            name: np.lib.format.open_memmap(os.path.join(output_dir, f"{name}.npy"), mode='w+',
+                                            dtype=np.float32, shape=shapes[name])
+            for name in TRAINING_ARRAYS
+        }
+        start = 0
+        for chunk in iter_batches(path, columns=columns, batch_size=chunk_size):
+            end = start + len(chunk)
+            arrays['static'][start:end] = chunk[self.coordinate_features + self.normalized_static_features].values
+            arrays['temporal'][start:end] = self.temporal_tensor(chunk[self.temporal_features].values)
+            arrays['target'][start:end] = chunk[self.target].values
+            start = end
+        for array in arrays.values():
+            array.flush()
+            record_write(array.filename, rows=len(array))
+
+        joblib.dump(self.temporal_parameters, os.path.join(output_dir, "temporal_parameters.joblib"))
+        print(f"Wrote {n_rows} training rows to {output_dir}")
+        return n_rows
+
+    def fit_array_scalers(self, arrays, indices, chunk_size=100000):
+        """
+        Fit the scalers on the given rows of unscaled training arrays, chunk by chunk
+        """
+        static, temporal, _ = arrays
+        n_coordinates = len(self.coordinate_features)
+        self.coordinates_scaler = StandardScaler()
+        self.temporal_scaler = StandardScaler()
+        indices = np.sort(indices)
+        for start in range(0, len(indices), chunk_size):
+            rows = indices[start:start + chunk_size]
+            self.coordinates_scaler.partial_fit(static[rows, :n_coordinates])
+            # (rows, 12, parameters) back to the temporal_features column order
+            self.temporal_scaler.partial_fit(temporal[rows].transpose(0, 2, 1).reshape(len(rows), -1))
+
+    def scale_arrays(self, X_static, X_temporal):
+        """
+        Scale unscaled static and temporal model inputs with the fitted scalers
+        """
+        n_coordinates = len(self.coordinate_features)
+        X_static = np.array(X_static, dtype=np.float32)
+        X_static[:, :n_coordinates] = self.coordinates_scaler.transform(X_static[:, :n_coordinates])
+        temporal_mean = self.temporal_tensor(self.temporal_scaler.mean_[None])
+        temporal_scale = self.temporal_tensor(self.temporal_scaler.scale_[None])
+        return X_static, ((X_temporal - temporal_mean) / temporal_scale).astype(np.float32)
+
+    def array_dataset(self, arrays, indices, batch_size, shuffle=False, seed=42):
+        """
+        tf.data pipeline over memory-mapped training arrays: batches of row
+        indices are gathered from the arrays and scaled in parallel, and prefetched
+        """
+        static, temporal, target = arrays
+
+        def gather(batch_indices):
+            batch_indices = np.sort(batch_indices)
+            X_static, X_temporal = self.scale_arrays(static[batch_indices], temporal[batch_indices])
+            return X_static, X_temporal, target[batch_indices]
+
+        def load(batch_indices):
+            X_static, X_temporal, y = tf.numpy_function(
+                gather, [batch_indices], [tf.float32, tf.float32, tf.float32]
+            )
+            X_static.set_shape([None, static.shape[1]])
+            X_temporal.set_shape([None] + list(temporal.shape[1:]))
+            y.set_shape([None])
+            return (X_static, X_temporal), y
+
+        dataset = tf.data.Dataset.from_tensor_slices(indices)
+        if shuffle:
+            dataset = dataset.shuffle(len(indices), seed=seed, reshuffle_each_iteration=True)
+        return (
+            dataset
+            .batch(batch_size)
+            .map(load, num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE)
+        )
+
+    @profiled()
+    def train_from_arrays(self, data_dir, validation_split=0.2, epochs=50, batch_size=1024,
+                          patience=5, checkpoint_dir=None, split=None):
+        """
+        Train on arrays written by write_training_arrays, streaming them through tf.data.
+
+        split is an optional (train_idx, val_idx) pair of row positions; by
+        default rows are split at random. The scalers are fitted on the
+        training rows only. Training stops early once the validation loss has
+        not improved for patience epochs (keeping the best weights). With a
+        checkpoint_dir the state is backed up every epoch and an interrupted
+        run resumes where it stopped when called again.
+        """
+        arrays = [np.load(os.path.join(data_dir, f"{name}.npy"), mmap_mode='r') for name in TRAINING_ARRAYS]
+        record_read(data_dir, rows=len(arrays[0]))
+        self.load_temporal_parameters(os.path.join(data_dir, "temporal_parameters.joblib"))
+
+        if split is None:
+            train_idx, val_idx = train_test_split(
+                np.arange(len(arrays[2])), test_size=validation_split, random_state=42
+            )
+        else:
+            train_idx, val_idx = split
+        self.fit_array_scalers(arrays, train_idx)
+        self.build_hybrid_model(arrays[0].shape[1])
+
+        callbacks = [EarlyStopping(monitor='val_loss', patience=patience, restore_best_weights=True)]
+        if checkpoint_dir:
+            callbacks.append(BackupAndRestore(backup_dir=checkpoint_dir))
+
+        history = self.lstm_model.fit(
+            self.array_dataset(arrays, train_idx, batch_size, shuffle=True),
+            validation_data=self.array_dataset(arrays, val_idx, batch_size),
+            epochs=epochs,
+            callbacks=callbacks
+        )
+        return history
+
+    @profiled()
     def predict(self, df):
-        coordinate_features = ['LAT', 'LON', 'BOTTOM_LEFT_LAT', 'BOTTOM_LEFT_LON', 
-                             'UPPER_RIGHT_LAT', 'UPPER_RIGHT_LON']
-        normalized_static_features = ['DRAIN', 'CFRAG', 'SDTO', 'STPC', 'CLPC', 'PSCL', 
-                                    'BULK', 'TAWC', 'CECS', 'BSAT', 'CECC', 'PHAQ', 
-                                    'TCEQ', 'GYPS', 'ELCO', 'TOTC', 'TOTN', 'ECEC', 
-                                    'ALSA', 'ESP']
-        temporal_features = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
-                           'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
-        
-        X_coordinates = df[coordinate_features].values
-        X_coordinates_scaled = self.coordinates_scaler.transform(X_coordinates)
-        X_normalized = df[normalized_static_features].values
-        X_static = np.hstack([X_coordinates_scaled, X_normalized])
-        X_temporal = df[temporal_features].values
-        X_temporal_scaled = self.temporal_scaler.transform(X_temporal)
-        X_temporal_reshaped = X_temporal_scaled.reshape(-1, 12, 1)
+        X_static, X_temporal_reshaped = self.transform_features(df)
         prediction = self.lstm_model.predict([X_static, X_temporal_reshaped])
         return prediction
+
+    def serving_function(self, batch_size):
+        """
+        The model as a tf.function traced once for a fixed batch size
+        """
+        if batch_size not in self._serving_functions:
+            static_dim = len(self.coordinate_features) + len(self.normalized_static_features)
+            model = self.lstm_model
+
+            @tf.function(input_signature=[
+                tf.TensorSpec([batch_size, static_dim], tf.float32),
+                tf.TensorSpec([batch_size, *self.temporal_shape()], tf.float32)
+            ])
+            def serve(X_static, X_temporal):
+                return model([X_static, X_temporal], training=False)
+
+            self._serving_functions[batch_size] = serve
+        return self._serving_functions[batch_size]
+
+    @profiled()
+    def predict_batches(self, X_static, X_temporal, batch_size=4096, latencies=None):
+        """
+        Run the model over prepared inputs in fixed-size batches, padding the
+        last one so every call hits the same traced signature.
+        Per-batch latencies in seconds are appended to latencies if given.
+        """
+        serve = self.serving_function(batch_size)
+        n_rows = len(X_static)
+        predictions = np.empty(n_rows, dtype=np.float32)
+        for start in range(0, n_rows, batch_size):
+            end = min(start + batch_size, n_rows)
+            static_batch = np.zeros((batch_size, X_static.shape[1]), dtype=np.float32)
+            temporal_batch = np.zeros((batch_size,) + X_temporal.shape[1:], dtype=np.float32)
+            static_batch[:end - start] = X_static[start:end]
+            temporal_batch[:end - start] = X_temporal[start:end]
+
+            batch_start = time.perf_counter()
+            output = serve(tf.constant(static_batch), tf.constant(temporal_batch)).numpy()
+            if latencies is not None:
+                latencies.append(time.perf_counter() - batch_start)
+            predictions[start:end] = output[:end - start, 0]
+        return predictions
+
+    @profiled()
+    def predict_stream(self, chunks, output_path=None, batch_size=4096, n_threads=2,
+                       id_columns=('LAT', 'LON', 'YEAR')):
+        """
+        Score an iterator of DataFrame chunks (e.g. DataStore.iter_batches) with the trained model.
+
+        Feature preparation runs on a pool of CPU threads, up to n_threads chunks
+        ahead of the model, and the predictions of every chunk are appended to
+        output_path (CSV or Parquet) as soon as they are ready, next to the
+        id_columns present in the input.
+
+        Returns:
+            dict: rows, seconds, rows_per_s and the p50/p99 batch latency in ms.
+        """
+        def prepare(chunk):
+            X_static, X_temporal = self.transform_features(chunk)
+            ids = chunk[[col for col in id_columns if col in chunk.columns]].reset_index(drop=True)
+            return ids, X_static.astype(np.float32), X_temporal.astype(np.float32)
+
+        writer = TableWriter(output_path, partition_by=[]) if output_path else None
+        latencies = []
+        n_rows = 0
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                pending = deque()
+                chunks = iter(chunks)
+                for chunk in chunks:
+                    pending.append(executor.submit(prepare, chunk))
+                    if len(pending) > n_threads:
+                        break
+                while pending:
+                    ids, X_static, X_temporal = pending.popleft().result()
+                    next_chunk = next(chunks, None)
+                    if next_chunk is not None:
+                        pending.append(executor.submit(prepare, next_chunk))
+
+                    predictions = self.predict_batches(X_static, X_temporal, batch_size, latencies)
+                    n_rows += len(predictions)
+                    if writer is not None:
+                        writer.write(ids.assign(**{f'PREDICTED_{self.target}': predictions}))
+        finally:
+            if writer is not None:
+                writer.close()
+
+        seconds = time.perf_counter() - start
+        latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+        stats = {
+            'rows': n_rows,
+            'seconds': seconds,
+            'rows_per_s': n_rows / max(seconds, 1e-9),
+            'p50_ms': float(np.percentile(latencies_ms, 50)),
+            'p99_ms': float(np.percentile(latencies_ms, 99))
+        }
+        print(f"Scored {n_rows} rows in {seconds:.2f}s ({stats['rows_per_s']:.0f} rows/s), "
+              f"batch latency p50 {stats['p50_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms")
+        return stats
     
+    @profiled()
     def save_models(self, path_prefix):
         save_model(self.lstm_model, f"{path_prefix}_lstm.h5")
         joblib.dump(self.coordinates_scaler, f"{path_prefix}_coordinates_scaler.joblib")
         joblib.dump(self.temporal_scaler, f"{path_prefix}_temporal_scaler.joblib")
+        joblib.dump(self.temporal_parameters, f"{path_prefix}_temporal_parameters.joblib")
+
+    @profiled()
+    def load_models(self, path_prefix):
+        """
+        Load a model and its scalers written by save_models
+        """
+        self.lstm_model = load_model(f"{path_prefix}_lstm.h5")
+        self._serving_functions = {}
+        self.coordinates_scaler = joblib.load(f"{path_prefix}_coordinates_scaler.joblib")
+        self.temporal_scaler = joblib.load(f"{path_prefix}_temporal_scaler.joblib")
+        self.load_temporal_parameters(f"{path_prefix}_temporal_parameters.joblib")
+        return self
 
@@ -0,0 +1,189 @@
+import os
+import joblib
+import numpy as np
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import LinearRegression
+from xgboost import XGBRegressor
+from drought_prediction_system import DroughtPredictionSystem
+from model_validation import spatial_kfold
+
+def tree_members(n_jobs=-1):
+    """
+    The tree-based ensemble members, both using every core
+    """
+    return {
+        'random_forest': RandomForestRegressor(
+            n_estimators=200, min_samples_leaf=2, n_jobs=n_jobs, random_state=42
+        ),
+        'xgboost': XGBRegressor(
+            n_estimators=500, learning_rate=0.05, max_depth=8, subsample=0.8,
+            tree_method='hist', n_jobs=n_jobs, random_state=42
+        )
+    }
+
+def flatten_features(X_static, X_temporal):
+    """
+    Static features followed by the flattened monthly sequence, as input for the tree members
+    """
+    return np.hstack([X_static, X_temporal.reshape(len(X_temporal), -1)])
+
+class DroughtEnsemble:
+    """
+    Random Forest, XGBoost and (optionally) LSTM members trained on the
+    prepare_data features of a DroughtPredictionSystem, combined by a stacking
+    or weighted-average layer.
+
+    Out-of-fold predictions of every member are computed on spatially-blocked
+    folds and cached in cache_dir together with the fitted members, keyed by a
+    hash of the data, folds and member parameters. Refitting the combination
+    layer therefore never retrains a member.
+    """
+    def __init__(self, members=None, include_lstm=False, cache_dir=None, n_folds=5, block_size=2.0, n_jobs=-1):
+        self.members = members if members is not None else tree_members(n_jobs)
+        self.include_lstm = include_lstm
+        self.cache_dir = cache_dir
+        self.n_folds = n_folds
+        self.block_size = block_size
+        self.system = DroughtPredictionSystem()
+        self.fitted = {}
+        self.oof = {}
+        self.y = None
+        self.method = None
+        self.combiner = None
+        self.weights = None
+
+    def member_names(self):
+        return list(self.members) + (['lstm'] if self.include_lstm else [])
+
+    def _cache_path(self, name, key, suffix):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return os.path.join(self.cache_dir, f"{name}_{key}{suffix}")
+
+    def _fit_tree_member(self, name, X, y, folds, data_key):
+        member = self.members[name]
+        key = joblib.hash((data_key, name, member.get_params()))
+        if self.cache_dir:
+            oof_file = self._cache_path(name, key, '_oof.npy')
+            model_file = self._cache_path(name, key, '.joblib')
+            if os.path.exists(oof_file) and os.path.exists(model_file):
+                print(f"{name}: using cached out-of-fold predictions and model")
+                return np.load(oof_file), joblib.load(model_file)
+
+        oof = np.full(len(y), np.nan)
+        for fold, (train_idx, val_idx) in enumerate(folds):
+            print(f"{name}: fold {fold + 1}/{len(folds)}")
+            model = clone(member).fit(X[train_idx], y[train_idx])
+            oof[val_idx] = model.predict(X[val_idx])
+        model = clone(member).fit(X, y)
+
+        if self.cache_dir:
+            np.save(oof_file, oof)
+            joblib.dump(model, model_file)
+        return oof, model
+
+    def _fit_lstm_member(self, df, y, folds, data_key):
+        key = joblib.hash((data_key, 'lstm'))
+        prefix = self._cache_path('lstm', key, '') if self.cache_dir else None
+        if prefix and os.path.exists(f"{prefix}_oof.npy") and os.path.exists(f"{prefix}_lstm.h5"):
+            print("lstm: using cached out-of-fold predictions and model")
+            return np.load(f"{prefix}_oof.npy"), DroughtPredictionSystem().load_models(prefix)
+
+        oof = np.full(len(y), np.nan)
+        for fold, (train_idx, val_idx) in enumerate(folds):
+            print(f"lstm: fold {fold + 1}/{len(folds)}")
+            system = DroughtPredictionSystem()
+            system.train(df, split=(train_idx, val_idx))
+            oof[val_idx] = system.predict(df.iloc[val_idx])[:, 0]
+        system = DroughtPredictionSystem()
+        system.train(df)
+
+        if prefix:
+            np.save(f"{prefix}_oof.npy", oof)
+            system.save_models(prefix)
+        return oof, system
+
+    def fit(self, df, method='stacking', folds=None):
+        """
+        Fit every member, collect their out-of-fold predictions and fit the
+        combination layer. folds defaults to spatially-blocked k-fold
+        (train_idx, val_idx) pairs over df's LAT/LON.
+        """
+        X_static, X_temporal, y = self.system.prepare_data(df)
+        X = flatten_features(X_static, X_temporal)
+        if folds is None:
+            folds = list(spatial_kfold(df, self.n_folds, self.block_size))
+        data_key = joblib.hash((X, y, [val_idx for _, val_idx in folds]))
+
+        for name in self.members:
+            self.oof[name], self.fitted[name] = self._fit_tree_member(name, X, y, folds, data_key)
+        if self.include_lstm:
+            self.oof['lstm'], self.fitted['lstm'] = self._fit_lstm_member(df, y, folds, data_key)
+
+        self.y = y
+        return self.fit_combiner(method)
+
+    def fit_combiner(self, method='stacking'):
+        """
+        (Re)fit the combination layer on the cached out-of-fold predictions.
+
+        'stacking' fits a non-negative linear regression on the member
+        predictions, 'weighted' averages them with inverse out-of-fold MSE weights.
+        Only rows in some fold's validation set have out-of-fold predictions,
+        rows the folds leave out (e.g. the buffer of spatial_split) are skipped.
+        """
+        P = np.column_stack([self.oof[name] for name in self.member_names()])
+        covered = ~np.isnan(P).any(axis=1)
+        if not covered.any():
+            raise ValueError("The folds leave no row with out-of-fold predictions")
+        if not covered.all():
+            print(f"Fitting the combination on {covered.sum()} of {len(covered)} rows covered by the folds")
+        P, y = P[covered], self.y[covered]
+        if method == 'stacking':
+            self.combiner = LinearRegression(positive=True).fit(P, y)
+            self.weights = self.combiner.coef_
+        elif method == 'weighted':
+            inverse_mse = 1.0 / np.maximum(((P - y[:, None]) ** 2).mean(axis=0), 1e-12)
+            self.combiner = None
+            self.weights = inverse_mse / inverse_mse.sum()
+        else:
+            raise ValueError(f"Unknown combination method: {method}")
+        self.method = method
+
+        for name, weight, mse in zip(self.member_names(), self.weights, ((P - y[:, None]) ** 2).mean(axis=0)):
+            print(f"{name}: out-of-fold MSE {mse:.4f}, weight {weight:.3f}")
+        print(f"Ensemble out-of-fold MSE: {((self.combine(P) - y) ** 2).mean():.4f}")
+        return self
+
+    def set_weights(self, weights):
+        """
+        Use fixed weights ({member: weight}) for a weighted average of the members
+        """
+        self.combiner = None
+        self.method = 'weighted'
+        self.weights = np.array([weights[name] for name in self.member_names()], dtype=np.float64)
+        self.weights = self.weights / self.weights.sum()
+        return self
+
+    def combine(self, P):
+        if self.combiner is not None:
+            return self.combiner.predict(P)
+        return P @ self.weights
+
+    def predict_members(self, df):
+        X_static, X_temporal = self.system.transform_features(df)
+        X = flatten_features(X_static, X_temporal)
+        predictions = {name: self.fitted[name].predict(X) for name in self.members}
+        if self.include_lstm:
+            predictions['lstm'] = self.fitted['lstm'].predict(df)[:, 0]
+        return predictions
+
+    def predict(self, df):
+        predictions = self.predict_members(df)
+        return self.combine(np.column_stack([predictions[name] for name in self.member_names()]))
+
+if __name__ == "__main__":
+    df = DroughtPredictionSystem().load_data('../output/AUGUMENTED_SOTWIS_NASA.parquet')
+
+    ensemble = DroughtEnsemble(cache_dir='../output/ensemble_cache').fit(df, method='stacking')
+    ensemble.fit_combiner('weighted')
@@ -0,0 +1,205 @@
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# The instrumentation layer shared with the data pipeline in src/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+from Profiling import current_rss_mb
+
+def export_tflite(system, path, quantization=None, representative_df=None):
+    """
+    Export a trained DroughtPredictionSystem as a self-contained TFLite model.
+
+    Both StandardScalers are folded into the graph, so the model takes the raw
+    coordinate, soil and monthly columns. A JSON file next to it (path + '.json')
+    records the column order of each input.
+
+    Parameters:
+        system (DroughtPredictionSystem): Trained system.
+        path (str): Destination .tflite file.
+        quantization (str): None, 'float16' or 'int8'. 'int8' uses full integer
+            quantization of the weights and activations when representative_df
+            is given and dynamic-range quantization otherwise.
+        representative_df (DataFrame): Sample rows used to calibrate 'int8'.
+    """
+    import tensorflow as tf
+
+    coordinates_mean = tf.constant(system.coordinates_scaler.mean_, tf.float32)
+    coordinates_scale = tf.constant(system.coordinates_scaler.scale_, tf.float32)
+    temporal_mean = tf.constant(system.temporal_scaler.mean_, tf.float32)
+    temporal_scale = tf.constant(system.temporal_scaler.scale_, tf.float32)
+    model = system.lstm_model
+
+    @tf.function(input_signature=[
+        tf.TensorSpec([None, len(system.coordinate_features)], tf.float32, name='coordinates'),
+        tf.TensorSpec([None, len(system.normalized_static_features)], tf.float32, name='soil'),
+        tf.TensorSpec([None, len(system.temporal_features)], tf.float32, name='monthly')
+    ])
+    def serve(coordinates, soil, monthly):
+        X_static = tf.concat([(coordinates - coordinates_mean) / coordinates_scale, soil], axis=1)
+        # (rows, parameters x 12) -> (rows, 12, parameters), as DroughtPredictionSystem.temporal_tensor
+        X_temporal = tf.transpose(
+            tf.reshape((monthly - temporal_mean) / temporal_scale, [-1, *system.temporal_shape()[::-1]]), [0, 2, 1]
+        )
+        return {system.target: model([X_static, X_temporal], training=False)}
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([serve.get_concrete_function()], model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if representative_df is not None:
+            inputs = raw_inputs(system, representative_df)
+
+            def representative_dataset():
+                for i in range(len(representative_df)):
+                    yield [array[i:i + 1] for array in inputs]
+
+            converter.representative_dataset = representative_dataset
+    elif quantization is not None:
+        raise ValueError(f"Unknown quantization: {quantization}")
+
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+    with open(f"{path}.json", 'w') as f:
+        json.dump({
+            'coordinates': system.coordinate_features,
+            'soil': system.normalized_static_features,
+            'monthly': system.temporal_features,
+            'target': system.target,
+            'quantization': quantization
+        }, f, indent=2)
+    print(f"Exported {path} ({os.path.getsize(path) / 1024:.0f} KB, quantization={quantization})")
+
+def raw_inputs(columns, df):
+    """
+    The coordinate, soil and monthly inputs of an exported model as float32 arrays.
+    columns is a DroughtPredictionSystem or the column metadata of an export.
+    """
+    if isinstance(columns, dict):
+        groups = [columns['coordinates'], columns['soil'], columns['monthly']]
+    else:
+        groups = [columns.coordinate_features, columns.normalized_static_features, columns.temporal_features]
+    return [df[group].to_numpy(dtype=np.float32) for group in groups]
+
+class LiteDroughtModel:
+    """
+    Runtime for a model written by export_tflite. Uses the standalone
+    tflite_runtime interpreter when it is installed, so scoring hosts do not
+    need TensorFlow.
+    """
+    def __init__(self, path, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        with open(f"{path}.json") as f:
+            self.columns = json.load(f)
+        self.interpreter = Interpreter(model_path=str(path), num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        details = self.interpreter.get_input_details()
+        self.inputs = [
+            next(d['index'] for d in details if name in d['name'])
+            for name in ['coordinates', 'soil', 'monthly']
+        ]
+        self.output = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+
+    def predict_arrays(self, coordinates, soil, monthly):
+        batch_size = len(coordinates)
+        if batch_size != self._batch_size:
+            for index, array in zip(self.inputs, [coordinates, soil, monthly]):
+                self.interpreter.resize_tensor_input(index, array.shape)
+            self.interpreter.allocate_tensors()
+            self._batch_size = batch_size
+        for index, array in zip(self.inputs, [coordinates, soil, monthly]):
+            self.interpreter.set_tensor(index, np.ascontiguousarray(array, dtype=np.float32))
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output)[:, 0]
+
+    def predict(self, df):
+        return self.predict_arrays(*raw_inputs(self.columns, df))
+
+def time_batches(predict, inputs, batch_size, n_runs=20):
+    """
+    Median latency in ms of predict on the first batch_size rows of inputs
+    """
+    batch = [array[:batch_size] for array in inputs]
+    predict(*batch)  # warm-up
+    latencies = []
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        predict(*batch)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies) * 1000)
+
+def benchmark_export(system, df, export_dir, quantizations=(None, 'float16', 'int8'), batch_sizes=(1, 1024)):
+    """
+    Export the system with each quantization and compare latency, memory,
+    size and accuracy against the Keras model on df.
+
+    Every model is timed end to end on the same raw float32 inputs: the Keras
+    model scales them with the fitted scalers in NumPy, the exported models
+    with the scalers folded into their graph. load_mb is the growth of the
+    resident memory while loading the saved model.
+    """
+    os.makedirs(export_dir, exist_ok=True)
+    inputs = raw_inputs(system, df)
+
+    prefix = os.path.join(export_dir, 'drought_model_keras')
+    system.save_models(prefix)
+    rss_before = current_rss_mb()
+    keras = type(system)().load_models(prefix)
+    keras_load_mb = current_rss_mb() - rss_before
+
+    coordinates_mean = keras.coordinates_scaler.mean_.astype(np.float32)
+    coordinates_scale = keras.coordinates_scaler.scale_.astype(np.float32)
+    temporal_mean = keras.temporal_scaler.mean_.astype(np.float32)
+    temporal_scale = keras.temporal_scaler.scale_.astype(np.float32)
+
+    def keras_predict(coordinates, soil, monthly):
+        X_static = np.hstack([(coordinates - coordinates_mean) / coordinates_scale, soil])
+        X_temporal = keras.temporal_tensor((monthly - temporal_mean) / temporal_scale)
+        return keras.lstm_model([X_static, X_temporal], training=False).numpy()[:, 0]
+
+    reference = keras.predict(df)[:, 0]
+    results = [{
+        'model': 'keras',
+        'size_kb': os.path.getsize(f"{prefix}_lstm.h5") / 1024,
+        'load_mb': keras_load_mb,
+        'rmse_vs_keras': 0.0,
+        **{f'ms_batch_{b}': time_batches(keras_predict, inputs, b) for b in batch_sizes}
+    }]
+    for quantization in quantizations:
+        path = os.path.join(export_dir, f"drought_model_{quantization or 'float32'}.tflite")
+        export_tflite(system, path, quantization, representative_df=df.iloc[:200])
+
+        rss_before = current_rss_mb()
+        lite = LiteDroughtModel(path)
+        load_mb = current_rss_mb() - rss_before
+        predictions = lite.predict(df)
+        results.append({
+            'model': f"tflite_{quantization or 'float32'}",
+            'size_kb': os.path.getsize(path) / 1024,
+            'load_mb': load_mb,
+            'rmse_vs_keras': float(np.sqrt(np.mean((predictions - reference) ** 2))),
+            **{f'ms_batch_{b}': time_batches(lite.predict_arrays, inputs, b) for b in batch_sizes}
+        })
+
+    for result in results:
+        print(result)
+    return results
+
+if __name__ == "__main__":
+    from drought_prediction_system import DroughtPredictionSystem
+
+    table_path = '../output/AUGUMENTED_SOTWIS_NASA.parquet'
+    path_prefix = '../output/drought_model'  # Prefix given to save_models
+
+    system = DroughtPredictionSystem().load_models(path_prefix)
+    df = system.load_data(table_path).sample(n=5000, random_state=42)
+    benchmark_export(system, df, '../output/exported_models')
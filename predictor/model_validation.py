@@ -0,0 +1,131 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+# The storage and instrumentation layers shared with the data pipeline in src/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+from DataStore import iter_batches
+from Profiling import TraceSession
+from drought_prediction_system import DroughtPredictionSystem
+
+def read_split_keys(path, chunk_size=100000):
+    """
+    Load only LAT, LON and YEAR of a table, in the row order used by
+    write_training_arrays and load_data
+    """
+    return pd.concat(iter_batches(path, columns=['LAT', 'LON', 'YEAR'], batch_size=chunk_size),
+                     ignore_index=True)
+
+def spatial_blocks(lats, lons, block_size=2.0):
+    """
+    Block id of every row: rows whose cells fall in the same block_size x
+    block_size degree square share an id, so all YEAR rows of a cell do too
+    """
+    rows = np.floor(np.asarray(lats, dtype='float64') / block_size).astype(np.int64)
+    columns = np.floor(np.asarray(lons, dtype='float64') / block_size).astype(np.int64)
+    block_ids, _ = pd.MultiIndex.from_arrays([rows, columns]).factorize()
+    return block_ids
+
+def block_folds(block_ids, n_folds=5, seed=42):
+    """
+    Assign the distinct blocks at random to n_folds folds and return the fold of every row
+    """
+    n_blocks = block_ids.max() + 1
+    block_fold = np.empty(n_blocks, dtype=np.int64)
+    block_fold[np.random.default_rng(seed).permutation(n_blocks)] = np.arange(n_blocks) % n_folds
+    return block_fold[block_ids]
+
+def spatial_kfold(keys, n_folds=5, block_size=2.0, seed=42):
+    """
+    Yield (train_idx, val_idx) row positions for k-fold cross-validation over spatial blocks
+    """
+    folds = block_folds(spatial_blocks(keys['LAT'], keys['LON'], block_size), n_folds, seed)
+    for fold in range(n_folds):
+        yield np.flatnonzero(folds != fold), np.flatnonzero(folds == fold)
+
+def spatial_split(keys, validation_split=0.2, block_size=2.0, seed=42, validation_years=None):
+    """
+    Single leakage-free (train_idx, val_idx) split.
+
+    About validation_split of the spatial blocks are held out for validation.
+    With validation_years=(first, last) only the rows of those years in the
+    held-out blocks are validated on and all other rows of the held-out blocks
+    are left out of both sets; with block_size=None the split is by year range
+    alone.
+    """
+    if block_size is None and validation_years is None:
+        raise ValueError("spatial_split needs a block_size, validation_years or both")
+    n_rows = len(keys)
+    if block_size is None:
+        held_out = np.ones(n_rows, dtype=bool)
+    else:
+        n_folds = max(int(round(1 / validation_split)), 2)
+        held_out = block_folds(spatial_blocks(keys['LAT'], keys['LON'], block_size), n_folds, seed) == 0
+
+    if validation_years is None:
+        return np.flatnonzero(~held_out), np.flatnonzero(held_out)
+
+    years = keys['YEAR'].to_numpy()
+    in_years = (years >= validation_years[0]) & (years <= validation_years[1])
+    val = held_out & in_years
+    train = ~in_years if block_size is None else ~held_out
+    return np.flatnonzero(train), np.flatnonzero(val)
+
+def run_fold(data_dir, fold, split, train_kwargs):
+    """
+    Train a fresh model on one fold of the memory-mapped training arrays.
+    The fold's memory is sampled by a TraceSession of its own, so the peak
+    does not carry over from earlier folds run by the same (reused) worker.
+    """
+    session = TraceSession(f"fold_{fold}")
+    train = session.open('train')
+    start_rss_mb = train.peak_rss_mb
+    try:
+        history = DroughtPredictionSystem().train_from_arrays(data_dir, split=split, **train_kwargs)
+    finally:
+        session.close(train)
+        session.stop()
+    stats = session.stats['train']
+    return {
+        'fold': fold,
+        'train_rows': len(split[0]),
+        'val_rows': len(split[1]),
+        'best_val_loss': float(min(history.history['val_loss'])),
+        'epochs': len(history.history['val_loss']),
+        'seconds': stats['wall_s'],
+        'start_rss_mb': start_rss_mb,
+        'peak_rss_mb': stats['peak_rss_mb']
+    }
+
+def cross_validate(data_dir, keys, n_folds=5, block_size=2.0, n_jobs=-1, **train_kwargs):
+    """
+    Spatially-blocked k-fold cross-validation on arrays written by
+    write_training_arrays, one fold per worker process.
+
+    keys holds the LAT and LON of every array row (see read_split_keys). Only
+    index arrays are sent to the workers; they memory-map the training data.
+    train_kwargs are passed on to train_from_arrays.
+
+    Returns:
+        DataFrame: One row per fold with its best validation loss, wall time
+        and the worker memory at the start of the fold and at its peak during it.
+    """
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(run_fold)(data_dir, fold, split, train_kwargs)
+        for fold, split in enumerate(spatial_kfold(keys, n_folds, block_size))
+    )
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    print(f"Mean validation loss: {results['best_val_loss'].mean():.4f} "
+          f"(std {results['best_val_loss'].std():.4f})")
+    return results
+
+if __name__ == "__main__":
+    table_path = '../output/AUGUMENTED_SOTWIS_NASA.parquet'
+    data_dir = '../output/training_arrays'
+
+    system = DroughtPredictionSystem()
+    system.write_training_arrays(table_path, data_dir)
+    cross_validate(data_dir, read_split_keys(table_path), n_folds=5, epochs=20)
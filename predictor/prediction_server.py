@@ -0,0 +1,176 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from drought_prediction_system import DroughtPredictionSystem
+from DataStore import iter_batches
+
+class StaticFeatureCache:
+    """
+    Model-ready static inputs (scaled coordinates followed by the normalized
+    soil features) for every (LAT, LON) cell of a table, so a request only has
+    to supply its monthly values.
+    """
+    def __init__(self, system, table_path, chunk_size=100000):
+        columns = system.coordinate_features + system.normalized_static_features
+        cells = {}
+        for chunk in iter_batches(table_path, columns=columns, batch_size=chunk_size):
+            # The static features do not change over the years, keep one row per cell
+            chunk = chunk.drop_duplicates(['LAT', 'LON'], keep='last')
+            X_static, _ = system.transform_features(
+                chunk.assign(**{col: 0.0 for col in system.temporal_features})
+            )
+            for lat, lon, row in zip(chunk['LAT'].to_numpy(), chunk['LON'].to_numpy(), X_static):
+                cells[self.key(lat, lon)] = row.astype(np.float32)
+        self.cells = cells
+
+    @staticmethod
+    def key(lat, lon):
+        return (round(float(lat), 4), round(float(lon), 4))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def get(self, lat, lon):
+        return self.cells.get(self.key(lat, lon))
+
+class MicroBatcher:
+    """
+    Collect concurrent requests into one model call.
+
+    A worker thread waits for the first request, then keeps taking requests
+    for at most max_wait_ms or until max_batch_size are queued, and scores them
+    together through the fixed-size serving function of the system.
+    """
+    def __init__(self, system, max_batch_size=64, max_wait_ms=5.0):
+        self.system = system
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.temporal_mean = system.temporal_scaler.mean_.astype(np.float32)
+        self.temporal_scale = system.temporal_scaler.scale_.astype(np.float32)
+        self._worker = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        # Trace the serving function and run it once before taking requests
+        static_dim = len(self.system.coordinate_features) + len(self.system.normalized_static_features)
+        self.system.predict_batches(
+            np.zeros((1, static_dim), dtype=np.float32),
+            np.zeros((1,) + self.system.temporal_shape(), dtype=np.float32),
+            batch_size=self.max_batch_size
+        )
+        self._worker.start()
+        return self
+
+    def submit(self, static_row, monthly_values):
+        future = Future()
+        self.requests.put((static_row, monthly_values, future))
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                X_static = np.stack([static_row for static_row, _, _ in batch])
+                X_temporal = np.stack([monthly for _, monthly, _ in batch])
+                X_temporal = self.system.temporal_tensor((X_temporal - self.temporal_mean) / self.temporal_scale)
+                predictions = self.system.predict_batches(X_static, X_temporal, batch_size=self.max_batch_size)
+                for (_, _, future), prediction in zip(batch, predictions):
+                    future.set_result(float(prediction))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+
+class PredictionServer(ThreadingHTTPServer):
+    """
+    Local HTTP scoring service.
+
+    POST /predict with {"LAT": .., "LON": .., "MONTHLY": [12 values]} returns
+    {"PREDICTED_ANN": ..}. With several temporal parameters MONTHLY holds the
+    12 values of each, one parameter after the other. Cells not present in the
+    static feature table are answered with 404.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, system, static_features, max_batch_size=64, max_wait_ms=5.0):
+        super().__init__(address, PredictionHandler)
+        self.system = system
+        self.static_features = static_features
+        self.batcher = MicroBatcher(system, max_batch_size, max_wait_ms).start()
+
+    def predict(self, lat, lon, monthly_values, timeout=10.0):
+        static_row = self.static_features.get(lat, lon)
+        if static_row is None:
+            raise KeyError(f"No SOTWIS features for cell ({lat}, {lon})")
+        # Validate here so a malformed request never reaches the shared batch
+        monthly_values = np.asarray(monthly_values, dtype=np.float32)
+        if monthly_values.shape != (len(self.system.temporal_features),):
+            raise ValueError(f"Expected {len(self.system.temporal_features)} monthly values")
+        if not np.isfinite(monthly_values).all():
+            raise ValueError("Monthly values must be finite numbers")
+        return self.batcher.submit(static_row, monthly_values).result(timeout)
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            lat, lon, monthly_values = request['LAT'], request['LON'], request['MONTHLY']
+        except (KeyError, ValueError, TypeError) as e:
+            self._reply(400, {'error': f"Invalid request: {e}"})
+            return
+        try:
+            prediction = self.server.predict(lat, lon, monthly_values)
+            self._reply(200, {f'PREDICTED_{self.server.system.target}': prediction})
+        except KeyError as e:
+            self._reply(404, {'error': str(e)})
+        except (ValueError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+        except TimeoutError:
+            self._reply(503, {'error': "Prediction timed out"})
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(path_prefix, table_path, host='127.0.0.1', port=8080, max_batch_size=64, max_wait_ms=5.0):
+    """
+    Load a saved model, cache the static features of every cell and serve predictions
+    """
+    system = DroughtPredictionSystem().load_models(path_prefix)
+    static_features = StaticFeatureCache(system, table_path)
+    server = PredictionServer((host, port), system, static_features, max_batch_size, max_wait_ms)
+    print(f"Serving {len(static_features)} cells on http://{host}:{port}/predict")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    path_prefix = '../output/drought_model'  # Prefix given to save_models
+    table_path = '../output/AUGUMENTED_SOTWIS_NASA.parquet'  # Source of the static SOTWIS features
+
+    serve(path_prefix, table_path)
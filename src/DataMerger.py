@@ -1,48 +1,271 @@
+import os
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point, Polygon
-
-def merge_datasets_efficiently(nasa_file, sotwis_file, output_file):
-    # Load the NASA dataset
-    nasa_df = pd.read_csv(nasa_file)
-    nasa_gdf = gpd.GeoDataFrame(
-        nasa_df,
-        geometry=gpd.points_from_xy(nasa_df['LON'], nasa_df['LAT'])
-    )
-
-    # Load the SOTWIS dataset and convert bounding boxes to polygons
-    sotwis_df = pd.read_csv(sotwis_file)
-    sotwis_gdf = gpd.GeoDataFrame(
-        sotwis_df,
-        geometry=[
-            Polygon([
-                (row['BOTTOM_LEFT_LON'], row['BOTTOM_LEFT_LAT']),
-                (row['BOTTOM_LEFT_LON'], row['UPPER_RIGHT_LAT']),
-                (row['UPPER_RIGHT_LON'], row['UPPER_RIGHT_LAT']),
-                (row['UPPER_RIGHT_LON'], row['BOTTOM_LEFT_LAT']),
-                (row['BOTTOM_LEFT_LON'], row['BOTTOM_LEFT_LAT'])
-            ])
-            for _, row in sotwis_df.iterrows()
-        ]
-    )
-
-    # Ensure coordinate systems match
-    nasa_gdf.set_crs("EPSG:4326", inplace=True)
-    sotwis_gdf.set_crs("EPSG:4326", inplace=True)
-
-    # Perform a spatial join to match NASA points to SOTWIS polygons
-    merged_gdf = gpd.sjoin(nasa_gdf, sotwis_gdf, how='inner', predicate='within')
-    if 'index_right' in merged_gdf.columns:
-        merged_gdf.drop(columns=['index_right'], inplace=True)
-
-    # Drop geometry columns and save the result
-    merged_df = pd.DataFrame(merged_gdf.drop(columns='geometry'))
-    merged_df.to_csv(output_file, index=False)
+import shapely
+from DataStore import read_table, write_table
+from PolygonStore import POLYGON_ID_COLUMN, PolygonStore
+from Profiling import profiled, tracing
+from TableSchema import BOX_COLUMNS
+
+def build_box_index(sotwis_df):
+    """
+    Build an STRtree over the SOTWIS bounding boxes.
+
+    The boxes are created in one vectorized shapely.box call. Rows with missing
+    bounds are left out of the tree; the returned array maps tree positions back
+    to SOTWIS row positions.
+    """
+    bounds = sotwis_df[BOX_COLUMNS].apply(pd.to_numeric, errors='coerce').to_numpy(dtype='float64')
+    valid_rows = np.flatnonzero(~np.isnan(bounds).any(axis=1))
+    boxes = shapely.box(*bounds[valid_rows].T)
+    return shapely.STRtree(boxes), valid_rows
+
+def match_cells_to_boxes(lats, lons, tree, valid_rows):
+    """
+    Return (cell, SOTWIS row) position pairs for every grid point lying strictly
+    within a box, ordered by cell and then by SOTWIS row.
+    """
+    points = shapely.points(np.asarray(lons, dtype='float64'), np.asarray(lats, dtype='float64'))
+    cell_idx, box_idx = tree.query(points, predicate='within')
+    sotwis_rows = valid_rows[box_idx]
+    order = np.lexsort((sotwis_rows, cell_idx))
+    return cell_idx[order], sotwis_rows[order]
+
+def match_cells_to_polygons(lats, lons, polygons, row_ids):
+    """
+    Return (cell, SOTWIS row) position pairs for every grid point lying strictly
+    within the exact polygon of a SOTWIS row, ordered by cell and then by SOTWIS
+    row. row_ids gives the polygon id of every SOTWIS row.
+    """
+    cell_idx, ids = polygons.query_points(lats, lons)
+    pairs = pd.DataFrame({'CELL': cell_idx, 'ID': ids})
+    rows = pd.DataFrame({'ID': row_ids, 'ROW': np.arange(len(row_ids))})
+    pairs = pairs.merge(rows, on='ID').sort_values(['CELL', 'ROW'])
+    return pairs['CELL'].to_numpy(), pairs['ROW'].to_numpy()
+
+@profiled()
+def match_cells(lats, lons, sotwis_df, polygons=None):
+    """
+    Match grid points to SOTWIS rows, by exact polygon when a PolygonStore is
+    given and by bounding box otherwise
+    """
+    if polygons is not None:
+        return match_cells_to_polygons(lats, lons, polygons, row_polygon_ids(sotwis_df))
+    tree, valid_rows = build_box_index(sotwis_df)
+    return match_cells_to_boxes(lats, lons, tree, valid_rows)
+
+@profiled()
+def broadcast_matches(cell_codes, cell_idx, sotwis_rows, n_cells):
+    """
+    Expand per-cell matches to per-row matches.
+
+    cell_codes gives the grid cell of every NASA row (-1 for unknown cells).
+    Returns (NASA row, SOTWIS row) position pairs in NASA row order.
+    """
+    counts = np.bincount(cell_idx, minlength=n_cells)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    row_counts = np.where(cell_codes >= 0, counts[cell_codes], 0)
+    nasa_rows = np.repeat(np.arange(len(cell_codes)), row_counts)
+
+    # Position of each output row inside its cell's block of matches
+    first_output = np.cumsum(row_counts) - row_counts
+    within_cell = np.arange(row_counts.sum()) - np.repeat(first_output, row_counts)
+    match_positions = np.repeat(starts[np.maximum(cell_codes, 0)], row_counts) + within_cell
+
+    return nasa_rows, sotwis_rows[match_positions]
+
+@profiled()
+def join_rows(nasa_df, sotwis_df, nasa_rows, sotwis_rows):
+    """
+    Assemble the merged table from matched row positions, suffixing clashing
+    column names the same way gpd.sjoin does.
+    """
+    left = nasa_df.iloc[nasa_rows].reset_index(drop=True)
+    right = sotwis_df.iloc[sotwis_rows].reset_index(drop=True)
+
+    clashing = left.columns.intersection(right.columns)
+    left = left.rename(columns={col: f"{col}_left" for col in clashing})
+    right = right.rename(columns={col: f"{col}_right" for col in clashing})
+
+    return pd.concat([left, right], axis=1)
+
+def box_hashes(sotwis_df):
+    """
+    Content hash of every SOTWIS box, used to recognise polygons across runs
+    """
+    bounds = sotwis_df[BOX_COLUMNS].apply(pd.to_numeric, errors='coerce').astype('float64')
+    return pd.util.hash_pandas_object(bounds, index=False).to_numpy()
+
+def row_polygon_ids(sotwis_df):
+    """
+    Polygon id of every SOTWIS row ('' for rows that do not come from a shapefile)
+    """
+    if POLYGON_ID_COLUMN not in sotwis_df.columns:
+        return np.full(len(sotwis_df), '', dtype=object)
+    return sotwis_df[POLYGON_ID_COLUMN].astype(object).fillna('').astype(str).to_numpy(dtype=object)
+
+class CellJoinCache:
+    """
+    Persisted mapping from NASA grid cells (LAT, LON) to the hashes of the
+    SOTWIS boxes that contain them.
+
+    The cache remembers which cells and which boxes have already been joined,
+    so a run only queries new cells against all boxes and known cells against
+    new boxes. When neither changed (e.g. a new year of NASA data) no spatial
+    work is done at all.
+
+    With a PolygonStore the cells are matched against the exact polygons and
+    the cache is keyed by polygon id instead of box hash; such a cache must
+    live in its own directory.
+    """
+    def __init__(self, cache_dir, polygons=None):
+        self.cache_dir = str(cache_dir)
+        self.polygons = polygons
+        self.key, key_dtype = ('BOX_HASH', 'uint64') if polygons is None else (POLYGON_ID_COLUMN, 'str')
+        self.cells = self._load('cells.parquet', {'LAT': 'float64', 'LON': 'float64'})
+        self.boxes = self._load('boxes.parquet', {self.key: key_dtype})
+        self.matches = self._load('matches.parquet', {'LAT': 'float64', 'LON': 'float64', self.key: key_dtype})
+
+    def _load(self, name, dtypes):
+        path = os.path.join(self.cache_dir, name)
+        if os.path.exists(path):
+            return read_table(path).astype(dtypes)
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in dtypes.items()})
+
+    def save(self):
+        write_table(self.cells, os.path.join(self.cache_dir, 'cells.parquet'))
+        write_table(self.boxes, os.path.join(self.cache_dir, 'boxes.parquet'))
+        write_table(self.matches, os.path.join(self.cache_dir, 'matches.parquet'))
+
+    def row_keys(self, sotwis_df):
+        if self.polygons is None:
+            return box_hashes(sotwis_df)
+        return row_polygon_ids(sotwis_df)
+
+    def _query(self, cells, sotwis_df, hashes):
+        cell_idx, rows = match_cells(cells['LAT'], cells['LON'], sotwis_df, self.polygons)
+        return pd.DataFrame({
+            'LAT': cells['LAT'].to_numpy()[cell_idx],
+            'LON': cells['LON'].to_numpy()[cell_idx],
+            self.key: hashes[rows]
+        })
+
+    @profiled()
+    def update(self, cells, sotwis_df, hashes):
+        """
+        Join the cells and boxes that are not in the cache yet
+        """
+        known_cells = cells.merge(self.cells, on=['LAT', 'LON'], how='left', indicator=True)
+        new_cells = cells[(known_cells['_merge'] == 'left_only').to_numpy()]
+        new_box_rows = np.flatnonzero(~np.isin(hashes, self.boxes[self.key].to_numpy()))
+
+        print(f"Join cache: {len(new_cells)} new cells, {len(new_box_rows)} new boxes")
+        if len(new_cells) == 0 and len(new_box_rows) == 0:
+            return
+
+        new_matches = []
+        if len(new_cells):
+            new_matches.append(self._query(new_cells, sotwis_df, hashes))
+        if len(new_box_rows) and len(self.cells):
+            new_boxes_df = sotwis_df.iloc[new_box_rows]
+            new_matches.append(self._query(self.cells, new_boxes_df, hashes[new_box_rows]))
+
+        self.matches = pd.concat([self.matches, *new_matches], ignore_index=True).drop_duplicates()
+        self.cells = pd.concat([self.cells, new_cells], ignore_index=True)
+        self.boxes = pd.DataFrame({self.key: np.union1d(self.boxes[self.key].to_numpy(), hashes)})
+        self.save()
+
+    @profiled()
+    def lookup(self, cells, sotwis_df):
+        """
+        Return (cell, SOTWIS row) position pairs like match_cells_to_boxes,
+        joining only what the cache does not know yet.
+        """
+        hashes = self.row_keys(sotwis_df)
+        self.update(cells, sotwis_df, hashes)
+
+        cell_positions = cells.assign(CELL=np.arange(len(cells)))
+        box_rows = pd.DataFrame({self.key: hashes, 'ROW': np.arange(len(hashes))})
+        pairs = (
+            self.matches
+            .merge(cell_positions, on=['LAT', 'LON'])
+            .merge(box_rows, on=self.key)
+            .sort_values(['CELL', 'ROW'])
+        )
+        return pairs['CELL'].to_numpy(), pairs['ROW'].to_numpy()
+
+@profiled()
+def box_join(nasa_df, sotwis_df, cache=None, polygons=None):
+    """
+    Match NASA grid points to the SOTWIS bounding boxes that contain them.
+
+    Every distinct (LAT, LON) cell is looked up once and the matches are then
+    broadcast to all of its YEAR rows. If a PolygonStore is given, a point only
+    matches the SOTWIS rows whose exact polygon contains it (exact mode);
+    otherwise the bounding box is enough (fast bbox mode).
+
+    Parameters:
+        nasa_df (DataFrame): NASA POWER rows with LAT and LON columns.
+        sotwis_df (DataFrame): SOTWIS rows with bounding box columns.
+        cache (CellJoinCache): Optional persisted cell join cache.
+        polygons (PolygonStore): Optional exact SOTWIS polygons.
+
+    Returns:
+        DataFrame: NASA columns followed by the matching SOTWIS columns.
+    """
+    cell_codes, cells = pd.MultiIndex.from_frame(nasa_df[['LAT', 'LON']]).factorize()
+    cells = pd.DataFrame({
+        'LAT': cells.get_level_values(0).astype('float64'),
+        'LON': cells.get_level_values(1).astype('float64')
+    })
+    if cache is None:
+        cell_idx, matched_rows = match_cells(cells['LAT'], cells['LON'], sotwis_df, polygons)
+    else:
+        cell_idx, matched_rows = cache.lookup(cells, sotwis_df)
+    nasa_rows, sotwis_rows = broadcast_matches(cell_codes, cell_idx, matched_rows, len(cells))
+    return join_rows(nasa_df, sotwis_df, nasa_rows, sotwis_rows)
+
+def join_cache_dir(cache_dir, polygon_store=None):
+    """
+    The CellJoinCache directory used by merge_datasets_efficiently: a cache of
+    the exact polygon join lives in its own 'exact' subdirectory
+    """
+    if polygon_store and os.path.isdir(polygon_store):
+        return os.path.join(cache_dir, 'exact')
+    return cache_dir
+
+@profiled()
+def merge_datasets_efficiently(nasa_file, sotwis_file, output_file, cache_dir=None, polygon_store=None):
+    # Load the NASA and SOTWIS datasets
+    nasa_df = read_table(nasa_file)
+    sotwis_df = read_table(sotwis_file)
+
+    # Exact polygons if a polygon store is available, bounding boxes otherwise
+    polygons = None
+    if polygon_store and os.path.isdir(polygon_store):
+        polygons = PolygonStore.load(polygon_store)
+        print(f"Exact join against {len(polygons)} SOTWIS polygons")
+        if cache_dir:
+            cache_dir = join_cache_dir(cache_dir, polygon_store)
+    else:
+        print("Bounding box join")
+
+    # Match NASA points to SOTWIS polygons, one lookup per grid cell
+    cache = CellJoinCache(cache_dir, polygons=polygons) if cache_dir else None
+    merged_df = box_join(nasa_df, sotwis_df, cache=cache, polygons=polygons)
+
+    # Save the result
+    write_table(merged_df, output_file)
     print(f"Merged dataset saved to {output_file}")
 
-# Example usage
-nasa_file = '../output/merged_nasa_power.csv'  # NASA Power Data
-sotwis_file = '../output/sotwis_processed.csv'  # SOTWIS Processed Data
-output_file = '../output/merged_sotwis_nasa.csv'  # Output merged data
+if __name__ == "__main__":
+    with tracing('merge'):
+        # Example usage
+        nasa_file = '../output/nasa_power_wide.parquet'  # NASA Power Data, one row per cell and year
+        sotwis_file = '../output/sotwis_processed.parquet'  # SOTWIS Processed Data
+        output_file = '../output/merged_sotwis_nasa.parquet'  # Output merged data
+        cache_dir = '../output/join_cache'  # Cell to SOTWIS box mapping reused across runs
+        polygon_store = '../output/sotwis_polygons'  # Exact SOTWIS polygons, if extracted
 
-merge_datasets_efficiently(nasa_file, sotwis_file, output_file)
+        merge_datasets_efficiently(nasa_file, sotwis_file, output_file, cache_dir, polygon_store)
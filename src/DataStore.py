@@ -0,0 +1,289 @@
+import os
+import shutil
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+from Profiling import profiled, record_read, record_write
+from TableSchema import PARTITION_COLUMN, apply_schema, arrow_table, declared_schema
+
+# Every intermediate table is stored as Parquet unless its path ends in .csv
+PARQUET_COMPRESSION = 'zstd'
+
+# Tables carrying PARTITION_COLUMN are partitioned on it (one directory per year)
+PARTITION_SCHEMA = pa.schema([(PARTITION_COLUMN, pa.int16())])
+
+def is_csv(path):
+    """
+    Return True if the table at path is (or should be) stored as CSV
+    """
+    return str(path).lower().endswith('.csv')
+
+def remove_table(path):
+    """
+    Delete a stored table, whether it is a single file or a partitioned directory
+    """
+    path = str(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def copy_table(path, destination):
+    """
+    Copy a stored table, whether it is a single file or a partitioned directory
+    """
+    remove_table(destination)
+    os.makedirs(os.path.dirname(str(destination)) or '.', exist_ok=True)
+    if os.path.isdir(str(path)):
+        shutil.copytree(str(path), str(destination))
+    else:
+        shutil.copyfile(str(path), str(destination))
+    record_write(destination)
+
+def unify_schemas(schemas):
+    """
+    Merge the Arrow schemas of several chunks of one table into a single schema.
+
+    Null-typed (all-missing) chunks are ignored, mixed integer and float columns
+    become float64 and any other mix becomes a string column.
+    """
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, set())
+            if not pa.types.is_null(field.type):
+                types[field.name].add(field.type)
+
+    fields = []
+    for name, seen in types.items():
+        if len(seen) == 1:
+            field_type = seen.pop()
+        elif seen and all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in seen):
+            field_type = pa.float64()
+        else:
+            field_type = pa.string()
+        fields.append(pa.field(name, field_type))
+    return pa.schema(fields)
+
+def _partition_by(df, partition_by):
+    if partition_by is None:
+        partition_by = [PARTITION_COLUMN] if PARTITION_COLUMN in df.columns else []
+    return [col for col in partition_by if col in df.columns]
+
+def write_table(df, path, partition_by=None):
+    """
+    Persist a DataFrame as compressed Parquet (or CSV if path ends in .csv),
+    with the column types declared in TableSchema.
+
+    Parameters:
+        df (DataFrame): Table to store.
+        path (str): Destination file, or directory for a partitioned dataset.
+        partition_by (list): Partition columns. Defaults to ['YEAR'] when present.
+    """
+    remove_table(path)
+    os.makedirs(os.path.dirname(str(path)) or '.', exist_ok=True)
+
+    if is_csv(path):
+        df.to_csv(path, index=False)
+        record_write(path, rows=len(df))
+        return
+
+    partition_by = _partition_by(df, partition_by)
+    table = arrow_table(df)
+    if partition_by:
+        pq.write_to_dataset(
+            table, str(path),
+            partition_cols=partition_by,
+            compression=PARQUET_COMPRESSION,
+            basename_template='part-{i}.parquet'
+        )
+    else:
+        pq.write_table(table, str(path), compression=PARQUET_COMPRESSION)
+    record_write(path, rows=len(df))
+
+def replace_partitions(df, path):
+    """
+    Rewrite the YEAR partitions of a partitioned table that df holds rows for,
+    leaving every other partition untouched. Each partition is written aside
+    and then moved in place. Tables that are not partitioned are rewritten whole.
+    """
+    path = str(path)
+    if is_csv(path) or not os.path.isdir(path) or PARTITION_COLUMN not in df.columns:
+        write_table(df, path)
+        return
+
+    for value, part in df.groupby(PARTITION_COLUMN, sort=True):
+        partition = os.path.join(path, f"{PARTITION_COLUMN}={value}")
+        staging = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        pq.write_to_dataset(
+            arrow_table(part.drop(columns=PARTITION_COLUMN)), staging,
+            compression=PARQUET_COMPRESSION,
+            basename_template='part-{i}.parquet'
+        )
+        remove_table(partition)
+        os.rename(staging, partition)
+    record_write(path, rows=len(df))
+
+class TableWriter:
+    """
+    Append DataFrame chunks to a table without holding them all in memory.
+
+    If a schema is given every chunk is converted to it (with the declared
+    TableSchema types), so chunks in which a column happens to be empty or
+    differently inferred still line up.
+    """
+    def __init__(self, path, partition_by=None, schema=None):
+        self.path = str(path)
+        self.partition_by = partition_by
+        self.schema = declared_schema(schema) if schema is not None else None
+        self.rows_written = 0
+        self._writer = None
+        self._chunks = 0
+        remove_table(self.path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+
+    def write(self, df):
+        if is_csv(self.path):
+            df.to_csv(self.path, mode='a', header=self._chunks == 0, index=False)
+        else:
+            partition_by = _partition_by(df, self.partition_by)
+            table = arrow_table(df, self.schema)
+            if partition_by:
+                pq.write_to_dataset(
+                    table, self.path,
+                    partition_cols=partition_by,
+                    compression=PARQUET_COMPRESSION,
+                    basename_template=f'part-{self._chunks}-{uuid.uuid4().hex[:8]}-{{i}}.parquet'
+                )
+            else:
+                if self._writer is None:
+                    self._writer = pq.ParquetWriter(self.path, table.schema,
+                                                    compression=PARQUET_COMPRESSION)
+                self._writer.write_table(table.cast(self._writer.schema))
+        self._chunks += 1
+        self.rows_written += len(df)
+        record_write(rows=len(df), nbytes=0)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        record_write(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _dataset(path):
+    path = str(path)
+    partitioning = None
+    if os.path.isdir(path):
+        partitioning = ds.partitioning(PARTITION_SCHEMA, flavor='hive')
+    return ds.dataset(
+        path,
+        format='parquet',
+        partitioning=partitioning,
+        filesystem=fs.LocalFileSystem(use_mmap=True)
+    )
+
+def read_table(path, columns=None, filter=None):
+    """
+    Load a stored table with the declared column types, reading only the requested columns.
+
+    Parameters:
+        path (str): Parquet file, partitioned directory or CSV file.
+        columns (list): Columns to load. Defaults to all columns.
+        filter (Expression): Optional pyarrow row filter, e.g. ds.field('YEAR') >= 2000.
+
+    Returns:
+        DataFrame: The loaded table.
+    """
+    if is_csv(path):
+        df = pd.read_csv(path, usecols=columns)
+        if filter is not None:
+            df = pa.Table.from_pandas(df).filter(filter).to_pandas()
+    else:
+        df = _dataset(path).to_table(columns=columns, filter=filter).to_pandas()
+    record_read(path, rows=len(df))
+    return apply_schema(df)
+
+def iter_partitions(path, columns=None):
+    """
+    Yield a stored table one YEAR partition at a time.
+
+    Partitioned Parquet datasets are read partition by partition; CSV files and
+    single Parquet files are loaded once and split on YEAR when present.
+    """
+    if is_csv(path) or not os.path.isdir(str(path)):
+        df = read_table(path, columns=columns)
+        if PARTITION_COLUMN not in df.columns:
+            yield df
+            return
+        for _, part in df.groupby(PARTITION_COLUMN, sort=True):
+            yield part.reset_index(drop=True)
+        return
+
+    dataset = _dataset(path)
+    record_read(path)
+    values = sorted({
+        ds.get_partition_keys(fragment.partition_expression).get(PARTITION_COLUMN)
+        for fragment in dataset.get_fragments()
+    } - {None})
+    for value in values:
+        table = dataset.to_table(columns=columns, filter=ds.field(PARTITION_COLUMN) == value)
+        record_read(rows=table.num_rows, nbytes=0)
+        yield apply_schema(table.to_pandas())
+
+def iter_batches(path, columns=None, batch_size=100000):
+    """
+    Yield a stored table as DataFrames of at most batch_size rows
+    """
+    record_read(path)
+    if is_csv(path):
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=batch_size):
+            record_read(rows=len(chunk), nbytes=0)
+            yield apply_schema(chunk)
+        return
+    for batch in _dataset(path).to_batches(columns=columns, batch_size=batch_size):
+        record_read(rows=batch.num_rows, nbytes=0)
+        yield apply_schema(batch.to_pandas())
+
+def table_columns(path):
+    """
+    Return the column names of a stored table without loading any rows
+    """
+    if is_csv(path):
+        return pd.read_csv(path, nrows=0).columns.tolist()
+    return _dataset(path).schema.names
+
+@profiled()
+def export_csv(path, csv_path, columns=None):
+    """
+    Export a stored table to CSV, one record batch at a time. A table that is
+    already the CSV file at csv_path is left as it is.
+    """
+    if os.path.abspath(str(path)) == os.path.abspath(str(csv_path)):
+        # Opening csv_path for writing would truncate the table before it is read
+        print(f"{csv_path} is already stored as CSV")
+        return
+    if is_csv(path):
+        batches = pd.read_csv(path, usecols=columns, chunksize=100000)
+    else:
+        batches = (batch.to_pandas() for batch in _dataset(path).to_batches(columns=columns))
+
+    os.makedirs(os.path.dirname(str(csv_path)) or '.', exist_ok=True)
+    header = True
+    rows = 0
+    with open(csv_path, 'w', newline='') as f:
+        for batch in batches:
+            batch.to_csv(f, header=header, index=False)
+            header = False
+            rows += len(batch)
+    record_read(path, rows=rows)
+    record_write(csv_path, rows=rows)
+    print(f"CSV export saved to {csv_path}")
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from scipy.special import digamma, gammainc, ndtri, polygamma
+from DataStore import TableWriter, copy_table, read_table
+from NasaPower_DataPreprocessing import monthly_tensor, table_parameters, wide_table
+from Profiling import profiled, span, tracing
+
+# Accumulation periods (months) of the standardized indices, e.g. SPI-3
+INDEX_WINDOWS = (1, 3, 6, 12)
+
+# Trailing rolling mean periods (months)
+MEAN_WINDOWS = (3, 6, 12)
+
+# Lags (months) of the raw values; 12 is the same month of the previous year
+LAGS = (1, 12)
+
+# Parameters standardized through a fitted gamma distribution (SPI); every
+# other parameter is standardized with its mean and deviation (e.g. SSMI for
+# the soil wetness parameters GWETTOP and GWETROOT)
+GAMMA_PARAMETERS = {'PRECTOT', 'PRECTOTCORR', 'PRECSNO'}
+
+# Below this many years a calendar month gets no standardized index
+MIN_YEARS = 5
+
+# Probabilities are clipped to this margin so the indices stay finite
+PROBABILITY_MARGIN = 1e-6
+
+# Newton steps refining Thom's gamma shape estimate to the maximum likelihood one
+SHAPE_NEWTON_STEPS = 4
+
+def feature_names(parameters, index_windows=INDEX_WINDOWS, mean_windows=MEAN_WINDOWS, lags=LAGS):
+    """
+    Names of the monthly features of every parameter, in the order compute_features returns them.
+    Every name N is stored as the columns N_JAN..N_DEC, so the names can be passed
+    as temporal_parameters to DroughtPredictionSystem.
+    """
+    return [
+        name for parameter in parameters for name in (
+            [f"{parameter}_SI{window}" for window in index_windows]
+            + [f"{parameter}_ANOM"]
+            + [f"{parameter}_MEAN{window}" for window in mean_windows]
+            + [f"{parameter}_LAG{lag}" for lag in lags]
+        )
+    ]
+
+def rolling_mean(series, window):
+    """
+    Trailing mean over window months along axis 1 of (cells, months) series,
+    from cumulative sums. Missing months are skipped; the first window - 1
+    months and windows without any value are NaN.
+    """
+    present = ~np.isnan(series)
+    sums = np.zeros((series.shape[0], series.shape[1] + 1))
+    counts = np.zeros((series.shape[0], series.shape[1] + 1))
+    np.cumsum(np.where(present, series, 0.0), axis=1, out=sums[:, 1:])
+    np.cumsum(present, axis=1, out=counts[:, 1:])
+
+    window_sums = sums[:, window:] - sums[:, :-window]
+    window_counts = counts[:, window:] - counts[:, :-window]
+    means = np.full(series.shape, np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means[:, window - 1:] = np.where(window_counts > 0, window_sums / window_counts, np.nan)
+    return means
+
+def lagged(series, lag):
+    """
+    (cells, months) series shifted lag months later along axis 1
+    """
+    shifted = np.full(series.shape, np.nan)
+    shifted[:, lag:] = series[:, :-lag]
+    return shifted
+
+def normal_index(values):
+    """
+    Standardize (cells, years, 12) values per cell and calendar month over the years
+    """
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=1, keepdims=True)
+    mean = np.where(valid, values, 0.0).sum(axis=1, keepdims=True) / np.maximum(n, 1)
+    deviation = np.sqrt(np.where(valid, (values - mean) ** 2, 0.0).sum(axis=1, keepdims=True) / np.maximum(n - 1, 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        index = (values - mean) / deviation
+    return np.where((n >= MIN_YEARS) & (deviation > 0), index, np.nan)
+
+def gamma_index(values):
+    """
+    SPI-style index of (cells, years, 12) non-negative values: a gamma
+    distribution is fitted per cell and calendar month by maximum likelihood
+    (Thom's approximation of the shape, refined by Newton steps on
+    log(shape) - digamma(shape) = log(mean) - mean(log)), with the
+    probability of zero handled separately, and its cumulative probability
+    mapped to the standard normal
+    """
+    valid = ~np.isnan(values)
+    positive = valid & (values > 0)
+    n = valid.sum(axis=1, keepdims=True)
+    n_positive = positive.sum(axis=1, keepdims=True)
+    zero_probability = (n - n_positive) / np.maximum(n, 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        positive_values = np.where(positive, values, 1.0)
+        mean = np.where(positive, values, 0.0).sum(axis=1, keepdims=True) / np.maximum(n_positive, 1)
+        mean_log = np.where(positive, np.log(positive_values), 0.0).sum(axis=1, keepdims=True) / np.maximum(n_positive, 1)
+        a = np.log(mean) - mean_log
+        fitted = (n >= MIN_YEARS) & (n_positive >= 2) & (a > 0)
+        a = np.where(fitted, a, 1.0)
+        shape = (1 + np.sqrt(1 + 4 * a / 3)) / (4 * a)
+        for _ in range(SHAPE_NEWTON_STEPS):
+            step = (np.log(shape) - digamma(shape) - a) / (1 / shape - polygamma(1, shape))
+            shape = np.maximum(shape - step, shape / 10)
+        scale = mean / shape
+        cumulative = gammainc(np.where(fitted, shape, 1.0), np.where(positive, values, 0.0) / np.where(fitted, scale, 1.0))
+
+    probability = zero_probability + (1 - zero_probability) * cumulative
+    index = ndtri(np.clip(probability, PROBABILITY_MARGIN, 1 - PROBABILITY_MARGIN))
+    return np.where(fitted & valid, index, np.nan)
+
+def compute_features(monthly, parameters, index_windows=INDEX_WINDOWS, mean_windows=MEAN_WINDOWS, lags=LAGS):
+    """
+    Drought features of every cell from its whole monthly series, computed for
+    all cells at once.
+
+    For each parameter: the standardized index of every accumulation window
+    (gamma-based for GAMMA_PARAMETERS, normal otherwise, fitted per cell and
+    calendar month over all years), the anomaly from the cell's calendar-month
+    mean, the trailing rolling means and the lagged values. Windows and lags
+    run across year boundaries.
+
+    Parameters:
+        monthly (ndarray): (cell, year, month, parameter) values, as returned by
+            monthly_tensor, with consecutive years.
+        parameters (list): Parameter of every slice of the last axis.
+
+    Returns:
+        ndarray: (cell, year, month, feature) float32 features, named by feature_names.
+    """
+    n_cells, n_years, n_months, _ = monthly.shape
+    n_features = len(feature_names(parameters, index_windows, mean_windows, lags))
+    features = np.empty((n_cells, n_years, n_months, n_features), dtype=np.float32)
+    columns = iter(range(n_features))
+    for p, parameter in enumerate(parameters):
+        # Each cell's series as one row of consecutive months
+        series = monthly[:, :, :, p].reshape(n_cells, n_years * n_months).astype(np.float64)
+        standardize = gamma_index if parameter in GAMMA_PARAMETERS else normal_index
+        for window in index_windows:
+            accumulated = rolling_mean(series, window).reshape(n_cells, n_years, n_months)
+            features[..., next(columns)] = standardize(accumulated)
+
+        values = series.reshape(n_cells, n_years, n_months)
+        valid = ~np.isnan(values)
+        climatology = np.where(valid, values, 0.0).sum(axis=1, keepdims=True) / np.maximum(valid.sum(axis=1, keepdims=True), 1)
+        features[..., next(columns)] = values - climatology
+
+        for window in mean_windows:
+            features[..., next(columns)] = rolling_mean(series, window).reshape(n_cells, n_years, n_months)
+        for lag in lags:
+            features[..., next(columns)] = lagged(series, lag).reshape(n_cells, n_years, n_months)
+    return features
+
+def features_key(df, params):
+    """
+    Hash of the content of a long NASA POWER table and of the feature parameters
+    """
+    digest = hashlib.sha256()
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+@profiled()
+def compute_drought_features(input_file, output_file, cache_dir=None, parameters=None, index_windows=INDEX_WINDOWS,
+                             mean_windows=MEAN_WINDOWS, lags=LAGS, cells_per_block=5000):
+    """
+    Compute the drought features of every cell and year from the long NASA
+    POWER table written by ingest_nasa_power, one row per cell and year with
+    the columns N_JAN..N_DEC of every feature N of feature_names.
+
+    Cells are processed in blocks of cells_per_block, each block in one
+    vectorized pass over the whole period. With a cache_dir, the result is
+    stored under the hash of the input rows and parameters and reused as long
+    as neither changes.
+
+    Parameters:
+        input_file (str): Long NASA POWER table.
+        output_file (str): Path of the feature table.
+        cache_dir (str): Optional directory of previously computed feature tables.
+        parameters (list): Parameters to derive features from. Defaults to all present.
+        index_windows (tuple): Accumulation periods of the standardized indices.
+        mean_windows (tuple): Rolling mean periods.
+        lags (tuple): Lags of the raw values.
+        cells_per_block (int): Cells processed at once, bounding memory.
+
+    Returns:
+        list: The feature names.
+    """
+    df = read_table(input_file)
+    if parameters is None:
+        parameters = table_parameters(df)
+    params = {
+        'parameters': list(parameters), 'index_windows': list(index_windows),
+        'mean_windows': list(mean_windows), 'lags': list(lags)
+    }
+    names = feature_names(parameters, index_windows, mean_windows, lags)
+
+    cached = None
+    if cache_dir:
+        cached = os.path.join(cache_dir, f"{features_key(df, params)}.parquet")
+        if os.path.exists(cached):
+            copy_table(cached, output_file)
+            print(f"Drought features unchanged, reused {cached}")
+            return names
+
+    cells, years, parameters, monthly, _ = monthly_tensor(df, parameters)
+    del df
+    with TableWriter(cached or output_file) as writer:
+        for start in range(0, len(cells), cells_per_block):
+            block = slice(start, start + cells_per_block)
+            with span('compute_features'):
+                features = compute_features(monthly[block], parameters, index_windows, mean_windows, lags)
+            writer.write(wide_table(cells[block], years, names, features))
+    if cached:
+        copy_table(cached, output_file)
+    print(f"{len(names)} drought features of {len(cells)} cells over {len(years)} years saved to {output_file}")
+    return names
+
+if __name__ == "__main__":
+    with tracing('drought_indices'):
+        input_file = "../output/merged_nasa_power.parquet"  # Long NASA POWER table
+        output_file = "../output/drought_features.parquet"
+        cache_dir = "../output/feature_cache"  # Feature tables keyed by input hash
+
+        names = compute_drought_features(input_file, output_file, cache_dir)
+        print(f"Features: {names}")
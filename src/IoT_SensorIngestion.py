@@ -0,0 +1,392 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from http import HTTPStatus
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from scipy.spatial import cKDTree
+from DataStore import PARQUET_COMPRESSION, read_table, replace_partitions
+from DataMerger import CellJoinCache, join_cache_dir
+from NasaPower_DataPreprocessing import MONTH_COLUMNS, PRIMARY_PARAMETER, parameter_columns
+from PolygonStore import PolygonStore
+from Profiling import profiled, record_write, tracing
+
+# Soil moisture readings as fractions (0-1), comparable to NASA POWER GWETTOP
+READING_SCHEMA = pa.schema([
+    ('SENSOR_ID', pa.string()),
+    ('TIMESTAMP', pa.timestamp('ms', tz='UTC')),
+    ('LAT', pa.float64()),
+    ('LON', pa.float64()),
+    ('SOIL_MOISTURE', pa.float32())
+])
+
+IOT_PARAMETER = 'IOT_SOIL_MOISTURE'
+
+# Decimal places on which sensor cells and feature table rows are matched
+COORDINATE_DECIMALS = 4
+
+# Readings stamped further than this in the future are rejected as clock errors
+MAX_CLOCK_SKEW = pd.Timedelta(minutes=10)
+
+def readings_frame(records):
+    """
+    Validate a list of reading dicts into a DataFrame following READING_SCHEMA.
+    Readings with a missing or malformed timestamp, position or value, or
+    stamped more than MAX_CLOCK_SKEW in the future, are dropped, the others
+    are kept.
+    """
+    df = pd.DataFrame.from_records(records, columns=READING_SCHEMA.names)
+    df['SENSOR_ID'] = df['SENSOR_ID'].astype(str)
+    df['TIMESTAMP'] = pd.to_datetime(df['TIMESTAMP'], utc=True, format='ISO8601', errors='coerce')
+    for col in ['LAT', 'LON', 'SOIL_MOISTURE']:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    df = df.dropna(subset=['TIMESTAMP', 'LAT', 'LON', 'SOIL_MOISTURE'])
+    return df[df['TIMESTAMP'] <= pd.Timestamp.now(tz='UTC') + MAX_CLOCK_SKEW]
+
+class ReadingLog:
+    """
+    Append-only columnar log of raw readings: every flush writes a new
+    compressed Parquet segment, existing segments are never rewritten.
+    The whole log is read back with read().
+    """
+    def __init__(self, log_dir):
+        self.log_dir = str(log_dir)
+        self.segments = 0
+        self.rows_written = 0
+        os.makedirs(self.log_dir, exist_ok=True)
+
+    def append(self, df):
+        if len(df) == 0:
+            return
+        table = pa.Table.from_pandas(df[READING_SCHEMA.names], schema=READING_SCHEMA, preserve_index=False)
+        path = os.path.join(self.log_dir, f"segment-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet")
+        pq.write_table(table, path, compression=PARQUET_COMPRESSION)
+        record_write(path, rows=len(df))
+        self.segments += 1
+        self.rows_written += len(df)
+
+    def read(self):
+        return ds.dataset(self.log_dir, format='parquet', schema=READING_SCHEMA).to_table().to_pandas()
+
+class CellMapper:
+    """
+    Assign sensors to the NASA POWER grid cells known to DataMerger's
+    CellJoinCache, so readings land on the same (LAT, LON) cells as the
+    merged NASA/SOTWIS table.
+    """
+    def __init__(self, cells, max_distance=0.5):
+        self.cells = cells[['LAT', 'LON']].reset_index(drop=True)
+        self.tree = cKDTree(self.cells.to_numpy(dtype='float64'))
+        self.max_distance = max_distance
+
+    @classmethod
+    def from_join_cache(cls, cache_dir, polygon_store=None, max_distance=0.5):
+        """
+        Cells of the join cache written by merge_datasets_efficiently with the
+        same cache_dir and polygon_store (the exact join keeps its own cache)
+        """
+        directory = join_cache_dir(cache_dir, polygon_store)
+        polygons = PolygonStore.load(polygon_store) if directory != cache_dir else None
+        return cls(CellJoinCache(directory, polygons=polygons).cells, max_distance)
+
+    def map(self, lats, lons):
+        """
+        Return the cell position of every point, -1 when no cell is within max_distance degrees
+        """
+        distances, positions = self.tree.query(np.column_stack([lats, lons]), k=1)
+        return np.where(distances <= self.max_distance, positions, -1)
+
+class MonthlyAggregates:
+    """
+    Rolling per-cell monthly means of the readings, kept in memory as running
+    sums and counts. Only the last keep_months months up to the current
+    month (by the wall clock, not the latest reading) are retained.
+    """
+    def __init__(self, cells, keep_months=24):
+        self.cells = cells.reset_index(drop=True)
+        self.keep_months = keep_months
+        index = pd.MultiIndex.from_arrays([[], [], []], names=['CELL', 'YEAR', 'MONTH'])
+        self.sums = pd.Series(dtype='float64', index=index)
+        self.counts = pd.Series(dtype='float64', index=index)
+        # Incremented on every update, so consumers can tell whether the means changed
+        self.version = 0
+        # update() runs in a worker thread while table() is served from the event loop
+        self._lock = threading.Lock()
+
+    def update(self, df, cell_positions):
+        mapped = cell_positions >= 0
+        if not mapped.any():
+            return
+        timestamps = df['TIMESTAMP'][mapped]
+        keys = pd.MultiIndex.from_arrays([
+            cell_positions[mapped],
+            timestamps.dt.year.to_numpy(),
+            timestamps.dt.month.to_numpy()
+        ], names=['CELL', 'YEAR', 'MONTH'])
+        moisture = pd.Series(df['SOIL_MOISTURE'][mapped].to_numpy(dtype='float64'), index=keys)
+        grouped = moisture.groupby(level=['CELL', 'YEAR', 'MONTH'])
+        with self._lock:
+            sums, counts = self._expire(
+                self.sums.add(grouped.sum(), fill_value=0),
+                self.counts.add(grouped.count(), fill_value=0)
+            )
+            self.sums, self.counts = sums, counts
+            self.version += 1
+
+    def _expire(self, sums, counts, now=None):
+        if len(sums) == 0:
+            return sums, counts
+        now = now or pd.Timestamp.now(tz='UTC')
+        months = sums.index.get_level_values('YEAR') * 12 + sums.index.get_level_values('MONTH') - 1
+        keep = months > now.year * 12 + now.month - 1 - self.keep_months
+        return sums[keep], counts[keep]
+
+    def table(self):
+        """
+        Monthly means in the NASA POWER layout (PARAMETER, YEAR, LAT, LON,
+        JAN..DEC, ANN), one row per cell and year
+        """
+        with self._lock:
+            sums, counts = self.sums, self.counts
+        if len(sums) == 0:
+            return pd.DataFrame(columns=['PARAMETER', 'YEAR', 'LAT', 'LON'] + MONTH_COLUMNS + ['ANN'])
+        means = (sums / counts).unstack('MONTH').reindex(columns=range(1, 13))
+        means.columns = MONTH_COLUMNS
+        means = means.astype('float32').reset_index()
+        cells = self.cells.iloc[means.pop('CELL').to_numpy()].reset_index(drop=True)
+        means.insert(0, 'PARAMETER', IOT_PARAMETER)
+        means.insert(2, 'LAT', cells['LAT'])
+        means.insert(3, 'LON', cells['LON'])
+        means['YEAR'] = means['YEAR'].astype('int16')
+        means['ANN'] = means[MONTH_COLUMNS].mean(axis=1)
+        return means
+
+def cell_year_index(df):
+    """
+    (LAT, LON, YEAR) of every row, with the coordinates rounded to
+    COORDINATE_DECIMALS so float32 and float64 copies of a cell match
+    """
+    return pd.MultiIndex.from_arrays([
+        df['LAT'].to_numpy(dtype='float64').round(COORDINATE_DECIMALS),
+        df['LON'].to_numpy(dtype='float64').round(COORDINATE_DECIMALS),
+        df['YEAR'].to_numpy(dtype='int64')
+    ], names=['LAT', 'LON', 'YEAR'])
+
+@profiled()
+def merge_into_feature_table(means, table_path, parameter=PRIMARY_PARAMETER):
+    """
+    Upsert per-cell monthly sensor means, as returned by MonthlyAggregates.table,
+    into a wide NASA/SOTWIS feature table (e.g. the augmented table the model
+    is trained on) per (LAT, LON, YEAR).
+
+    In the rows of the table, every month with readings replaces the monthly
+    value of parameter and its annual value is recomputed from the months.
+    A year the table has no row for is added for a cell once all twelve months
+    have readings, with the other columns taken from the cell's latest row.
+    Only the YEAR partitions holding changed rows are rewritten.
+
+    Parameters:
+        means (DataFrame): Monthly means with YEAR, LAT, LON and JAN..DEC.
+        table_path (str): Wide feature table, as written by the pipeline.
+        parameter (str): Parameter the readings measure.
+
+    Returns:
+        tuple: Numbers of rows updated and added.
+    """
+    if len(means) == 0:
+        return 0, 0
+    month_columns = parameter_columns(parameter)
+    annual_column = parameter_columns(parameter, ['ANN'])[0]
+    sensor = means[MONTH_COLUMNS].set_axis(cell_year_index(means))
+    sensor = sensor[~sensor.index.duplicated(keep='last')]
+
+    keys = read_table(table_path, columns=['LAT', 'LON', 'YEAR'])
+    index = cell_year_index(keys)
+    cells = index.droplevel('YEAR')
+    # Complete sensor years of known cells that the table has no row for yet
+    new = sensor[sensor.notna().all(axis=1) & ~sensor.index.isin(index)
+                 & sensor.index.droplevel('YEAR').isin(cells)]
+    latest_years = pd.Series(index.get_level_values('YEAR'), index=cells).groupby(level=['LAT', 'LON']).max()
+    template_years = latest_years.reindex(new.index.droplevel('YEAR')).to_numpy()
+
+    changed_years = set(sensor.index.get_level_values('YEAR')) & set(index.get_level_values('YEAR'))
+    changed_years |= set(new.index.get_level_values('YEAR'))
+    df = read_table(table_path, filter=ds.field('YEAR').isin(
+        sorted(changed_years | set(template_years.tolist()))
+    ))
+    df_index = cell_year_index(df)
+
+    # Months with readings replace the values of the existing rows
+    readings = sensor.reindex(df_index).to_numpy(dtype='float32')
+    updated = ~np.isnan(readings).all(axis=1)
+    months = df[month_columns].to_numpy(dtype='float32')
+    df[month_columns] = np.where(np.isnan(readings), months, readings)
+    df[annual_column] = df[month_columns].mean(axis=1).astype('float32')
+
+    # New years start from a copy of the cell's latest row
+    templates = df.set_axis(df_index).loc[lambda t: ~t.index.duplicated(keep='last')]
+    added = templates.reindex(pd.MultiIndex.from_arrays([
+        new.index.get_level_values('LAT'), new.index.get_level_values('LON'), template_years
+    ], names=['LAT', 'LON', 'YEAR'])).reset_index(drop=True)
+    added['YEAR'] = new.index.get_level_values('YEAR').to_numpy()
+    added[month_columns] = new.to_numpy(dtype='float32')
+    added[annual_column] = added[month_columns].mean(axis=1).astype('float32')
+
+    touched = df[df['YEAR'].isin(set(df.loc[updated, 'YEAR']) | set(added['YEAR']))]
+    if len(touched) or len(added):
+        replace_partitions(pd.concat([touched, added], ignore_index=True), table_path)
+    return int(updated.sum()), len(added)
+
+class SensorIngestionService:
+    """
+    asyncio service accepting sensor readings over HTTP.
+
+    POST /readings with one reading or a list of readings
+    ({"SENSOR_ID", "TIMESTAMP", "LAT", "LON", "SOIL_MOISTURE"}) queues them;
+    a consumer task appends them to the ReadingLog in batches of at most
+    flush_rows or every flush_seconds, and updates the monthly aggregates.
+    With a feature_table, the aggregates are merged into it every
+    merge_seconds when they changed, so the model inputs follow the readings
+    without re-running the batch pipeline.
+    GET /aggregates returns the current per-cell monthly means.
+    """
+    def __init__(self, log_dir, mapper, flush_rows=5000, flush_seconds=2.0, keep_months=24,
+                 feature_table=None, merge_seconds=60.0):
+        self.log = ReadingLog(log_dir)
+        self.mapper = mapper
+        self.aggregates = MonthlyAggregates(mapper.cells, keep_months)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.feature_table = feature_table
+        self.merge_seconds = merge_seconds
+        self.merged_version = 0
+        self.queue = asyncio.Queue()
+        self.unmapped = 0
+
+    @profiled()
+    def ingest(self, records):
+        """
+        Validate a batch of readings, log it and update the aggregates
+        """
+        df = readings_frame(records)
+        if len(df) == 0:
+            return 0
+        self.log.append(df)
+        cell_positions = self.mapper.map(df['LAT'].to_numpy(), df['LON'].to_numpy())
+        self.unmapped += int((cell_positions < 0).sum())
+        self.aggregates.update(df, cell_positions)
+        return len(df)
+
+    async def consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_seconds
+            while len(batch) < self.flush_rows:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await asyncio.to_thread(self.ingest, batch)
+            except Exception as e:
+                print(f"Error ingesting {len(batch)} readings: {str(e)}")
+
+    def merge(self):
+        """
+        Merge the aggregates into the feature table if they changed since the last merge
+        """
+        version = self.aggregates.version
+        if version == self.merged_version:
+            return 0, 0
+        counts = merge_into_feature_table(self.aggregates.table(), self.feature_table)
+        self.merged_version = version
+        return counts
+
+    async def merge_periodically(self):
+        while True:
+            await asyncio.sleep(self.merge_seconds)
+            try:
+                updated, added = await asyncio.to_thread(self.merge)
+                if updated or added:
+                    print(f"Feature table: {updated} rows updated, {added} rows added")
+            except Exception as e:
+                print(f"Error merging aggregates into {self.feature_table}: {str(e)}")
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = {}
+            while (line := (await reader.readline()).decode().strip()):
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            method, path = request_line[0], request_line[1]
+            if method == 'POST' and path == '/readings':
+                readings = json.loads(body)
+                readings = readings if isinstance(readings, list) else [readings]
+                if not all(isinstance(reading, dict) for reading in readings):
+                    raise ValueError("Every reading must be a JSON object")
+                for reading in readings:
+                    self.queue.put_nowait(reading)
+                status, payload = 202, {'queued': len(readings)}
+            elif method == 'GET' and path == '/aggregates':
+                status, payload = 200, json.loads(self.aggregates.table().to_json(orient='records'))
+            else:
+                status, payload = 404, {'error': f"Unknown path {path}"}
+        except (ValueError, IndexError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {'error': str(e)}
+
+        data = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8081):
+        tasks = [asyncio.create_task(self.consume())]
+        if self.feature_table:
+            tasks.append(asyncio.create_task(self.merge_periodically()))
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Accepting sensor readings on http://{host}:{port}/readings")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+async def post_readings(readings, host='127.0.0.1', port=8081):
+    """
+    Minimal HTTP client used as a local stand-in for the sensor gateways
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(readings).encode()
+    writer.write(
+        f"POST /readings HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b'\r\n\r\n', 1)[1])
+
+if __name__ == "__main__":
+    with tracing('iot_ingestion'):
+        log_dir = '../output/iot_readings'  # Append-only log of raw readings
+        cache_dir = '../output/join_cache'  # Cells known to DataMerger
+        polygon_store = '../output/sotwis_polygons'  # Exact SOTWIS polygons, if extracted
+        feature_table = '../output/AUGUMENTED_SOTWIS_NASA.parquet'  # Model inputs updated by the readings
+
+        service = SensorIngestionService(log_dir, CellMapper.from_join_cache(cache_dir, polygon_store),
+                                         feature_table=feature_table)
+        asyncio.run(service.serve())
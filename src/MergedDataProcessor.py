@@ -1,8 +1,14 @@
+import os
+import tempfile
 import pandas as pd
 import numpy as np
+import joblib
 from joblib import Parallel, delayed
+from DataStore import read_table, write_table, iter_partitions, table_columns, export_csv, TableWriter
+from Profiling import profiled, tracing
 
 # Function to resolve conflicts within a group
+@profiled()
 def resolve_conflicts_fast(group):
     data = group.to_numpy()
     columns = group.columns
@@ -33,68 +39,249 @@ def resolve_conflicts_fast(group):
 
     return pd.DataFrame(results, columns=columns)
 
-# Function to apply parallel processing
-def merge_duplicates_parallel(input_file, output_file, n_jobs=-1):
-    df = pd.read_csv(input_file)
+# Fields identifying a single merged record
+GROUP_KEYS = ['LAT', 'LON', 'YEAR']
+
+# Below this many conflicting rows per worker, process start-up costs more than it saves
+MIN_ROWS_PER_WORKER = 10000
+
+@profiled()
+def find_conflicting_groups(df, keys=GROUP_KEYS):
+    """
+    Label each row with its group id and flag the groups holding more than one
+    distinct non-null value in any column.
+
+    Returns:
+        tuple: (group id per row, -1 for null keys; boolean conflict flag per group)
+    """
+    group_ids = df.groupby(keys, sort=True).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    n_groups = group_ids.max() + 1 if len(group_ids) else 0
+    valid = group_ids >= 0
+    value_columns = df.columns.difference(keys, sort=False)
+
+    conflicts = np.zeros(n_groups, dtype=bool)
+    numeric_columns = df[value_columns].select_dtypes(include='number').columns
+    other_columns = value_columns.difference(numeric_columns, sort=False)
 
-    # Group by the unique identifier fields
-    grouped = df.groupby(['LAT', 'LON', 'YEAR'])
+    # More than one distinct non-null number in a group <=> its min and max differ
+    if len(numeric_columns):
+        grouped = df.loc[valid, numeric_columns].groupby(group_ids[valid])
+        maxima, minima = grouped.max(), grouped.min()
+        conflicts[maxima.index] |= ((maxima != minima) & maxima.notna()).any(axis=1).to_numpy()
 
-    # Resolve conflicts in parallel
-    resolved_groups = Parallel(n_jobs=n_jobs)(
-        delayed(resolve_conflicts_fast)(group) for _, group in grouped
-    )
+    if len(other_columns):
+        distinct = df.loc[valid, other_columns].groupby(group_ids[valid]).nunique(dropna=True)
+        conflicts[distinct.index] |= (distinct > 1).any(axis=1).to_numpy()
 
-    # Combine all resolved groups into a single DataFrame
-    resolved_df = pd.concat(resolved_groups, ignore_index=True)
+    return group_ids, conflicts
 
-    # Save the resolved DataFrame
-    resolved_df.to_csv(output_file, index=False)
-    print(f"Resolved dataset saved to {output_file}")
+@profiled()
+def encode_columns(df):
+    """
+    Replace every value by an integer code (-1 for nulls) so that equality
+    checks between rows run on plain integer arrays
+    """
+    if not len(df.columns):
+        return np.empty((len(df), 0), dtype=np.int64)
+    return np.column_stack([pd.factorize(df[col])[0] for col in df.columns])
+
+def resolve_group_codes(codes, offset=0):
+    """
+    resolve_conflicts_fast on an encoded group.
 
-# Example usage
-merged_file = '../output/merged_sotwis_nasa.csv'  # Input file
-output_file = '../output/resolved_sotwis_nasa.csv'  # Output file
+    Returns one array per output row giving, for each column, the position of
+    the row the value is taken from (-1 when it stays null).
+    """
+    n_rows = len(codes)
+    positions = np.arange(n_rows) + offset
+    merged = np.zeros(n_rows, dtype=bool)
 
-merge_duplicates_parallel(merged_file, output_file)
+    results = []
+    for i in range(n_rows):
+        if merged[i]:
+            continue  # Skip rows already merged
 
+        own_sources = np.where(codes[i] >= 0, positions[i], -1)
+        merged_codes = codes[i].copy()
+        sources = own_sources.copy()
+        conflict_found = False
+
+        for j in range(i + 1, n_rows):
+            row_j = codes[j]
+            if np.any((merged_codes >= 0) & (row_j >= 0) & (merged_codes != row_j)):
+                conflict_found = True
+                continue
+
+            fill = (merged_codes < 0) & (row_j >= 0)
+            merged_codes[fill] = row_j[fill]
+            sources[fill] = positions[j]
+            merged[j] = True
+
+        results.append(sources if not conflict_found else own_sources)
+
+    return results
+
+def resolve_encoded_groups(codes, bounds, offset=0):
+    """
+    Resolve consecutive encoded groups; bounds holds the start of every group
+    followed by the end of the last one
+    """
+    results = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        results.extend(resolve_group_codes(codes[start:end], offset + start))
+    return results
+
+def resolve_encoded_chunk(codes_file, bounds):
+    """
+    Worker entry point: resolve a run of groups from the memory-mapped codes
+    """
+    codes = np.load(codes_file, mmap_mode='r')
+    results = resolve_encoded_groups(codes[bounds[0]:bounds[-1]], bounds - bounds[0], bounds[0])
+    return np.array(results, dtype=np.int64).reshape(len(results), codes.shape[1])
+
+def balanced_chunks(bounds, n_chunks):
+    """
+    Split consecutive groups into at most n_chunks runs of similar cost.
+
+    The row-by-row merge is quadratic in the group size, so runs are balanced
+    on the sum of squared group sizes rather than on the number of groups.
+    """
+    cost = np.cumsum(np.diff(bounds).astype(np.float64) ** 2)
+    targets = cost[-1] * np.arange(1, n_chunks) / n_chunks
+    edges = np.unique(np.r_[0, np.searchsorted(cost, targets, side='right'), len(cost)])
+    return [bounds[start:end + 1] for start, end in zip(edges[:-1], edges[1:])]
+
+@profiled()
+def resolve_in_chunks(codes, bounds, n_jobs=1, chunks_per_worker=4):
+    """
+    Resolve encoded groups in size-balanced chunks.
+
+    Workers read their rows from a memory-mapped copy of the codes instead of
+    receiving pickled DataFrames.
+
+    Returns:
+        ndarray: Source row position per output row and column.
+    """
+    n_groups = len(bounds) - 1
+    n_workers = min(n_groups, len(codes) // MIN_ROWS_PER_WORKER, joblib.effective_n_jobs(n_jobs))
+    if n_workers <= 1:
+        results = resolve_encoded_groups(codes, bounds)
+        return np.array(results, dtype=np.int64).reshape(len(results), codes.shape[1])
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        codes_file = os.path.join(temp_dir, 'codes.npy')
+        np.save(codes_file, codes)
+        resolved = Parallel(n_jobs=n_workers)(
+            delayed(resolve_encoded_chunk)(codes_file, chunk)
+            for chunk in balanced_chunks(bounds, n_workers * chunks_per_worker)
+        )
+    return np.concatenate(resolved)
+
+@profiled()
+def resolve_conflicts_vectorized(df, keys=GROUP_KEYS, n_jobs=1):
+    """
+    Resolve duplicate records with the same semantics as resolve_conflicts_fast
+    applied to every (LAT, LON, YEAR) group.
+
+    Groups without conflicting values collapse to their first non-null value per
+    column in one groupby pass. Only the genuinely conflicting groups go through
+    the row-by-row merge, which runs on integer-encoded columns.
+
+    Parameters:
+        df (DataFrame): Merged SOTWIS/NASA rows.
+        keys (list): Columns identifying a record.
+        n_jobs (int): Parallel workers for the conflicting groups (joblib convention).
+
+    Returns:
+        DataFrame: Resolved rows ordered by group key.
+    """
+    group_ids, conflicts = find_conflicting_groups(df, keys)
+    valid = group_ids >= 0
+    slow_rows = valid & conflicts[np.where(valid, group_ids, 0)]
+    fast_rows = valid & ~slow_rows
+
+    # Conflict-free groups: a single coalescing reduction
+    coalesced = df[fast_rows].groupby(group_ids[fast_rows], sort=True).first()
+    parts = [coalesced.reset_index(drop=True)]
+    part_ids = [coalesced.index.to_numpy()]
+
+    # Conflicting groups: the row-by-row merge on encoded values
+    if slow_rows.any():
+        order = np.argsort(group_ids[slow_rows], kind='stable')
+        slow_df = df[slow_rows].iloc[order].reset_index(drop=True)
+        slow_ids = group_ids[slow_rows][order]
+        codes = encode_columns(slow_df)
+        bounds = np.flatnonzero(np.r_[True, slow_ids[1:] != slow_ids[:-1], True])
+
+        sources = resolve_in_chunks(codes, bounds, n_jobs=n_jobs)
+
+        parts.append(pd.DataFrame({
+            col: pd.api.extensions.take(slow_df[col].array, sources[:, c], allow_fill=True)
+            for c, col in enumerate(df.columns)
+        }))
+        part_ids.append(slow_ids[sources[:, df.columns.get_loc(keys[0])]])
+
+    resolved_df = pd.concat(parts, ignore_index=True)
+    order = np.argsort(np.concatenate(part_ids), kind='stable')
+    return resolved_df.iloc[order].reset_index(drop=True)
+
+# Function to apply parallel processing
+@profiled()
+def merge_duplicates_parallel(input_file, output_file, n_jobs=-1):
+    # Groups never span years, so the table is resolved and written one YEAR
+    # partition at a time and memory stays bounded by the largest year
+    with TableWriter(output_file) as writer:
+        for df in iter_partitions(input_file):
+            # Coalesce duplicates per (LAT, LON, YEAR), resolving conflicts in parallel
+            writer.write(resolve_conflicts_vectorized(df, n_jobs=n_jobs))
+
+    print(f"Resolved dataset saved to {output_file} ({writer.rows_written} rows)")
+
+@profiled()
 def drop_pattern_columns(input_csv, output_csv, column_patterns, specific_columns):
     """
-    Drop columns matching patterns or specific names from a CSV file and save the result to a new file.
+    Drop columns matching patterns or specific names from a table and save the result to a new file.
 
     Parameters:
-        input_csv (str): Path to the input CSV file.
-        output_csv (str): Path to save the modified CSV file.
+        input_csv (str): Path to the input table (Parquet or CSV).
+        output_csv (str): Path to save the modified table.
         column_patterns (list): List of patterns to match column names (e.g., 'SOIL', 'PROP').
         specific_columns (list): List of specific column names to drop (e.g., ['PARAMETER']).
     """
     try:
-        # Load the CSV into a DataFrame
-        df = pd.read_csv(input_csv)
-        
-        # Find columns matching the patterns
+        # Find columns matching the patterns without loading any rows
+        columns = table_columns(input_csv)
         columns_to_drop = [
-            col for col in df.columns
+            col for col in columns
             if any(col.startswith(pattern) for pattern in column_patterns)
         ]
         
         # Add the specific columns to the list
         columns_to_drop.extend(specific_columns)
         
-        # Drop the identified columns
-        df.drop(columns=columns_to_drop, inplace=True, errors='ignore')
+        # Load only the columns that are kept
+        df = read_table(input_csv, columns=[col for col in columns if col not in columns_to_drop])
         
-        # Save the modified DataFrame to a new CSV file
-        df.to_csv(output_csv, index=False)
+        # Save the modified DataFrame to a new table
+        write_table(df, output_csv)
         print(f"Columns {columns_to_drop} dropped and saved to {output_csv}")
     except Exception as e:
         print(f"Error: {e}")
 
-# Example usage
-input_csv = '../output/resolved_sotwis_nasa.csv'
-output_csv = '../output/FINAL_SOTWIS_NASA.csv'
-column_patterns = ['SOIL', 'PROP']  # Pattern prefixes for column names
-specific_columns = ['PARAMETER']    # Explicit column name to drop
+if __name__ == "__main__":
+    with tracing('merged_processing'):
+        # Example usage
+        merged_file = '../output/merged_sotwis_nasa.parquet'  # Input file
+        output_file = '../output/resolved_sotwis_nasa.parquet'  # Output file
+
+        merge_duplicates_parallel(merged_file, output_file)
+
+        input_csv = '../output/resolved_sotwis_nasa.parquet'
+        output_csv = '../output/FINAL_SOTWIS_NASA.parquet'
+        column_patterns = ['SOIL', 'PROP']  # Pattern prefixes for column names
+        specific_columns = ['PARAMETER']    # Explicit column name to drop
 
-drop_pattern_columns(input_csv, output_csv, column_patterns, specific_columns)
+        drop_pattern_columns(input_csv, output_csv, column_patterns, specific_columns)
 
+        # Optional CSV export for the visualization notebook
+        export_csv(output_csv, '../output/FINAL_SOTWIS_NASA.csv')
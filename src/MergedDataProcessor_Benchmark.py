@@ -0,0 +1,67 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from DataStore import read_table
+from MergedDataProcessor import GROUP_KEYS, resolve_conflicts_fast, resolve_conflicts_vectorized
+
+def resolve_groupwise(df, n_jobs=-1):
+    """
+    Reference implementation: resolve_conflicts_fast on every group
+    """
+    grouped = df.groupby(GROUP_KEYS)
+    resolved_groups = Parallel(n_jobs=n_jobs)(
+        delayed(resolve_conflicts_fast)(group) for _, group in grouped
+    )
+    return pd.concat(resolved_groups, ignore_index=True)
+
+def sample_groups(df, max_groups, seed=42):
+    """
+    Keep all rows of at most max_groups randomly chosen (LAT, LON, YEAR) groups
+    """
+    group_ids = df.groupby(GROUP_KEYS).ngroup().to_numpy()
+    n_groups = group_ids.max() + 1
+    if max_groups is None or n_groups <= max_groups:
+        return df
+    chosen = np.random.default_rng(seed).choice(n_groups, size=max_groups, replace=False)
+    return df[np.isin(group_ids, chosen)]
+
+def same_values(expected, actual):
+    """
+    Compare two resolved tables value by value, ignoring dtypes
+    """
+    if list(expected.columns) != list(actual.columns) or len(expected) != len(actual):
+        return False
+    return expected.reset_index(drop=True).astype(object).equals(
+        actual.reset_index(drop=True).astype(object)
+    )
+
+def run_benchmark(input_file, max_groups=None, n_jobs=-1):
+    """
+    Time the group-coalesce engine against the group-by-group resolution on
+    the merged SOTWIS/NASA table and check that both give the same rows.
+    """
+    df = sample_groups(read_table(input_file), max_groups)
+    n_groups = df.groupby(GROUP_KEYS).ngroups
+    print(f"Benchmarking {len(df)} rows in {n_groups} groups")
+
+    start = time.perf_counter()
+    expected = resolve_groupwise(df, n_jobs=n_jobs)
+    reference_time = time.perf_counter() - start
+    print(f"resolve_conflicts_fast per group: {reference_time:.2f}s")
+
+    start = time.perf_counter()
+    actual = resolve_conflicts_vectorized(df, n_jobs=n_jobs)
+    vectorized_time = time.perf_counter() - start
+    print(f"resolve_conflicts_vectorized:     {vectorized_time:.2f}s")
+
+    print(f"Speed-up: {reference_time / max(vectorized_time, 1e-9):.1f}x")
+    print(f"Identical output: {same_values(expected, actual)}")
+    return reference_time, vectorized_time
+
+if __name__ == "__main__":
+    merged_file = '../output/merged_sotwis_nasa.parquet'
+    max_groups = int(sys.argv[1]) if len(sys.argv) > 1 else None
+
+    run_benchmark(merged_file, max_groups)
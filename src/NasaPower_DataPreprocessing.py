@@ -1,35 +1,272 @@
 import os
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+from joblib import Parallel, delayed
+from DataStore import TableWriter, iter_partitions, read_table
+from Profiling import profiled, record_read, path_size, tracing
 
-# Define the input and output directories
-input_dir = "../data/NasaPower"
-output_file = "../output/merged_nasa_power.csv"
+HEADER_END_MARKER = "-END HEADER-"
 
-# Initialize an empty DataFrame to store merged data
-merged_df = pd.DataFrame()
+MONTH_COLUMNS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+                 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
 
-# Loop through all CSV files in the input directory
-for file in os.listdir(input_dir):
-    if file.endswith(".csv"):
-        file_path = os.path.join(input_dir, file)
+# Explicit dtypes so pandas never has to infer them file by file
+NASA_DTYPES = {
+    'PARAMETER': 'category',
+    'YEAR': 'int16',
+    'LAT': 'float32',
+    'LON': 'float32',
+    **{month: 'float32' for month in MONTH_COLUMNS},
+    'ANN': 'float32',
+}
 
-        try:
-            # Read the CSV file, skipping the header lines (assumed to be the first 9 rows)
-            temp_df = pd.read_csv(file_path, skiprows=9)
+# Columns that identify a single NASA POWER record
+DEDUP_KEYS = ['PARAMETER', 'YEAR', 'LAT', 'LON']
 
-            # Append the data to the merged DataFrame
-            merged_df = pd.concat([merged_df, temp_df], ignore_index=True)
-        except pd.errors.ParserError as e:
-            print(f"Error reading {file_path}: {e}")
-        except Exception as e:
-            print(f"Unexpected error with {file_path}: {e}")
+# The parameter whose values keep the plain JAN..DEC and ANN column names in the
+# wide table (the predictor target); every other parameter P gets P_JAN..P_ANN
+PRIMARY_PARAMETER = 'GWETTOP'
 
-# Drop duplicate rows based on all columns
-merged_df = merged_df.drop_duplicates()
+def find_header_end(file_path, marker=HEADER_END_MARKER):
+    """
+    Return the number of lines up to and including the header end marker,
+    or 0 if the file has no NASA POWER header block.
+    """
+    with open(file_path, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            if line.strip() == marker:
+                return line_number
+            if line_number == 1 and not line.startswith('-BEGIN HEADER-'):
+                return 0
+    return 0
 
-# Save the merged DataFrame to the output file
-os.makedirs(os.path.dirname(output_file), exist_ok=True)
-merged_df.to_csv(output_file, index=False)
+def read_power_file(file_path):
+    """
+    Read a single NASA POWER regional CSV with explicit dtypes
+    """
+    try:
+        skiprows = find_header_end(file_path)
+        return pd.read_csv(file_path, skiprows=skiprows, dtype=NASA_DTYPES)
+    except pd.errors.ParserError as e:
+        print(f"Error reading {file_path}: {e}")
+    except Exception as e:
+        print(f"Unexpected error with {file_path}: {e}")
+    return None
 
-print(f"Merged CSV saved to {output_file}")
+def list_power_files(input_dir):
+    """
+    List the CSV files of a NASA POWER download directory in a stable order
+    """
+    return sorted(
+        os.path.join(input_dir, file)
+        for file in os.listdir(input_dir)
+        if file.endswith(".csv")
+    )
 
+class StreamingDeduplicator:
+    """
+    Hash-based duplicate filter that only keeps the 64-bit hashes of the
+    key columns seen so far, never the rows themselves.
+
+    The hashes are kept in sorted runs, one per chunk, and two runs are only
+    merged once the older one is no longer than the newer one (like a binary
+    counter). There are at most log2(n) runs and every hash is re-sorted at
+    most log2(n) times, so a chunk costs O(chunk log n) amortized instead of
+    re-sorting the whole history.
+    """
+    def __init__(self, keys=DEDUP_KEYS):
+        self.keys = list(keys)
+        self.runs = []
+
+    def seen(self, hashes):
+        """
+        Which of the hashes were emitted before
+        """
+        seen = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            positions = np.searchsorted(run, hashes)
+            positions[positions == len(run)] = 0
+            seen |= run[positions] == hashes
+        return seen
+
+    def _add(self, hashes):
+        if len(hashes):
+            self.runs.append(np.sort(hashes))
+        while len(self.runs) > 1 and len(self.runs[-2]) <= len(self.runs[-1]):
+            newer = self.runs.pop()
+            self.runs[-1] = np.sort(np.concatenate([self.runs[-1], newer]))
+
+    @profiled()
+    def filter(self, df):
+        hashes = pd.util.hash_pandas_object(df[self.keys], index=False).to_numpy()
+
+        # Drop duplicates inside the chunk, then the ones already emitted
+        keep = ~pd.Series(hashes).duplicated().to_numpy()
+        keep &= ~self.seen(hashes)
+
+        self._add(hashes[keep])
+        return df[keep]
+
+@profiled()
+def ingest_nasa_power(input_dir, output_file, n_jobs=-1):
+    """
+    Merge every NASA POWER CSV of input_dir into output_file (Parquet, or CSV
+    if the path ends in .csv).
+
+    Files are parsed in parallel and streamed to the output one at a time,
+    so peak memory is roughly one file plus the deduplication index.
+
+    Parameters:
+        input_dir (str): Directory containing POWER_Regional_Monthly_*.csv files.
+        output_file (str): Path of the merged table.
+        n_jobs (int): Number of parallel parser processes (joblib convention).
+
+    Returns:
+        int: Number of rows written.
+    """
+    files = list_power_files(input_dir)
+    deduplicator = StreamingDeduplicator()
+    record_read(nbytes=sum(path_size(file_path) for file_path in files))
+
+    frames = Parallel(n_jobs=n_jobs, return_as='generator')(
+        delayed(read_power_file)(file_path) for file_path in files
+    )
+    with TableWriter(output_file) as writer:
+        for temp_df in frames:
+            if temp_df is None:
+                continue
+            record_read(rows=len(temp_df), nbytes=0)
+            writer.write(deduplicator.filter(temp_df))
+
+    return writer.rows_written
+
+def parameter_columns(parameter, columns=MONTH_COLUMNS):
+    """
+    Names of the columns holding the given values of a parameter in the wide table
+    """
+    if parameter == PRIMARY_PARAMETER:
+        return list(columns)
+    return [f"{parameter}_{col}" for col in columns]
+
+def table_parameters(df):
+    """
+    The parameters present in a long NASA POWER table, the primary one first
+    """
+    present = sorted(set(df['PARAMETER'].dropna().astype(str)))
+    return sorted(present, key=lambda parameter: parameter != PRIMARY_PARAMETER)
+
+@profiled()
+def monthly_tensor(df, parameters=None):
+    """
+    Pivot long NASA POWER rows (one per parameter, year and cell) into dense
+    float32 arrays, without any join or groupby: every row is scattered into
+    its (cell, year, parameter) slot in one fancy-indexing assignment.
+
+    Parameters:
+        df (DataFrame): Rows with PARAMETER, YEAR, LAT, LON, JAN..DEC and ANN.
+        parameters (list): Parameters to keep, in order. Defaults to all
+            present, the primary one first.
+
+    Returns:
+        tuple: (cells, years, parameters, monthly, annual) where cells is the
+        (n_cells, 2) array of LAT/LON sorted by LAT then LON, years covers
+        every year from the first to the last, monthly has the shape
+        (cell, year, month, parameter) and annual (cell, year, parameter).
+        Missing values are NaN.
+    """
+    if parameters is None:
+        parameters = table_parameters(df)
+    parameter_codes = pd.Categorical(df['PARAMETER'].astype(object), categories=parameters).codes
+    df = df[parameter_codes >= 0]
+    parameter_codes = parameter_codes[parameter_codes >= 0]
+
+    # Cells are numbered by their position on the LAT x LON grid of the table
+    lat_codes, lats = pd.factorize(df['LAT'].to_numpy(dtype=np.float32), sort=True)
+    lon_codes, lons = pd.factorize(df['LON'].to_numpy(dtype=np.float32), sort=True)
+    grid_cells, cell_codes = np.unique(lat_codes.astype(np.int64) * len(lons) + lon_codes, return_inverse=True)
+    cells = np.column_stack([lats[grid_cells // len(lons)], lons[grid_cells % len(lons)]]).astype(np.float32)
+
+    year_values = df['YEAR'].to_numpy(dtype=np.int64)
+    first_year = year_values.min() if len(year_values) else 0
+    years = np.arange(first_year, year_values.max() + 1 if len(year_values) else 0, dtype=np.int16)
+    year_codes = year_values - first_year
+
+    monthly = np.full((len(cells), len(years), len(MONTH_COLUMNS), len(parameters)), np.nan, dtype=np.float32)
+    annual = np.full((len(cells), len(years), len(parameters)), np.nan, dtype=np.float32)
+    monthly[cell_codes, year_codes, :, parameter_codes] = df[MONTH_COLUMNS].to_numpy(dtype=np.float32)
+    if 'ANN' in df.columns:
+        annual[cell_codes, year_codes, parameter_codes] = df['ANN'].to_numpy(dtype=np.float32)
+    return cells, years, list(parameters), monthly, annual
+
+def wide_table(cells, years, parameters, monthly, annual=None):
+    """
+    The arrays of monthly_tensor as one row per cell and year, with the
+    columns of every parameter side by side (see parameter_columns). Without
+    annual values there are no ANN columns. Cell years without any value are
+    left out.
+    """
+    n_rows = len(cells) * len(years)
+    blocks = [monthly.transpose(0, 1, 3, 2).reshape(n_rows, len(parameters), len(MONTH_COLUMNS))]
+    value_columns = list(MONTH_COLUMNS)
+    if annual is not None:
+        blocks.append(annual.reshape(n_rows, len(parameters), 1))
+        value_columns.append('ANN')
+    values = np.concatenate(blocks, axis=2).reshape(n_rows, -1)
+    columns = [
+        col for parameter in parameters for col in parameter_columns(parameter, value_columns)
+    ]
+    df = pd.DataFrame(values, columns=columns)
+    df.insert(0, 'LAT', np.repeat(cells[:, 0], len(years)))
+    df.insert(1, 'LON', np.repeat(cells[:, 1], len(years)))
+    df.insert(2, 'YEAR', np.tile(years, len(cells)))
+    return df[~np.isnan(values).all(axis=1)].reset_index(drop=True)
+
+@profiled()
+def pivot_nasa_power(input_file, output_file, parameters=None, features_file=None):
+    """
+    Turn the long table written by ingest_nasa_power (one row per parameter)
+    into the wide table joined with SOTWIS (one row per cell and year), one
+    YEAR partition at a time.
+
+    Parameters:
+        input_file (str): Long NASA POWER table.
+        output_file (str): Path of the wide table.
+        parameters (list): Parameters to keep. Defaults to all present, the
+            primary one first.
+        features_file (str): Optional table of per cell and year features
+            (e.g. from DroughtIndices.compute_drought_features), joined on
+            LAT, LON and YEAR.
+
+    Returns:
+        int: Number of rows written.
+    """
+    if parameters is None:
+        parameters = table_parameters(read_table(input_file, columns=['PARAMETER']))
+    with TableWriter(output_file) as writer:
+        for df in iter_partitions(input_file):
+            wide = wide_table(*monthly_tensor(df, parameters))
+            if features_file is not None and len(wide):
+                features = read_table(features_file, filter=ds.field('YEAR') == int(wide['YEAR'].iloc[0]))
+                wide = wide.merge(features, on=['LAT', 'LON', 'YEAR'], how='left')
+            writer.write(wide)
+    print(f"Pivoted {len(parameters)} NASA POWER parameters {parameters} into {output_file}")
+    return writer.rows_written
+
+def read_monthly_tensor(path, parameters=None):
+    """
+    Load a long NASA POWER table as the arrays of monthly_tensor
+    """
+    return monthly_tensor(read_table(path), parameters)
+
+if __name__ == "__main__":
+    with tracing('nasa_ingest'):
+        # Define the input and output directories
+        input_dir = "../data/NasaPower"
+        output_file = "../output/merged_nasa_power.parquet"
+
+        rows = ingest_nasa_power(input_dir, output_file)
+        print(f"Merged NASA POWER data saved to {output_file} ({rows} rows)")
+
+        # One row per cell and year with the columns of every parameter
+        pivot_nasa_power(output_file, "../output/nasa_power_wide.parquet")
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from NasaPower_DataPreprocessing import ingest_nasa_power, pivot_nasa_power
+from DroughtIndices import compute_drought_features
+from SOTWIS_DataCollection import collect_sotwis_data, get_project_root
+from SOTWIS_DataPreprocessing import sotwis_pipeline
+from DataMerger import merge_datasets_efficiently
+from MergedDataProcessor import merge_duplicates_parallel, drop_pattern_columns
+from SyntheticDataGenerator import process_and_save_data
+from DataStore import export_csv
+from Profiling import span, tracing
+
+STATE_FILE = 'pipeline_state.json'
+
+class DigestCache:
+    """
+    Content digests of files and directories, recomputed only for files whose
+    size or modification time changed since the last run. Safe to use from
+    several threads.
+    """
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """
+        A copy of the entries that can be serialized while other threads keep hashing
+        """
+        with self._lock:
+            return dict(self.entries)
+
+    def _file_digest(self, path):
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        with self._lock:
+            cached = self.entries.get(path)
+        if cached and cached['signature'] == signature:
+            return cached['digest']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        with self._lock:
+            self.entries[path] = {'signature': signature, 'digest': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def digest(self, path):
+        """
+        Digest of a file, or of every file below a directory; None if path does not exist
+        """
+        path = os.path.abspath(str(path))
+        if os.path.isfile(path):
+            return self._file_digest(path)
+        if not os.path.isdir(path):
+            return None
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).encode())
+                digest.update(self._file_digest(file_path).encode())
+        return digest.hexdigest()
+
+class Stage:
+    """
+    One pipeline step: func is called as func(**inputs, **outputs, **params),
+    where inputs and outputs map argument names to paths. watches lists paths
+    the function reads on its own, hashed like inputs but not passed to it.
+    """
+    def __init__(self, name, func, inputs=None, outputs=None, params=None, watches=()):
+        self.name = name
+        self.func = func
+        self.inputs = inputs or {}
+        self.outputs = outputs or {}
+        self.params = params or {}
+        self.watches = list(watches)
+
+    def key(self, input_digests):
+        """
+        Hash of everything that determines the outputs: the function, its parameters and its inputs
+        """
+        description = {
+            'func': f"{self.func.__module__}.{self.func.__qualname__}",
+            'params': self.params,
+            'inputs': input_digests,
+            'outputs': {name: str(path) for name, path in self.outputs.items()}
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def run(self):
+        with span(self.name):
+            self.func(**self.inputs, **self.outputs, **self.params)
+
+class Pipeline:
+    """
+    DAG of stages with content-hash caching.
+
+    A stage depends on the stages producing its input paths. A stage is
+    skipped when the digests of its inputs, its parameters and the digests of
+    its outputs are the same as after its last run, so a stage whose upstream
+    re-ran but produced identical files is skipped too. Independent stages run
+    concurrently, each stage keeps using its own process pool.
+    """
+    def __init__(self, stages, state_dir, max_workers=2):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_file = os.path.join(str(state_dir), STATE_FILE)
+        self.max_workers = max_workers
+        state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                state = json.load(f)
+        self.records = state.get('stages', {})
+        self.digests = DigestCache(state.get('digests'))
+        # Guards records, which stages running in other threads update
+        self._lock = threading.Lock()
+
+        producers = {
+            os.path.abspath(str(path)): stage.name
+            for stage in stages for path in stage.outputs.values()
+        }
+        self.dependencies = {
+            stage.name: {
+                producers[os.path.abspath(str(path))] for path in stage.inputs.values()
+                if os.path.abspath(str(path)) in producers
+            }
+            for stage in stages
+        }
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        with self._lock:
+            records = dict(self.records)
+        state = {'stages': records, 'digests': self.digests.snapshot()}
+        with open(self.state_file, 'w') as f:
+            json.dump(state, f, indent=1)
+
+    def _output_digests(self, stage):
+        return {name: self.digests.digest(path) for name, path in stage.outputs.items()}
+
+    def _execute(self, stage, force):
+        """
+        Run a stage unless it is up to date; returns True if it ran
+        """
+        input_digests = {name: self.digests.digest(path) for name, path in stage.inputs.items()}
+        input_digests.update({str(path): self.digests.digest(path) for path in stage.watches})
+        key = stage.key(input_digests)
+        with self._lock:
+            record = self.records.get(stage.name)
+        if not force and record and record['key'] == key and record['outputs'] == self._output_digests(stage):
+            print(f"[{stage.name}] up to date, skipped")
+            return False
+
+        print(f"[{stage.name}] running")
+        start = time.perf_counter()
+        stage.run()
+        seconds = time.perf_counter() - start
+        outputs = self._output_digests(stage)
+        with self._lock:
+            self.records[stage.name] = {'key': key, 'outputs': outputs, 'seconds': seconds}
+        print(f"[{stage.name}] done in {seconds:.1f}s")
+        return True
+
+    def run(self, force=()):
+        """
+        Run every stage that is out of date, independent ones concurrently.
+        Stages named in force are re-run regardless of the cache.
+
+        Returns:
+            dict: Stage name -> True if it ran, False if it was skipped.
+        """
+        done = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(done) < len(self.stages):
+                for name, stage in self.stages.items():
+                    if name in done or name in running.values():
+                        continue
+                    if self.dependencies[name] <= set(done):
+                        future = executor.submit(self._execute, stage, name in force)
+                        running[future] = name
+                if not running:
+                    raise ValueError(f"Cyclic stage dependencies: {sorted(set(self.stages) - set(done))}")
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        done[name] = future.result()
+                    finally:
+                        self.save_state()
+        return done
+
+def preprocess_sotwis(input_path, output_path):
+    sotwis_pipeline().run(input_path, output_path)
+
+def default_pipeline(data_dir='../data', output_dir='../output', eps=0.5, min_samples=5, per_cell=True,
+                     max_workers=2):
+    """
+    The full NASA POWER / SOTWIS pipeline, from the raw downloads to the
+    augmented table used by the predictor. per_cell selects the grid-cell
+    imputation (distinct cells clustered once) over the per-row one.
+    """
+    def out(name):
+        return os.path.join(output_dir, name)
+
+    stages = [
+        # NASA branch
+        Stage('nasa_ingest', ingest_nasa_power,
+              inputs={'input_dir': os.path.join(data_dir, 'NasaPower')},
+              outputs={'output_file': out('merged_nasa_power.parquet')}),
+        Stage('drought_indices', compute_drought_features,
+              inputs={'input_file': out('merged_nasa_power.parquet')},
+              outputs={'output_file': out('drought_features.parquet')},
+              params={'cache_dir': out('feature_cache')}),
+        Stage('nasa_pivot', pivot_nasa_power,
+              inputs={'input_file': out('merged_nasa_power.parquet'),
+                      'features_file': out('drought_features.parquet')},
+              outputs={'output_file': out('nasa_power_wide.parquet')}),
+
+        # SOTWIS branch
+        Stage('sotwis_collect', collect_sotwis_data,
+              outputs={'output_file': out('sotwis_combined_data.parquet'),
+                       'polygons_dir': out('sotwis_polygons')},
+              watches=[get_project_root() / 'data' / 'SOTWIS_SOVEUR_ver1.0']),
+        Stage('sotwis_preprocess', preprocess_sotwis,
+              inputs={'input_path': out('sotwis_combined_data.parquet')},
+              outputs={'output_path': out('sotwis_processed.parquet')}),
+
+        # Joined stages
+        Stage('merge', merge_datasets_efficiently,
+              inputs={'nasa_file': out('nasa_power_wide.parquet'),
+                      'sotwis_file': out('sotwis_processed.parquet'),
+                      'polygon_store': out('sotwis_polygons')},
+              outputs={'output_file': out('merged_sotwis_nasa.parquet')},
+              params={'cache_dir': out('join_cache')}),
+        Stage('resolve_duplicates', merge_duplicates_parallel,
+              inputs={'input_file': out('merged_sotwis_nasa.parquet')},
+              outputs={'output_file': out('resolved_sotwis_nasa.parquet')}),
+        Stage('drop_columns', drop_pattern_columns,
+              inputs={'input_csv': out('resolved_sotwis_nasa.parquet')},
+              outputs={'output_csv': out('FINAL_SOTWIS_NASA.parquet')},
+              params={'column_patterns': ['SOIL', 'PROP'], 'specific_columns': ['PARAMETER']}),
+        Stage('impute', process_and_save_data,
+              inputs={'input_file': out('FINAL_SOTWIS_NASA.parquet')},
+              outputs={'output_file': out('AUGUMENTED_SOTWIS_NASA.parquet')},
+              params={'eps': eps, 'min_samples': min_samples, 'per_cell': per_cell}),
+
+        # CSV copies read by the notebooks
+        Stage('export_final_csv', export_csv,
+              inputs={'path': out('FINAL_SOTWIS_NASA.parquet')},
+              outputs={'csv_path': out('FINAL_SOTWIS_NASA.csv')}),
+        Stage('export_augmented_csv', export_csv,
+              inputs={'path': out('AUGUMENTED_SOTWIS_NASA.parquet')},
+              outputs={'csv_path': out('AUGUMENTED_SOTWIS_NASA.csv')}),
+    ]
+    return Pipeline(stages, output_dir, max_workers=max_workers)
+
+if __name__ == "__main__":
+    with tracing('pipeline'):
+        # Stage names given on the command line are re-run even if up to date
+        default_pipeline().run(force=sys.argv[1:])
@@ -0,0 +1,297 @@
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from DataStore import iter_batches, write_table
+from NasaPower_DataPreprocessing import MONTH_COLUMNS, ingest_nasa_power, pivot_nasa_power
+from DroughtIndices import compute_drought_features
+from SOTWIS_DataPreprocessing import sotwis_pipeline, numeric_columns, drain_mapping
+from DataMerger import merge_datasets_efficiently
+from MergedDataProcessor import merge_duplicates_parallel, drop_pattern_columns
+from SyntheticDataGenerator import process_and_save_data
+from PolygonStore import POLYGON_ID_COLUMN
+from Profiling import git_commit, load_trace, span, tracing
+
+# Native NASA POWER MERRA-2 grid spacing (LAT, LON) in degrees
+NATIVE_SPACING = (0.5, 0.625)
+
+# Cells per tile, as in the regional POWER downloads
+CELLS_PER_FILE = 320
+
+POWER_HEADER = """-BEGIN HEADER-
+NASA/POWER Source Native Resolution Monthly and Annual
+Synthetic benchmark workload
+Parameter(s):
+{parameters}
+-END HEADER-
+"""
+
+# Pipeline stages in the order they run; each reads the previous stage's output
+STAGES = ['nasa_ingest', 'drought_indices', 'nasa_pivot', 'sotwis_preprocess', 'merge', 'resolve_duplicates', 'drop_columns',
+          'impute', 'train', 'predict']
+
+class Workload:
+    """
+    Shape of a synthetic NASA POWER / SOTWIS workload.
+
+    At scale 1 the grid has base_cells = (rows, columns) cells spaced
+    NATIVE_SPACING / density apart; scale multiplies the number of cells
+    (and SOTWIS boxes) by growing the region, so neighbourhood sizes stay
+    those of the real data.
+
+    Parameters:
+        base_cells (tuple): Grid rows and columns at scale 1.
+        years (int): Number of years of monthly values per cell.
+        density (float): Grid cells per native cell along each axis.
+        boxes_per_cell (float): SOTWIS bounding boxes per grid cell.
+        duplicate_rate (float): Fraction of NASA rows repeated in a second
+            tile and of SOTWIS boxes repeated with conflicting attributes.
+        nan_rate (float): Fraction of missing monthly and soil values.
+        parameters (tuple): NASA POWER parameters written for every cell and year.
+        seed (int): Random seed.
+    """
+    def __init__(self, base_cells=(20, 20), years=5, density=1.0, boxes_per_cell=0.5,
+                 duplicate_rate=0.05, nan_rate=0.1, parameters=('GWETTOP',), seed=42):
+        self.base_cells = base_cells
+        self.years = years
+        self.density = density
+        self.boxes_per_cell = boxes_per_cell
+        self.duplicate_rate = duplicate_rate
+        self.nan_rate = nan_rate
+        self.parameters = list(parameters)
+        self.seed = seed
+
+    def params(self):
+        return dict(vars(self))
+
+    def spacing(self):
+        return NATIVE_SPACING[0] / self.density, NATIVE_SPACING[1] / self.density
+
+    def grid(self, scale):
+        """
+        LAT and LON of every cell of the grid at the given scale
+        """
+        factor = np.sqrt(scale)
+        n_lat, n_lon = (max(1, int(round(n * factor))) for n in self.base_cells)
+        lat_step, lon_step = self.spacing()
+        lats, lons = np.meshgrid(-45.0 + lat_step * np.arange(n_lat), -60.0 + lon_step * np.arange(n_lon),
+                                 indexing='ij')
+        return lats.ravel(), lons.ravel()
+
+def write_power_files(workload, scale, output_dir):
+    """
+    Write NASA POWER regional monthly CSVs (header block included) for the
+    workload grid, CELLS_PER_FILE cells per file
+
+    Returns:
+        int: Number of data rows written, duplicates included.
+    """
+    rng = np.random.default_rng(workload.seed)
+    lats, lons = workload.grid(scale)
+    years = np.arange(2022 - workload.years + 1, 2023)
+    n_cells = len(lats)
+
+    # Every parameter is seasonal, with a per-cell level and yearly noise
+    season = 0.15 * np.cos(2 * np.pi * np.arange(12) / 12)
+    frames = []
+    for parameter in workload.parameters:
+        level = rng.uniform(0.2, 0.9, n_cells)
+        values = np.clip(
+            level[:, None, None] + season[None, None, :]
+            + rng.normal(0, 0.05, (n_cells, len(years), 12)), 0, 1
+        ).round(2)
+        values[rng.random(values.shape) < workload.nan_rate] = np.nan
+
+        frame = pd.DataFrame(values.reshape(-1, 12), columns=MONTH_COLUMNS)
+        frame.insert(0, 'PARAMETER', parameter)
+        frame.insert(1, 'YEAR', np.tile(years, n_cells))
+        frame.insert(2, 'LAT', np.repeat(lats, len(years)))
+        frame.insert(3, 'LON', np.repeat(lons, len(years)))
+        frame['ANN'] = np.nanmean(values, axis=2).reshape(-1).round(2)
+        frames.append(frame)
+    df = pd.concat(frames, ignore_index=True)
+    tiles = np.tile(np.repeat(np.arange(n_cells) // CELLS_PER_FILE, len(years)), len(workload.parameters))
+
+    # Overlapping downloads repeat some rows in the next tile
+    duplicated = rng.random(len(df)) < workload.duplicate_rate
+    df = pd.concat([df, df[duplicated]], ignore_index=True)
+    tiles = np.concatenate([tiles, tiles[duplicated] + 1])
+
+    os.makedirs(output_dir, exist_ok=True)
+    for tile, tile_df in df.groupby(tiles):
+        with open(os.path.join(output_dir, f"POWER_Regional_Monthly_synthetic ({tile}).csv"), 'w') as f:
+            f.write(POWER_HEADER.format(parameters='\n'.join(workload.parameters)))
+            tile_df.to_csv(f, index=False)
+    return len(df)
+
+def sotwis_table(workload, scale, soil_components=3, soil_codes=30):
+    """
+    A table shaped like the extracted SOTWIS data: bounding boxes, polygon ids,
+    raw soil attributes, drainage and texture classes and SOIL/PROP components
+    """
+    rng = np.random.default_rng(workload.seed + 1)
+    lats, lons = workload.grid(scale)
+    lat_step, lon_step = workload.spacing()
+    n_boxes = max(1, int(round(len(lats) * workload.boxes_per_cell)))
+
+    center_lat = rng.uniform(lats.min(), lats.max(), n_boxes)
+    center_lon = rng.uniform(lons.min(), lons.max(), n_boxes)
+    half_lat = rng.uniform(0.5, 1.5, n_boxes) * lat_step
+    half_lon = rng.uniform(0.5, 1.5, n_boxes) * lon_step
+    df = pd.DataFrame({
+        'BOTTOM_LEFT_LAT': center_lat - half_lat,
+        'BOTTOM_LEFT_LON': center_lon - half_lon,
+        'UPPER_RIGHT_LAT': center_lat + half_lat,
+        'UPPER_RIGHT_LON': center_lon + half_lon,
+        POLYGON_ID_COLUMN: [f"{i:016x}" for i in range(n_boxes)]
+    })
+    for col in numeric_columns:
+        df[col] = rng.uniform(0, 100, n_boxes).round(1)
+    classes = np.array(list(drain_mapping))
+    df['DRAIN'] = classes[rng.integers(0, len(classes), n_boxes)]
+    df['PSCL'] = classes[rng.integers(0, len(classes), n_boxes)]
+    codes = np.array([f"S{i:02d}" for i in range(soil_codes)])
+    for i in range(1, soil_components + 1):
+        df[f'SOIL{i}'] = codes[rng.integers(0, soil_codes, n_boxes)]
+        df[f'PROP{i}'] = rng.integers(0, 101, n_boxes).astype('float64')
+
+    attributes = numeric_columns + ['DRAIN', 'PSCL']
+    missing = rng.random((n_boxes, len(attributes))) < workload.nan_rate
+    df[attributes] = df[attributes].mask(missing)
+
+    # Repeated boxes whose soil values disagree with the original
+    duplicates = df[rng.random(n_boxes) < workload.duplicate_rate].copy()
+    duplicates[numeric_columns] = rng.uniform(0, 100, (len(duplicates), len(numeric_columns))).round(1)
+    return pd.concat([df, duplicates], ignore_index=True)
+
+def run_model_stages(input_file, work_dir, epochs=1, parameters=('GWETTOP',)):
+    """
+    Train DroughtPredictionSystem from memory-mapped arrays and score the table,
+    with the monthly values of every parameter (and drought feature) as temporal input
+    """
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'predictor'))
+    try:
+        from drought_prediction_system import DroughtPredictionSystem
+    except ImportError as e:
+        print(f"Skipping train/predict: {e}")
+        return
+
+    system = DroughtPredictionSystem(temporal_parameters=parameters)
+    with span('train'):
+        arrays_dir = os.path.join(work_dir, 'training_arrays')
+        system.write_training_arrays(input_file, arrays_dir)
+        system.train_from_arrays(arrays_dir, epochs=epochs, patience=epochs)
+    with span('predict'):
+        system.predict_stream(iter_batches(input_file, columns=system.feature_columns() + ['YEAR']),
+                              os.path.join(work_dir, 'predictions.parquet'))
+
+def run_stages(workload, scale, work_dir, epochs=1):
+    """
+    Generate the workload at one scale and run every pipeline stage on it
+    """
+    path = lambda name: os.path.join(work_dir, name)
+
+    rows = write_power_files(workload, scale, path('NasaPower'))
+    write_table(sotwis_table(workload, scale), path('sotwis_combined_data.parquet'))
+    print(f"Scale {scale}x: {rows} NASA POWER rows")
+
+    with span('nasa_ingest'):
+        ingest_nasa_power(path('NasaPower'), path('merged_nasa_power.parquet'))
+    with span('drought_indices'):
+        features = compute_drought_features(path('merged_nasa_power.parquet'), path('drought_features.parquet'),
+                                            parameters=workload.parameters)
+    with span('nasa_pivot'):
+        pivot_nasa_power(path('merged_nasa_power.parquet'), path('nasa_power_wide.parquet'),
+                         parameters=workload.parameters, features_file=path('drought_features.parquet'))
+    with span('sotwis_preprocess'):
+        sotwis_pipeline().run(path('sotwis_combined_data.parquet'), path('sotwis_processed.parquet'))
+    with span('merge'):
+        merge_datasets_efficiently(path('nasa_power_wide.parquet'), path('sotwis_processed.parquet'),
+                                   path('merged_sotwis_nasa.parquet'))
+    with span('resolve_duplicates'):
+        merge_duplicates_parallel(path('merged_sotwis_nasa.parquet'), path('resolved_sotwis_nasa.parquet'))
+    with span('drop_columns'):
+        drop_pattern_columns(path('resolved_sotwis_nasa.parquet'), path('FINAL_SOTWIS_NASA.parquet'),
+                             ['SOIL', 'PROP'], ['PARAMETER'])
+    with span('impute'):
+        process_and_save_data(path('FINAL_SOTWIS_NASA.parquet'), path('AUGUMENTED_SOTWIS_NASA.parquet'),
+                              eps=0.5, min_samples=5)
+    run_model_stages(path('AUGUMENTED_SOTWIS_NASA.parquet'), work_dir, epochs=epochs,
+                     parameters=workload.parameters + features)
+
+def run_benchmark(scales=(1, 10, 100), workload=None, results_dir='../output/benchmarks', epochs=1):
+    """
+    Run every stage at each scale and write the per-stage wall and CPU time,
+    peak RSS, rows and throughput to results_dir/pipeline_<commit>.json.
+
+    Everything runs offline in a temporary directory per scale. Memory is that
+    of the benchmark process; joblib worker processes are not included.
+
+    Returns:
+        DataFrame: One row per stage and scale.
+    """
+    workload = workload or Workload()
+    results = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as work_dir:
+            name = f"benchmark_{scale}x"
+            with tracing(name, trace_dir=os.path.join(results_dir, 'traces'), profile=False) as trace:
+                run_stages(workload, scale, work_dir, epochs=epochs)
+
+            spans = {entry['path']: entry for entry in load_trace(trace.trace_file)['spans']}
+            for stage in STAGES:
+                entry = spans.get(f"{name}/{stage}")
+                if entry is None:
+                    continue
+                results.append({
+                    'stage': stage,
+                    'scale': scale,
+                    'rows_in': entry['rows_in'],
+                    'rows_out': entry['rows_out'],
+                    'wall_s': entry['wall_s'],
+                    'cpu_s': entry['cpu_s'],
+                    'peak_rss_mb': entry['peak_rss_mb'],
+                    'rows_per_s': entry['rows_in'] / max(entry['wall_s'], 1e-9),
+                    'bytes_read': entry['bytes_read'],
+                    'bytes_written': entry['bytes_written']
+                })
+
+    results = pd.DataFrame(results)
+    commit = git_commit() or 'unknown'
+    os.makedirs(results_dir, exist_ok=True)
+    results_file = os.path.join(results_dir, f"pipeline_{commit}.json")
+    with open(results_file, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'workload': workload.params(),
+            'results': results.to_dict(orient='records')
+        }, f, indent=1)
+
+    print(results.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+    print(f"Results written to {results_file}")
+    return results
+
+def compare_results(old_file, new_file, metric='rows_per_s'):
+    """
+    Ratio new / old of a metric for every stage and scale of two results files
+    """
+    old, new = (
+        pd.DataFrame(load_trace(path)['results']).set_index(['stage', 'scale'])[metric]
+        for path in (old_file, new_file)
+    )
+    comparison = pd.DataFrame({'old': old, 'new': new})
+    comparison['ratio'] = comparison['new'] / comparison['old']
+    return comparison
+
+if __name__ == "__main__":
+    # Usage: python Pipeline_Benchmark.py [SCALE ...]
+    #        python Pipeline_Benchmark.py compare OLD_RESULTS.json NEW_RESULTS.json
+    if sys.argv[1:2] == ['compare']:
+        print(compare_results(sys.argv[2], sys.argv[3]).to_string(float_format=lambda value: f"{value:.3f}"))
+    else:
+        scales = [int(arg) for arg in sys.argv[1:]] or [1, 10, 100]
+        run_benchmark(scales)
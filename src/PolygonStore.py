@@ -0,0 +1,84 @@
+import os
+import joblib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from DataStore import PARQUET_COMPRESSION
+from Profiling import profiled
+
+# Column of the SOTWIS table naming the polygon a row was read from
+POLYGON_ID_COLUMN = 'POLYGON_ID'
+
+GEOMETRY_FILE = 'polygons.parquet'
+TREE_FILE = 'tree.joblib'
+
+def polygon_ids(geometries):
+    """
+    Content hash of every polygon's WKB as a hex string, so the same polygon
+    gets the same id in every layer and across runs
+    """
+    hashes = pd.util.hash_array(shapely.to_wkb(np.asarray(geometries, dtype=object)))
+    return pd.Series(hashes).map('{:016x}'.format).to_numpy(dtype=object)
+
+class PolygonStore:
+    """
+    Exact SOTWIS polygon geometries, kept as WKB in Parquet next to a prebuilt
+    STRtree over them.
+
+    Polygons are keyed by polygon_ids, which SOTWIS_DataCollection also writes
+    to the POLYGON_ID column of every shapefile row, so a polygon can be traced
+    back to all SOTWIS rows read from it. Identical polygons repeated across the
+    soil layers are stored once.
+    """
+    def __init__(self, ids, geometries, tree=None):
+        self.ids = np.asarray(ids, dtype=object)
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.tree = tree if tree is not None else shapely.STRtree(self.geometries)
+
+    @classmethod
+    def from_geometries(cls, geometries):
+        """
+        Build a store from shapely geometries, skipping missing and empty ones
+        """
+        geometries = np.asarray(geometries, dtype=object)
+        geometries = geometries[~(shapely.is_missing(geometries) | shapely.is_empty(geometries))]
+
+        ids, first = np.unique(polygon_ids(geometries), return_index=True)
+        return cls(ids, geometries[first])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, path):
+        os.makedirs(str(path), exist_ok=True)
+        table = pa.table({
+            POLYGON_ID_COLUMN: pa.array(self.ids, type=pa.string()),
+            'WKB': pa.array(shapely.to_wkb(self.geometries), type=pa.binary())
+        })
+        pq.write_table(table, os.path.join(str(path), GEOMETRY_FILE), compression=PARQUET_COMPRESSION)
+        joblib.dump(self.tree, os.path.join(str(path), TREE_FILE))
+
+    @classmethod
+    @profiled()
+    def load(cls, path):
+        table = pq.read_table(os.path.join(str(path), GEOMETRY_FILE), memory_map=True)
+        ids = table.column(POLYGON_ID_COLUMN).to_numpy(zero_copy_only=False)
+        geometries = shapely.from_wkb(table.column('WKB').to_numpy(zero_copy_only=False))
+
+        tree = None
+        tree_file = os.path.join(str(path), TREE_FILE)
+        if os.path.exists(tree_file):
+            tree = joblib.load(tree_file)
+        return cls(ids, geometries, tree)
+
+    @profiled()
+    def query_points(self, lats, lons):
+        """
+        Return (point position, polygon id) pairs for every point lying strictly
+        within a stored polygon
+        """
+        points = shapely.points(np.asarray(lons, dtype='float64'), np.asarray(lats, dtype='float64'))
+        point_idx, polygon_idx = self.tree.query(points, predicate='within')
+        return point_idx, self.ids[polygon_idx]
@@ -0,0 +1,352 @@
+import cProfile
+import functools
+import json
+import os
+import platform
+import pstats
+import resource
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+# Setting this environment variable makes every tracing() session write its
+# trace there, and PIPELINE_PROFILE=1 adds a cProfile dump next to it
+TRACE_DIR_VARIABLE = 'PIPELINE_TRACE_DIR'
+PROFILE_VARIABLE = 'PIPELINE_PROFILE'
+
+# Counters accumulated by every span, summed into its enclosing spans
+COUNTERS = ['rows_in', 'rows_out', 'bytes_read', 'bytes_written']
+
+def current_rss_mb():
+    """
+    Resident memory of the current process in MB (peak memory where /proc is unavailable)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def io_bytes():
+    """
+    Bytes read and written by the process so far through system calls (Linux), or (0, 0)
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def path_size(path):
+    """
+    Size in bytes of a file, or of every file below a directory
+    """
+    path = str(path)
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+class Span:
+    """
+    One timed execution of a stage or sub-step. Counters are filled in by
+    record_read / record_write or directly through add().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.peak_rss_mb = current_rss_mb()
+        self._io = io_bytes()
+        self._cpu = time.process_time()
+        self._start = time.perf_counter()
+
+    def add(self, **counters):
+        for name, value in counters.items():
+            self.counters[name] += int(value)
+
+    def finish(self):
+        io_read, io_written = io_bytes()
+        return {
+            'wall_s': time.perf_counter() - self._start,
+            'cpu_s': time.process_time() - self._cpu,
+            'peak_rss_mb': max(self.peak_rss_mb, current_rss_mb()),
+            'io_read_bytes': io_read - self._io[0],
+            'io_write_bytes': io_written - self._io[1],
+            **self.counters
+        }
+
+class TraceSession:
+    """
+    Collects the spans of one run, aggregated per span path
+    ('stage/sub-step'), while a background thread samples the resident memory
+    of the process into the peak of every open span.
+    """
+    def __init__(self, name, profile=False, sample_interval=0.05):
+        self.name = name
+        self.profile = profile
+        self.sample_interval = sample_interval
+        self.thread = threading.current_thread()
+        self.stats = {}
+        self.open_spans = set()
+        self.profiles = []
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            rss = current_rss_mb()
+            with self._lock:
+                for span in self.open_spans:
+                    span.peak_rss_mb = max(span.peak_rss_mb, rss)
+
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def open(self, name):
+        stack = self.stack()
+        span = Span(f"{stack[-1].path}/{name}" if stack else name)
+        stack.append(span)
+        with self._lock:
+            self.open_spans.add(span)
+        return span
+
+    def close(self, span):
+        stack = self.stack()
+        stack.pop()
+        result = span.finish()
+        with self._lock:
+            self.open_spans.discard(span)
+            stats = self.stats.setdefault(span.path, {'calls': 0, **dict.fromkeys(result, 0)})
+            stats['calls'] += 1
+            for name, value in result.items():
+                stats[name] = max(stats[name], value) if name == 'peak_rss_mb' else stats[name] + value
+        if stack:
+            stack[-1].add(**span.counters)
+
+    def stop(self):
+        """
+        Stop sampling the resident memory
+        """
+        self._stop.set()
+        if self._sampler is not threading.current_thread():
+            self._sampler.join()
+
+    def summary(self):
+        self.stop()
+        return {
+            'name': self.name,
+            'started': self.started.isoformat(timespec='seconds'),
+            'wall_s': time.perf_counter() - self._start,
+            'peak_rss_mb': current_rss_mb() if not self.stats else
+            max(current_rss_mb(), *(stats['peak_rss_mb'] for stats in self.stats.values())),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'argv': sys.argv,
+            'spans': [{'path': path, **stats} for path, stats in self.stats.items()]
+        }
+
+# The active session, None when tracing is off (spans then cost a single check)
+_session = None
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+class span:
+    """
+    Context manager timing a stage or sub-step:
+
+        with span('box_join') as s:
+            ...
+            s.add(rows_out=len(merged_df))
+
+    Spans opened inside another span of the same thread are recorded as
+    sub-steps ('merge/box_join'). Outside a tracing() session this does nothing.
+    A root span opened in a thread other than the one that started tracing
+    (e.g. a Pipeline stage) is profiled separately when cProfile is on.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._span = None
+        self._profile = None
+
+    def __enter__(self):
+        session = _session
+        if session is None:
+            return self
+        self._span = session.open(self.name)
+        if (session.profile and len(session.stack()) == 1
+                and threading.current_thread() is not session.thread):
+            self._profile = cProfile.Profile()
+            try:
+                self._profile.enable()
+            except ValueError:  # Only one profiler may be active (Python 3.12+)
+                self._profile = None
+        return self
+
+    def add(self, **counters):
+        if self._span is not None:
+            self._span.add(**counters)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        session = _session
+        if self._span is None or session is None:
+            return
+        if self._profile is not None:
+            self._profile.disable()
+            session.profiles.append(self._profile)
+        session.close(self._span)
+        self._span = None
+
+def profiled(name=None):
+    """
+    Decorator recording every call of a function as a span named after it
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _session is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _current_span():
+    session = _session
+    if session is None:
+        return None
+    stack = session.stack()
+    return stack[-1] if stack else None
+
+def record_read(path=None, rows=0, nbytes=None):
+    """
+    Count rows (and the size of path, unless nbytes is given) as read by the current span
+    """
+    current = _current_span()
+    if current is not None:
+        if nbytes is None:
+            nbytes = path_size(path) if path is not None and os.path.exists(str(path)) else 0
+        current.add(rows_in=rows, bytes_read=nbytes)
+
+def record_write(path=None, rows=0, nbytes=None):
+    """
+    Count rows (and the size of path, unless nbytes is given) as written by the current span
+    """
+    current = _current_span()
+    if current is not None:
+        if nbytes is None:
+            nbytes = path_size(path) if path is not None and os.path.exists(str(path)) else 0
+        current.add(rows_out=rows, bytes_written=nbytes)
+
+class tracing:
+    """
+    Record the spans of a run and write them as a JSON trace.
+
+    Parameters:
+        name (str): Run name, used for the trace file name.
+        trace_dir (str): Directory of the trace. Defaults to $PIPELINE_TRACE_DIR;
+            if neither is set, nothing is recorded.
+        profile (bool): Also write a cProfile dump (<trace>.prof, readable by
+            pstats, snakeviz or gprof2dot). Defaults to $PIPELINE_PROFILE.
+
+    The trace holds one entry per span path with its number of calls, total
+    wall and CPU time, peak RSS, rows in/out and bytes read/written, so two
+    traces can be compared with compare_traces. Nested sessions are ignored.
+    """
+    def __init__(self, name, trace_dir=None, profile=None):
+        self.name = name
+        self.trace_dir = trace_dir or os.environ.get(TRACE_DIR_VARIABLE)
+        self.profile = profile if profile is not None else os.environ.get(PROFILE_VARIABLE) == '1'
+        self.trace_file = None
+        self._session = None
+        self._root = None
+        self._profile = None
+
+    def __enter__(self):
+        global _session
+        if self.trace_dir is None or _session is not None:
+            return self
+        self._session = TraceSession(self.name, self.profile)
+        if self.profile:
+            self._profile = cProfile.Profile()
+            self._session.profiles.append(self._profile)
+        _session = self._session
+        self._root = span(self.name).__enter__()
+        if self._profile is not None:
+            self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _session
+        if self._session is None:
+            return
+        if self._profile is not None:
+            self._profile.disable()
+        self._root.__exit__(exc_type, exc_value, traceback)
+        _session = None
+
+        os.makedirs(self.trace_dir, exist_ok=True)
+        base = os.path.join(self.trace_dir, f"{self.name}-{self._session.started:%Y%m%d_%H%M%S}")
+        self.trace_file = f"{base}.json"
+        with open(self.trace_file, 'w') as f:
+            json.dump(self._session.summary(), f, indent=1)
+        print(f"Trace written to {self.trace_file}")
+
+        if self._profile is not None:
+            stats = pstats.Stats(self._session.profiles[0])
+            for profile in self._session.profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(f"{base}.prof")
+            print(f"Profile written to {base}.prof")
+
+def load_trace(path):
+    with open(path) as f:
+        return json.load(f)
+
+def compare_traces(old_file, new_file, metric='wall_s'):
+    """
+    Compare a metric of every span between two traces, largest regressions first
+
+    Returns:
+        list: (span path, old value, new value, relative change) tuples; values
+        are None for spans present in only one trace.
+    """
+    old = {entry['path']: entry[metric] for entry in load_trace(old_file)['spans']}
+    new = {entry['path']: entry[metric] for entry in load_trace(new_file)['spans']}
+    rows = []
+    for path in list(old) + [path for path in new if path not in old]:
+        before, after = old.get(path), new.get(path)
+        change = (after - before) / before if before and after is not None else None
+        rows.append((path, before, after, change))
+    return sorted(rows, key=lambda row: -abs(row[3]) if row[3] is not None else 0)
+
+if __name__ == "__main__":
+    # Usage: python Profiling.py OLD_TRACE.json NEW_TRACE.json [metric]
+    old_file, new_file = sys.argv[1], sys.argv[2]
+    metric = sys.argv[3] if len(sys.argv) > 3 else 'wall_s'
+    for path, before, after, change in compare_traces(old_file, new_file, metric):
+        before = f"{before:.3f}" if before is not None else '-'
+        after = f"{after:.3f}" if after is not None else '-'
+        change = f"{change:+.1%}" if change is not None else 'n/a'
+        print(f"{path:60} {before:>14} {after:>14} {change:>8}")
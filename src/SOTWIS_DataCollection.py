@@ -1,8 +1,16 @@
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import os
 from pathlib import Path
-import dbfread
+import pyogrio
+import shapely
+from joblib import Parallel, delayed
+from DataStore import write_table
+from PolygonStore import PolygonStore, polygon_ids
+from Profiling import profiled, record_read, path_size, tracing
+from TableSchema import apply_schema
+from SOTWIS_DataPreprocessing import columns_to_remove
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -13,73 +21,110 @@ def get_project_root():
     current_file = Path(__file__)
     return current_file.parent.parent
 
-def process_shapefile(shp_file):
+def projected_columns(file_path, drop_columns=None):
+    """
+    List the attribute fields of a shapefile or DBF that survive drop_columns,
+    so the others are never decoded. Returns None to read every field.
+    """
+    if drop_columns is None:
+        return None
+    drop_columns = {str(col).strip().upper() for col in drop_columns}
+    fields = pyogrio.read_info(str(file_path))['fields']
+    return list(dict.fromkeys(
+        field for field in fields if str(field).strip().upper() not in drop_columns
+    ))
+
+def deduplicate_fields(df):
+    """
+    Collapse repeated field names the way a record dict does: the column keeps
+    the position of its first occurrence and the values of its last one
+    """
+    if not df.columns.duplicated().any():
+        return df
+    columns = {}
+    for position, col in enumerate(df.columns):
+        columns[col] = df.iloc[:, position]
+    return pd.DataFrame(columns)
+
+def process_shapefile(shp_file, drop_columns=None):
     """
     Process a single shapefile and return geometry bounds and attribute data
     """
-    bounds_data = []
     try:
         print(f"Reading shapefile: {shp_file.name}")
-        gdf = gpd.read_file(str(shp_file))
+        gdf = gpd.read_file(
+            str(shp_file),
+            engine='pyogrio',
+            use_arrow=True,
+            columns=projected_columns(shp_file, drop_columns)
+        )
         
-        # Get the bounds for each geometry
-        for idx, row in gdf.iterrows():
-            bounds = row.geometry.bounds
-            bound_dict = {
-                'Bottom_Left_Lat': bounds[1],
-                'Bottom_Left_Lon': bounds[0],
-                'Upper_Right_Lat': bounds[3],
-                'Upper_Right_Lon': bounds[2]
-            }
-            
-            # Add all non-geometry columns to the bounds dictionary
-            for col in gdf.columns:
-                if col != 'geometry':
-                    bound_dict[col] = row[col]
-            
-            bounds_data.append(bound_dict)
+        # Get the bounds of all geometries at once
+        bounds = gdf.bounds.to_numpy()
+        bounds_data = pd.DataFrame({
+            'Bottom_Left_Lat': bounds[:, 1],
+            'Bottom_Left_Lon': bounds[:, 0],
+            'Upper_Right_Lat': bounds[:, 3],
+            'Upper_Right_Lon': bounds[:, 2],
+            'Polygon_Id': polygon_ids(gdf.geometry.values)
+        })
         
-        return bounds_data
+        # Attach all non-geometry columns
+        attributes = deduplicate_fields(pd.DataFrame(gdf.drop(columns='geometry')).reset_index(drop=True))
+        attributes = attributes.drop(columns=bounds_data.columns, errors='ignore')
+        return pd.concat([bounds_data, attributes], axis=1)
     except Exception as e:
         print(f"Error processing {shp_file}: {str(e)}")
-        return []
+        return None
 
-def process_dbf(dbf_file):
+def process_dbf(dbf_file, drop_columns=None):
     """
     Process a single DBF file and return its data
     """
     try:
         print(f"Reading DBF file: {dbf_file.name}")
-        table = dbfread.DBF(str(dbf_file))
-        return [{k: v for k, v in record.items()} for record in table]
+        columns = projected_columns(dbf_file, drop_columns)
+        if columns == []:
+            # Every field is dropped, only the record count is needed
+            return pd.DataFrame(index=range(pyogrio.read_info(str(dbf_file))['features']))
+        df = pyogrio.read_dataframe(
+            str(dbf_file),
+            read_geometry=False,
+            use_arrow=True,
+            columns=columns
+        )
+        return deduplicate_fields(df)
     except Exception as e:
         print(f"Error processing {dbf_file}: {str(e)}")
-        return []
+        return None
+
+def read_shapefile_geometries(shp_file):
+    """
+    Read only the polygons of a shapefile, as WKB
+    """
+    try:
+        print(f"Reading geometries: {shp_file.name}")
+        df = pyogrio.read_dataframe(str(shp_file), columns=[], use_arrow=True)
+        return shapely.to_wkb(df.geometry.values)
+    except Exception as e:
+        print(f"Error processing {shp_file}: {str(e)}")
+        return None
 
-def extract_sotwis_data():
+def sotwis_files():
     """
-    Extract data from SOTWIS SOTER files and combine into a single CSV.
+    Return the SOTWIS shapefiles and the standalone DBF files, in reading order
     """
-    # Setup paths
-    project_root = get_project_root()
-    data_dir = project_root / "data" / "SOTWIS_SOVEUR_ver1.0"
+    data_dir = get_project_root() / "data" / "SOTWIS_SOVEUR_ver1.0"
     shapefiles_dir = data_dir / "ShapeFiles"
     
-    all_data = []
-    
-    # Process shapefiles
-    print("\nProcessing shapefiles...")
+    # Collect shapefiles
+    shp_files = []
     if shapefiles_dir.exists():
         shp_files = list(shapefiles_dir.rglob("*.shp"))
-        for shp_file in shp_files:
-            bounds_data = process_shapefile(shp_file)
-            if bounds_data:
-                all_data.extend(bounds_data)
     else:
         print(f"Warning: ShapeFiles directory not found at {shapefiles_dir}")
     
-    # Process standalone DBF files
-    print("\nProcessing DBF files...")
+    # Collect standalone DBF files
     dbf_files = []
     for dir_name in ['ShapeFiles', 'Layers', 'LegendFiles']:
         dir_path = data_dir / dir_name
@@ -88,30 +133,81 @@ def extract_sotwis_data():
                 f for f in dir_path.rglob("*.dbf") 
                 if not os.path.exists(str(f)[:-4] + '.shp')
             ])
+    return shp_files, dbf_files
+
+@profiled()
+def extract_sotwis_polygons(n_jobs=-1):
+    """
+    Collect the exact polygons of all SOTWIS shapefiles into a PolygonStore,
+    or return None if there are no shapefiles
+    """
+    shp_files, _ = sotwis_files()
+    print("\nProcessing shapefile geometries...")
+    wkb = [
+        values for values in Parallel(n_jobs=n_jobs)(delayed(read_shapefile_geometries)(f) for f in shp_files)
+        if values is not None and len(values)
+    ]
+    if not wkb:
+        return None
+    return PolygonStore.from_geometries(shapely.from_wkb(np.concatenate(wkb)))
+
+@profiled()
+def extract_sotwis_data(drop_columns=None, n_jobs=-1):
+    """
+    Extract data from SOTWIS SOTER files and combine into a single table.
+    
+    Shapefiles and standalone DBF files are read concurrently in a process pool.
+    Fields listed in drop_columns are not read at all.
+    """
+    shp_files, dbf_files = sotwis_files()
     
-    for dbf_file in dbf_files:
-        dbf_data = process_dbf(dbf_file)
-        if dbf_data:
-            all_data.extend(dbf_data)
+    # Process all files in parallel, keeping shapefiles first and the file order stable
+    print("\nProcessing shapefiles and DBF files...")
+    tasks = [delayed(process_shapefile)(f, drop_columns) for f in shp_files]
+    tasks += [delayed(process_dbf)(f, drop_columns) for f in dbf_files]
+    all_data = [
+        frame for frame in Parallel(n_jobs=n_jobs)(tasks)
+        if frame is not None and len(frame.index)
+    ]
     
     # Check if we have any data
     if not all_data:
         raise ValueError("No data was successfully extracted from the files")
+    record_read(
+        rows=sum(len(frame.index) for frame in all_data),
+        nbytes=sum(path_size(f) for f in shp_files + [f.with_suffix('.dbf') for f in shp_files] + dbf_files
+                   if f.exists())
+    )
     
-    # Convert to DataFrame
+    # Combine the per-file tables
     print("\nCombining data...")
-    df = pd.DataFrame(all_data)
+    df = pd.concat(all_data, ignore_index=True, sort=False)
     
     # Clean up column names and remove duplicates
     df.columns = [str(col).strip().upper() for col in df.columns]
     df = df.loc[:, ~df.columns.duplicated()]
     
-    # Fill NaN values with appropriate placeholders
-    numeric_columns = df.select_dtypes(include=['float64', 'int64']).columns
-    df[numeric_columns] = df[numeric_columns].fillna('')
-    df = df.fillna('')
+    # Missing values stay NaN; text columns become categorical, floats float32
+    return apply_schema(df)
+
+@profiled()
+def collect_sotwis_data(output_file, polygons_dir=None, drop_columns=columns_to_remove, n_jobs=-1):
+    """
+    Extract the SOTWIS table into output_file and, if polygons_dir is given,
+    the exact polygons used by the exact join mode of DataMerger
+    """
+    combined_data = extract_sotwis_data(drop_columns=drop_columns, n_jobs=n_jobs)
     
-    return df
+    # Save to the intermediate store
+    write_table(combined_data, output_file)
+    print(f"\nData saved to {output_file}")
+
+    if polygons_dir is not None:
+        polygons = extract_sotwis_polygons(n_jobs=n_jobs)
+        if polygons is not None:
+            polygons.save(polygons_dir)
+            print(f"{len(polygons)} polygons saved to {polygons_dir}")
+    return combined_data
 
 def get_region_bounds(df):
     """
@@ -142,15 +238,13 @@ def main():
         output_dir = get_project_root() / "output"
         output_dir.mkdir(exist_ok=True)
         
-        # Extract all data
+        # Extract all data and the exact polygons
         print("Starting data extraction...")
-        combined_data = extract_sotwis_data()
-        
-        # Save to CSV
-        output_file = output_dir / "sotwis_combined_data.csv"
-        combined_data.to_csv(output_file, index=False)
-        print(f"\nData saved to {output_file}")
-        
+        combined_data = collect_sotwis_data(
+            output_dir / "sotwis_combined_data.parquet",
+            polygons_dir=output_dir / "sotwis_polygons"
+        )
+
         # Calculate and save region bounds if possible
         region_bounds = get_region_bounds(combined_data)
         if region_bounds:
@@ -167,4 +261,5 @@ def main():
         raise e
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with tracing('sotwis_collect'):
+        main()
@@ -1,33 +1,39 @@
+import numpy as np
 import pandas as pd
-import os
+import pyarrow as pa
 from sklearn.preprocessing import MinMaxScaler, LabelEncoder
-import shutil
-
-def delete_folder(folder_path):
-    if os.path.exists(folder_path):
-        shutil.rmtree(folder_path)  # Delete folder and its contents
-        print(f"Folder '{folder_path}' has been deleted.")
-    else:
-        print(f"Folder '{folder_path}' does not exist.")
-
-def create_folder_if_not_exists(folder_path):
-    # Check if the folder exists
-    if not os.path.exists(folder_path):
-        # Create the folder
-        os.makedirs(folder_path)
-        print(f"Folder created at: {folder_path}")
-    else:
-        print(f"Folder already exists at: {folder_path}")
-
-folder_path = '../output/temp'
-create_folder_if_not_exists(folder_path)
+from DataStore import read_table, write_table, iter_batches, unify_schemas, TableWriter
+from Profiling import profiled, span, tracing
 
+columns_to_remove = ['LAYER', 'SONEASTS_','SONEASTS_I', 'SCID', 'CLAF', 'PRID', 'BOTDEP', 'AREA', 'PERIMETER', 'ISO', 'SOVEUR_ID', 'DEGRAD_ID', 'SOVID_NEW', 'ISOC', 'SUID', 'NEWSUID', 'TCID', 'PROP', 'PRID', 'TOPDEP', 'BOTDEP', 'MISCUNITS', 'SOILMAPUNI', 'PRID1', 'PRID2','PRID3', 'PRID4', 'PRID5', 'PRID6', 'PRID7', 'PRID8', 'PRID9', 'PRID10', 'SONWESTS_', 'SONWESTS_I', 'ISO_', 'DEGRAD_ID_', 'FNODE_', 'TNODE_', 'LPOLY_', 'RPOLY_', 'LENGTH', 'SONEAST_', 'SONEAST_ID', 'XMIN', 'YMIN', 'XMAX', 'YMAX', 'IDTIC', 'XTIC', 'YTIC', 'MISC', 'CLIP', 'SONWEST_', 'SONWEST_ID']  # List of column names to remove
+
+exclusive_fields = ['BOTTOM_LEFT_LAT', 'BOTTOM_LEFT_LON', 'UPPER_RIGHT_LAT', 'UPPER_RIGHT_LON', 'POLYGON_ID']
+
+# Numeric columns to normalize
+numeric_columns = [
+    'CFRAG', 'SDTO', 'STPC', 'CLPC', 'BULK', 'TAWC', 'CECS', 'BSAT', 'CECC',
+    'PHAQ', 'TCEQ', 'GYPS', 'ELCO', 'TOTC', 'TOTN', 'ECEC', 'ALSA', 'ESP'
+]
+
+# Define the mapping of textural classes to normalized values
+drain_mapping = {
+    'C': 1.0,  # Coarse
+    'M': 0.75,  # Medium
+    'Z': 0.5,  # Medium fine
+    'F': 0.25,  # Fine
+    'V': 0.0   # Very fine
+}
+
+soil_columns = [f'SOIL{i}' for i in range(1, 11)]
+prop_columns = [f'PROP{i}' for i in range(1, 11)]
+
+@profiled()
 def remove_columns_from_csv(input_csv, output_csv, columns_to_remove):
-    # Read the input CSV file into a DataFrame
-    df = pd.read_csv(input_csv)
+    # Read the input table into a DataFrame
+    df = read_table(input_csv)
     
     # Print available columns
-    print("Available columns in the CSV:")
+    print("Available columns in the table:")
     print(df.columns.tolist())
     
     # Find and handle missing columns
@@ -38,21 +44,15 @@ def remove_columns_from_csv(input_csv, output_csv, columns_to_remove):
     # Remove specified columns if they exist
     df.drop(columns=[col for col in columns_to_remove if col in df.columns], inplace=True)
 
-    # Save the modified DataFrame to a new CSV file
-    df.to_csv(output_csv, index=False)
+    # Save the modified DataFrame to a new table
+    write_table(df, output_csv)
 
     print(f"Specified columns have been removed and saved to {output_csv}.")
 
-columns_to_remove = ['LAYER', 'SONEASTS_','SONEASTS_I', 'SCID', 'CLAF', 'PRID', 'BOTDEP', 'AREA', 'PERIMETER', 'ISO', 'SOVEUR_ID', 'DEGRAD_ID', 'SOVID_NEW', 'ISOC', 'SUID', 'NEWSUID', 'TCID', 'PROP', 'PRID', 'TOPDEP', 'BOTDEP', 'MISCUNITS', 'SOILMAPUNI', 'PRID1', 'PRID2','PRID3', 'PRID4', 'PRID5', 'PRID6', 'PRID7', 'PRID8', 'PRID9', 'PRID10', 'SONWESTS_', 'SONWESTS_I', 'ISO_', 'DEGRAD_ID_', 'FNODE_', 'TNODE_', 'LPOLY_', 'RPOLY_', 'LENGTH', 'SONEAST_', 'SONEAST_ID', 'XMIN', 'YMIN', 'XMAX', 'YMAX', 'IDTIC', 'XTIC', 'YTIC', 'MISC', 'CLIP', 'SONWEST_', 'SONWEST_ID']  # List of column names to remove
-
-input_csv = "../output/sotwis_combined_data.csv"
-output_csv = "../output/temp/sotwis_combined_data_deleted_irrelevant_cols.csv"
-
-remove_columns_from_csv(input_csv, output_csv, columns_to_remove)
-
+@profiled()
 def remove_exclusive_entries(input_csv, output_csv, exclusive_fields):
-    # Read the input CSV file into a DataFrame
-    df = pd.read_csv(input_csv)
+    # Read the input table into a DataFrame
+    df = read_table(input_csv)
 
     # Identify rows where all fields except the exclusive_fields are empty
     other_fields = [col for col in df.columns if col not in exclusive_fields]
@@ -61,48 +61,32 @@ def remove_exclusive_entries(input_csv, output_csv, exclusive_fields):
     # Remove the identified rows
     df_cleaned = df[~rows_to_remove]
 
-    # Save the modified DataFrame to a new CSV file
-    df_cleaned.to_csv(output_csv, index=False)
+    # Save the modified DataFrame to a new table
+    write_table(df_cleaned, output_csv)
 
     print(f"Rows with information exclusively in {exclusive_fields} have been removed and saved to {output_csv}.")
 
-exclusive_fields = ['BOTTOM_LEFT_LAT', 'BOTTOM_LEFT_LON', 'UPPER_RIGHT_LAT', 'UPPER_RIGHT_LON']
-
-input_csv = "../output/temp/sotwis_combined_data_deleted_irrelevant_cols.csv"
-output_csv = "../output/temp/sotwis_combined_data_no_empty_entries.csv"
-
-remove_exclusive_entries(input_csv, output_csv, exclusive_fields)
-
+@profiled()
 def remove_empty_columns(input_csv, output_csv):
-    # Read the input CSV file into a DataFrame
-    df = pd.read_csv(input_csv)
+    # Read the input table into a DataFrame
+    df = read_table(input_csv)
 
     # Drop columns where all values are NaN
     df_cleaned = df.dropna(axis=1, how='all')
 
-    # Save the updated DataFrame to a new CSV file
-    df_cleaned.to_csv(output_csv, index=False)
+    # Save the updated DataFrame to a new table
+    write_table(df_cleaned, output_csv)
 
     print(f"Empty columns have been removed and saved to {output_csv}.")
 
-input_csv = '../output/temp/sotwis_combined_data_no_empty_entries.csv' 
-output_csv = '../output/temp/sotwis_combined_data_cleaned.csv' 
-
-remove_empty_columns(input_csv, output_csv)
-
+@profiled()
 def normalize_fields(input_csv, output_csv):
-    # Read the input CSV file into a DataFrame
-    df = pd.read_csv(input_csv)
+    # Read the input table into a DataFrame
+    df = read_table(input_csv)
 
     # Initialize Min-Max Scaler
     scaler = MinMaxScaler()
 
-    # Numeric columns to normalize
-    numeric_columns = [
-        'CFRAG', 'SDTO', 'STPC', 'CLPC', 'BULK', 'TAWC', 'CECS', 'BSAT', 'CECC',
-        'PHAQ', 'TCEQ', 'GYPS', 'ELCO', 'TOTC', 'TOTN', 'ECEC', 'ALSA', 'ESP'
-    ]
-
     # Normalize numeric columns
     for col in numeric_columns:
         if col in df.columns:
@@ -111,16 +95,6 @@ def normalize_fields(input_csv, output_csv):
                 index=df[col].dropna().index
             )
 
-
-    # Define the mapping of textural classes to normalized values
-    drain_mapping = {
-        'C': 1.0,  # Coarse
-        'M': 0.75,  # Medium
-        'Z': 0.5,  # Medium fine
-        'F': 0.25,  # Fine
-        'V': 0.0   # Very fine
-    }
-
     # Replace the DRAIN field values using the mapping
     if 'DRAIN' in df.columns:
         df['DRAIN'] = df['DRAIN'].map(drain_mapping)
@@ -130,7 +104,6 @@ def normalize_fields(input_csv, output_csv):
         df['PSCL'] = df['PSCL'].map(drain_mapping)
 
     # Normalize SOIL fields (textual columns encoded into normalized values between 0 and 1)
-    soil_columns = [f'SOIL{i}' for i in range(1, 11)]
     for col in soil_columns:
         if col in df.columns:
             # Apply Label Encoding for categorical to numerical transformation
@@ -146,20 +119,206 @@ def normalize_fields(input_csv, output_csv):
                 index=df[col].dropna().index
             )
     # Normalize PROP fields (convert from 0-100 to 0-1)
-    prop_columns = [f'PROP{i}' for i in range(1, 11)]
     for col in prop_columns:
         if col in df.columns:
             df[col] = df[col].apply(lambda x: x / 100.0 if pd.notna(x) else x)
 
-
-    # Save the updated DataFrame to a new CSV file
-    df.to_csv(output_csv, index=False)
+    # Save the updated DataFrame to a new table
+    write_table(df, output_csv)
 
     print(f"Dataset has been normalized and saved to {output_csv}.")
 
-input_csv = '../output/temp/sotwis_combined_data_cleaned.csv'  # Input CSV file
-output_csv = '../output/sotwis_processed.csv'  # Output CSV file after normalization
-
-normalize_fields(input_csv, output_csv)
 
-delete_folder(folder_path)
\ No newline at end of file
+def min_max_parameters(data_min, data_max):
+    """
+    Scale and offset of a fitted MinMaxScaler with the default (0, 1) range
+    """
+    data_range = data_max - data_min
+    if data_range < 10 * np.finfo(np.float64).eps:
+        data_range = 1.0
+    scale = 1.0 / data_range
+    return scale, 0 - data_min * scale
+
+class DropColumns:
+    """
+    Streaming counterpart of remove_columns_from_csv
+    """
+    def __init__(self, columns):
+        self.columns = columns
+
+    def observe(self, df):
+        return self.transform(df)
+
+    def finalize(self):
+        pass
+
+    def transform(self, df):
+        return df.drop(columns=[col for col in self.columns if col in df.columns])
+
+class DropExclusiveRows:
+    """
+    Streaming counterpart of remove_exclusive_entries
+    """
+    def __init__(self, exclusive_fields):
+        self.exclusive_fields = exclusive_fields
+
+    def observe(self, df):
+        return self.transform(df)
+
+    def finalize(self):
+        pass
+
+    def transform(self, df):
+        other_fields = [col for col in df.columns if col not in self.exclusive_fields]
+        return df[~df[other_fields].isnull().all(axis=1)]
+
+class DropEmptyColumns:
+    """
+    Streaming counterpart of remove_empty_columns: the first pass records which
+    columns hold at least one value anywhere in the table
+    """
+    def __init__(self):
+        self.non_empty = set()
+
+    def observe(self, df):
+        self.non_empty.update(df.columns[df.notna().any()])
+        return df
+
+    def finalize(self):
+        pass
+
+    def transform(self, df):
+        return df[[col for col in df.columns if col in self.non_empty]]
+
+class NormalizeFields:
+    """
+    Streaming counterpart of normalize_fields. The first pass gathers the global
+    min/max of the numeric columns and the label vocabulary of the SOIL columns,
+    so every chunk is scaled exactly as the whole table would be.
+    """
+    def __init__(self):
+        self.minima = {}
+        self.maxima = {}
+        self.vocabularies = {col: set() for col in soil_columns}
+        self.scalers = {}
+        self.classes = {}
+
+    @property
+    def float_columns(self):
+        return numeric_columns + ['DRAIN', 'PSCL'] + soil_columns + prop_columns
+
+    def observe(self, df):
+        for col in numeric_columns:
+            if col in df.columns:
+                values = df[col].astype('float64')
+                if values.notna().any():
+                    self.minima[col] = min(self.minima.get(col, np.inf), values.min())
+                    self.maxima[col] = max(self.maxima.get(col, -np.inf), values.max())
+        for col in soil_columns:
+            if col in df.columns:
+                self.vocabularies[col].update(df[col].dropna().tolist())
+        return df
+
+    def finalize(self):
+        self.scalers = {
+            col: min_max_parameters(self.minima[col], self.maxima[col]) for col in self.minima
+        }
+        for col, vocabulary in self.vocabularies.items():
+            if vocabulary:
+                classes = np.array(sorted(vocabulary))
+                self.classes[col] = (classes, min_max_parameters(0, len(classes) - 1))
+
+    def transform(self, df):
+        df = df.copy()
+
+        # Normalize numeric columns
+        for col, (scale, offset) in self.scalers.items():
+            if col in df.columns:
+                df[col] = df[col].astype('float64') * scale + offset
+
+        # Replace the DRAIN and texture class (PSCL) values using the mapping
+        for col in ['DRAIN', 'PSCL']:
+            if col in df.columns:
+                df[col] = df[col].map(drain_mapping).astype('float64')
+
+        # Label-encode SOIL fields against the global vocabulary, then scale to [0, 1]
+        for col, (classes, (scale, offset)) in self.classes.items():
+            if col in df.columns:
+                present = df[col].notna().to_numpy()
+                encoded = np.full(len(df), np.nan)
+                encoded[present] = np.searchsorted(classes, df[col].to_numpy()[present]) * scale + offset
+                df[col] = encoded
+
+        # Normalize PROP fields (convert from 0-100 to 0-1)
+        for col in prop_columns:
+            if col in df.columns:
+                df[col] = df[col].astype('float64') / 100.0
+
+        return df
+
+class ChunkedPipeline:
+    """
+    Run a sequence of steps over a table in chunks, in two passes.
+
+    The first pass streams every chunk through the steps' observe() to gather
+    global statistics, the second applies transform() and appends each chunk to
+    the output, so only one chunk is ever held in memory.
+    """
+    def __init__(self, steps, batch_size=100000):
+        self.steps = steps
+        self.batch_size = batch_size
+        self.input_schema = None
+
+    @profiled()
+    def fit(self, input_path):
+        schemas = []
+        for chunk in iter_batches(input_path, batch_size=self.batch_size):
+            schemas.append(pa.Schema.from_pandas(chunk, preserve_index=False))
+            for step in self.steps:
+                with span(f"{type(step).__name__}.observe"):
+                    chunk = step.observe(chunk)
+        for step in self.steps:
+            step.finalize()
+        self.input_schema = unify_schemas(schemas)
+        return self
+
+    def output_schema(self):
+        float_columns = set()
+        for step in self.steps:
+            float_columns.update(getattr(step, 'float_columns', []))
+        return pa.schema([
+            pa.field(field.name, pa.float32()) if field.name in float_columns else field
+            for field in self.input_schema
+        ])
+
+    @profiled()
+    def transform(self, input_path, output_path):
+        with TableWriter(output_path, schema=self.output_schema()) as writer:
+            for chunk in iter_batches(input_path, batch_size=self.batch_size):
+                for step in self.steps:
+                    with span(f"{type(step).__name__}.transform"):
+                        chunk = step.transform(chunk)
+                writer.write(chunk)
+        return writer.rows_written
+
+    def run(self, input_path, output_path):
+        return self.fit(input_path).transform(input_path, output_path)
+
+def sotwis_pipeline(batch_size=100000):
+    """
+    The SOTWIS cleaning and normalization steps as a single chunked pipeline
+    """
+    return ChunkedPipeline([
+        DropColumns(columns_to_remove),
+        DropExclusiveRows(exclusive_fields),
+        DropEmptyColumns(),
+        NormalizeFields()
+    ], batch_size=batch_size)
+
+if __name__ == "__main__":
+    with tracing('sotwis_preprocess'):
+        input_path = "../output/sotwis_combined_data.parquet"
+        output_path = '../output/sotwis_processed.parquet'  # Output table after normalization
+
+        rows = sotwis_pipeline().run(input_path, output_path)
+        print(f"Dataset has been cleaned, normalized and saved to {output_path} ({rows} rows).")
@@ -1,10 +1,184 @@
 import pandas as pd
 import numpy as np
 from sklearn.cluster import DBSCAN
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
+from sklearn.neighbors import BallTree
 from datetime import datetime
+from DataStore import read_table, write_table, export_csv
+from Profiling import profiled, tracing
 
-def spatial_cluster_imputation(df, eps=1.0, min_samples=5):
+# Columns excluded from imputation
+COORDINATE_COLUMNS = ['LAT', 'LON', 'BOTTOM_LEFT_LAT', 'BOTTOM_LEFT_LON',
+                      'UPPER_RIGHT_LAT', 'UPPER_RIGHT_LON']
+
+# NASA POWER values that change from year to year; everything else is static per cell
+TEMPORAL_COLUMNS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+                    'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC', 'ANN']
+
+def is_temporal_column(col):
+    """
+    True for the monthly and annual columns of the primary NASA POWER
+    parameter (JAN) and of every other parameter in the wide table (T2M_JAN)
+    """
+    return col in TEMPORAL_COLUMNS or col.rpartition('_')[2] in TEMPORAL_COLUMNS
+
+@profiled()
+def nearest_donor_rows(coords, donor_mask, metric='euclidean', k=8):
+    """
+    Find the nearest donor row for every row outside donor_mask.
+    
+    Parameters:
+    -----------
+    coords : ndarray
+        (n, 2) array of LAT, LON coordinates
+    donor_mask : ndarray
+        Boolean mask of the rows holding a value
+    metric : str
+        'euclidean' on raw degrees (same result as argmin over cdist, ties going
+        to the first donor in row order) or 'haversine' great-circle distance
+    k : int
+        Initial number of candidate neighbours queried per row
+        
+    Returns:
+    --------
+    ndarray
+        Donor row position for each non-donor row, in row order
+    """
+    donor_rows = np.flatnonzero(donor_mask)
+    query = coords[~donor_mask]
+    
+    # cdist yields NaN distances for missing coordinates and argmin picks the first NaN
+    donor_coords = coords[donor_rows]
+    invalid_donors = ~np.isfinite(donor_coords).all(axis=1)
+    if invalid_donors.any():
+        return np.full(len(query), donor_rows[invalid_donors.argmax()])
+    nearest = np.full(len(query), donor_rows[0])
+    valid_query = np.isfinite(query).all(axis=1)
+    query = query[valid_query]
+    
+    # Donors sharing coordinates are interchangeable; keep the first of each
+    unique_coords, first_donor = np.unique(donor_coords, axis=0, return_index=True)
+    unique_rows = donor_rows[first_donor]
+    
+    if metric == 'haversine':
+        tree = BallTree(np.radians(unique_coords), metric='haversine')
+        idx = tree.query(np.radians(query), k=1, return_distance=False)[:, 0]
+        nearest[valid_query] = unique_rows[idx]
+        return nearest
+    
+    tree = cKDTree(unique_coords)
+    result = np.empty(len(query), dtype=np.int64)
+    pending = np.arange(len(query))
+    k = min(k, len(unique_coords))
+    while len(pending):
+        _, idx = tree.query(query[pending], k=k)
+        idx = idx.reshape(len(pending), -1)
+        # Exact distances as cdist computes them, so ties are detected exactly
+        diff = query[pending][:, None, :] - unique_coords[idx]
+        distances = np.sqrt((diff ** 2).sum(axis=2))
+        best = distances.min(axis=1, keepdims=True)
+        tied_rows = np.where(distances == best, unique_rows[idx], np.iinfo(np.int64).max)
+        result[pending] = tied_rows.min(axis=1)
+        
+        # Rows whose last candidate is still tied may have more ties further out
+        complete = (distances[:, -1] > best[:, 0]) | (k == len(unique_coords))
+        pending = pending[~complete]
+        k = min(2 * k, len(unique_coords))
+    
+    nearest[valid_query] = result
+    return nearest
+
+@profiled()
+def fill_from_nearest_donors(df, columns, metric='euclidean'):
+    """
+    Fill the NaNs of each column with the value of the nearest row that has one.
+    
+    Columns sharing the same missingness pattern share a single spatial index
+    and a single batched query.
+    
+    Parameters:
+    -----------
+    df : pandas DataFrame
+        Dataset with LAT and LON columns, modified in place
+    columns : list
+        Columns to fill
+    metric : str
+        'euclidean' or 'haversine', see nearest_donor_rows
+    """
+    coords = df[['LAT', 'LON']].to_numpy(dtype='float64')
+    missing = df[columns].isna()
+    
+    patterns = {}
+    for column in columns:
+        mask = missing[column].to_numpy()
+        if mask.any() and not mask.all():
+            patterns.setdefault(mask.tobytes(), []).append(column)
+    
+    for pattern_columns in patterns.values():
+        mask = missing[pattern_columns[0]].to_numpy()
+        donors = nearest_donor_rows(coords, ~mask, metric=metric)
+        for column in pattern_columns:
+            values = df[column].to_numpy(copy=True)
+            values[mask] = values[donors]
+            df[column] = values
+
+def distance_weighted_cluster_means(df, labels, columns, smoothing=1e-6):
+    """
+    Inverse-distance weighted mean of every column within each cluster, for
+    every row (NaN for noise points).
+    
+    Each row is weighted by 1 / (distance to its cluster centroid + smoothing),
+    so rows near the centre of a cluster dominate. All clusters are computed
+    at once with grouped weighted sums divided by grouped weight sums.
+    """
+    labels = np.asarray(labels)
+    coords = df[['LAT', 'LON']].to_numpy(dtype='float64')
+    centroids = pd.DataFrame(coords).groupby(labels).transform('mean').to_numpy()
+    weights = 1.0 / (np.linalg.norm(coords - centroids, axis=1) + smoothing)
+    
+    values = df[columns].astype('float64')
+    weighted_sums = values.mul(weights, axis=0).groupby(labels).transform('sum')
+    weight_sums = values.notna().mul(weights, axis=0).groupby(labels).transform('sum')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = weighted_sums / weight_sums
+    means.loc[labels == -1] = np.nan
+    return means
+
+@profiled()
+def fill_within_clusters(df, labels, columns, statistic='mean'):
+    """
+    Fill NaNs with a statistic of their DBSCAN cluster, modifying df in place.
+    Noise points (label -1) are left untouched, as are non-numeric columns.
+    
+    Parameters:
+    -----------
+    df : pandas DataFrame
+        Dataset to fill
+    labels : array-like
+        DBSCAN cluster label of every row
+    columns : list
+        Columns to fill
+    statistic : str
+        'mean', 'median' or 'distance_weighted' (inverse-distance weighted mean)
+    """
+    labels = np.asarray(labels)
+    in_cluster = labels != -1
+    columns = [col for col in columns if pd.api.types.is_numeric_dtype(df[col])]
+    if not in_cluster.any() or not columns:
+        return
+    
+    clustered = df.loc[in_cluster, columns]
+    if statistic == 'distance_weighted':
+        cluster_values = distance_weighted_cluster_means(df, labels, columns).loc[in_cluster]
+    elif statistic in ('mean', 'median'):
+        cluster_values = clustered.groupby(labels[in_cluster]).transform(statistic)
+    else:
+        raise ValueError(f"Unknown cluster statistic: {statistic}")
+    
+    df.loc[in_cluster, columns] = clustered.fillna(cluster_values)
+
+@profiled()
+def spatial_cluster_imputation(df, eps=1.0, min_samples=5, metric='euclidean', cluster_statistic='mean'):
     """
     Fill missing values using spatial clustering and hierarchical filling.
     
@@ -16,6 +190,10 @@ def spatial_cluster_imputation(df, eps=1.0, min_samples=5):
         Maximum distance between two samples for DBSCAN clustering
     min_samples : int
         Minimum number of samples in a cluster for DBSCAN
+    metric : str
+        Distance used for the nearest-neighbour fill: 'euclidean' or 'haversine'
+    cluster_statistic : str
+        Within-cluster fill value: 'mean', 'median' or 'distance_weighted'
         
     Returns:
     --------
@@ -38,42 +216,101 @@ def spatial_cluster_imputation(df, eps=1.0, min_samples=5):
                                            'UPPER_RIGHT_LAT', 'UPPER_RIGHT_LON'])
     
     # First pass: Fill within clusters
-    for cluster_id in sorted(set(clustering.labels_)):
-        if cluster_id == -1:  # Skip noise points
-            continue
-            
-        cluster_mask = df_filled['cluster'] == cluster_id
-        cluster_data = df_filled[cluster_mask]
-        
-        for column in columns_to_fill:
-            # Calculate mean of non-NaN values in the cluster
-            cluster_mean = cluster_data[column].mean()
-            # Fill NaN values in the cluster with the cluster mean
-            df_filled.loc[cluster_mask & df_filled[column].isna(), column] = cluster_mean
-    
-    # Second pass: Fill remaining NaNs using nearest clusters
-    def fill_from_nearest_clusters(row, column):
-        if pd.isna(row[column]):
-            # Get distances to all other points
-            point_coords = row[['LAT', 'LON']].values.reshape(1, -1)
-            other_coords = df_filled[~df_filled[column].isna()][['LAT', 'LON']].values
-            
-            if len(other_coords) > 0:
-                distances = cdist(point_coords, other_coords).flatten()
-                # Get the nearest non-NaN value
-                nearest_idx = distances.argmin()
-                return df_filled[~df_filled[column].isna()][column].iloc[nearest_idx]
-        return row[column]
-    
-    # Iterate through remaining NaN values
-    for column in columns_to_fill:
-        if df_filled[column].isna().any():
-            df_filled[column] = df_filled.apply(
-                lambda row: fill_from_nearest_clusters(row, column), axis=1
-            )
+    fill_within_clusters(df_filled, clustering.labels_, columns_to_fill, statistic=cluster_statistic)
+    
+    # Second pass: Fill remaining NaNs from the nearest rows holding a value
+    fill_from_nearest_donors(df_filled, list(columns_to_fill), metric=metric)
     
     return df_filled.drop('cluster', axis=1)
 
+@profiled()
+def fill_along_time_axis(df, columns, metric='euclidean'):
+    """
+    Fill time-varying values from the same cell's other years, then from the
+    nearest cell of the same year.
+    
+    Parameters:
+    -----------
+    df : pandas DataFrame
+        Dataset with LAT, LON and YEAR columns, modified in place
+    columns : list
+        Time-varying columns to fill
+    metric : str
+        'euclidean' or 'haversine', see nearest_donor_rows
+    """
+    if not len(columns):
+        return
+    
+    # Climatology: the mean of the same column over the cell's other years
+    climatology = df.groupby(['LAT', 'LON'])[columns].transform('mean')
+    df[columns] = df[columns].fillna(climatology)
+    
+    # Cells without a single value: nearest cell within the same year
+    remaining = [column for column in columns if df[column].isna().any()]
+    if remaining:
+        for _, year_index in df.groupby('YEAR').groups.items():
+            year_df = df.loc[year_index, ['LAT', 'LON'] + remaining]
+            fill_from_nearest_donors(year_df, remaining, metric=metric)
+            df.loc[year_index, remaining] = year_df[remaining]
+
+@profiled()
+def grid_cell_imputation(df, eps=1.0, min_samples=5, metric='euclidean', cluster_statistic='mean'):
+    """
+    Spatial cluster imputation over distinct grid cells instead of all rows.
+    
+    Static columns are imputed once per distinct (LAT, LON, static values)
+    profile, so DBSCAN sees every coordinate once and min_samples counts cells
+    rather than years. The result is broadcast back to all rows with a single
+    take. Time-varying NASA columns are filled along the time axis instead.
+    
+    Parameters:
+    -----------
+    df : pandas DataFrame
+        Input dataset with spatial coordinates and features
+    eps : float
+        Maximum distance between two samples for DBSCAN clustering
+    min_samples : int
+        Minimum number of distinct cells in a cluster for DBSCAN
+    metric : str
+        Distance used for the nearest-neighbour fill: 'euclidean' or 'haversine'
+    cluster_statistic : str
+        Within-cluster fill value: 'mean', 'median' or 'distance_weighted'
+        
+    Returns:
+    --------
+    pandas DataFrame
+        Dataset with imputed values
+    """
+    df_filled = df.copy()
+    temporal_columns = [col for col in df.columns if is_temporal_column(col)]
+    static_columns = list(df.columns.difference(COORDINATE_COLUMNS + temporal_columns + ['YEAR']))
+    
+    # One row per distinct cell profile
+    profile_keys = ['LAT', 'LON'] + static_columns
+    profile_ids = df.groupby(profile_keys, dropna=False, sort=False).ngroup().to_numpy()
+    first_rows = np.unique(profile_ids, return_index=True)[1]
+    profiles = df.iloc[first_rows][profile_keys].reset_index(drop=True)
+    
+    if static_columns:
+        # Cluster the distinct coordinates, then label each profile with its cell's cluster
+        cells = profiles[['LAT', 'LON']].drop_duplicates()
+        cell_labels = DBSCAN(eps=eps, min_samples=min_samples).fit(cells.values).labels_
+        labels = profiles[['LAT', 'LON']].merge(
+            cells.assign(cluster=cell_labels), on=['LAT', 'LON'], how='left'
+        )['cluster'].to_numpy()
+        
+        fill_within_clusters(profiles, labels, static_columns, statistic=cluster_statistic)
+        fill_from_nearest_donors(profiles, static_columns, metric=metric)
+        
+        # Broadcast the filled profiles back to every row
+        filled_static = profiles[static_columns].iloc[profile_ids].reset_index(drop=True)
+        filled_static.index = df_filled.index
+        df_filled[static_columns] = filled_static
+    
+    fill_along_time_axis(df_filled, temporal_columns, metric=metric)
+    return df_filled
+
+@profiled()
 def validate_imputation(df_original, df_imputed):
     """
     Validate the imputation results
@@ -98,34 +335,45 @@ def validate_imputation(df_original, df_imputed):
     }
     return metrics
 
-def process_and_save_data(input_file, output_file=None, eps=0.1, min_samples=3):
+@profiled()
+def process_and_save_data(input_file, output_file=None, eps=0.1, min_samples=3, metric='euclidean',
+                          per_cell=True, cluster_statistic='mean'):
     """
-    Process the input CSV file, perform imputation, and save results
+    Process the input table, perform imputation, and save results
     
     Parameters:
     -----------
     input_file : str
-        Path to input CSV file
+        Path to input table (Parquet or CSV)
     output_file : str, optional
-        Path to output CSV file. If None, generates a timestamped filename
+        Path to output table. If None, generates a timestamped filename
     eps : float
         Maximum distance between points for DBSCAN clustering
     min_samples : int
         Minimum number of samples in a cluster
+    metric : str
+        Distance used for the nearest-neighbour fill: 'euclidean' or 'haversine'
+    per_cell : bool
+        Impute distinct grid cells once (grid_cell_imputation, the default)
+        instead of every row (spatial_cluster_imputation)
+    cluster_statistic : str
+        Within-cluster fill value: 'mean', 'median' or 'distance_weighted'
     """
     # Read input data
-    df = pd.read_csv(input_file)
+    df = read_table(input_file)
     
     # Perform imputation
-    df_filled = spatial_cluster_imputation(df, eps=eps, min_samples=min_samples)
+    imputation = grid_cell_imputation if per_cell else spatial_cluster_imputation
+    df_filled = imputation(df, eps=eps, min_samples=min_samples, metric=metric,
+                           cluster_statistic=cluster_statistic)
     
     # Generate output filename if not provided
     if output_file is None:
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        output_file = f'filled_data_{timestamp}.csv'
+        output_file = f'filled_data_{timestamp}.parquet'
     
     # Save filled data
-    df_filled.to_csv(output_file, index=False)
+    write_table(df_filled, output_file)
     
     # Get validation metrics
     metrics = validate_imputation(df, df_filled)
@@ -148,15 +396,19 @@ def process_and_save_data(input_file, output_file=None, eps=0.1, min_samples=3):
 
 # Usage example
 if __name__ == '__main__':
-    input_file = '../output/FINAL_SOTWIS_NASA.csv'
-    output_file = '../output/AUGUMENTED_SOTWIS_NASA.csv'
-    
-    filled_file, validation_file = process_and_save_data(
-        input_file,
-        output_file,
-        eps=0.5,
-        min_samples=5
-    )
-    
-    print(f'Filled data saved to: {filled_file}')
-    print(f'Validation results saved to: {validation_file}')
\ No newline at end of file
+    with tracing('imputation'):
+        input_file = '../output/FINAL_SOTWIS_NASA.parquet'
+        output_file = '../output/AUGUMENTED_SOTWIS_NASA.parquet'
+
+        filled_file, validation_file = process_and_save_data(
+            input_file,
+            output_file,
+            eps=0.5,
+            min_samples=5
+        )
+
+        print(f'Filled data saved to: {filled_file}')
+        print(f'Validation results saved to: {validation_file}')
+
+        # Optional CSV export for the notebooks
+        export_csv(filled_file, '../output/AUGUMENTED_SOTWIS_NASA.csv')
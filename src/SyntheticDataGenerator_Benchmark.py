@@ -0,0 +1,76 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from SyntheticDataGenerator import fill_within_clusters
+
+def fill_within_clusters_loop(df, labels, columns):
+    """
+    Reference implementation: one masked .loc assignment per cluster and column
+    """
+    for cluster_id in sorted(set(labels)):
+        if cluster_id == -1:  # Skip noise points
+            continue
+
+        cluster_mask = labels == cluster_id
+        cluster_data = df[cluster_mask]
+
+        for column in columns:
+            cluster_mean = cluster_data[column].mean()
+            df.loc[cluster_mask & df[column].isna(), column] = cluster_mean
+
+def make_clustered_frame(n_clusters, rows_per_cluster=20, n_columns=20, nan_rate=0.3, seed=42):
+    """
+    Random rows spread over n_clusters clusters (plus 5% noise points) with a
+    fraction of NaNs in every feature column
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = n_clusters * rows_per_cluster
+    labels = rng.integers(0, n_clusters, n_rows)
+    labels[rng.random(n_rows) < 0.05] = -1
+
+    df = pd.DataFrame({
+        'LAT': rng.uniform(40, 55, n_rows).round(1),
+        'LON': rng.uniform(12, 30, n_rows).round(1),
+    })
+    features = rng.random((n_rows, n_columns))
+    features[rng.random(features.shape) < nan_rate] = np.nan
+    columns = [f'F{i}' for i in range(n_columns)]
+    df[columns] = features
+    return df, labels, columns
+
+def run_benchmark(n_clusters, rows_per_cluster=20, n_columns=20):
+    """
+    Time the groupby-transform fill against the per-cluster loop and check that
+    both give the same values (up to floating-point summation order)
+    """
+    df, labels, columns = make_clustered_frame(n_clusters, rows_per_cluster, n_columns)
+    print(f"Benchmarking {len(df)} rows, {n_clusters} clusters, {n_columns} columns")
+
+    expected = df.copy()
+    start = time.perf_counter()
+    fill_within_clusters_loop(expected, labels, columns)
+    loop_time = time.perf_counter() - start
+    print(f"Per-cluster loop: {loop_time:.2f}s")
+
+    timings = {'loop': loop_time}
+    for statistic in ['mean', 'median', 'distance_weighted']:
+        actual = df.copy()
+        start = time.perf_counter()
+        fill_within_clusters(actual, labels, columns, statistic=statistic)
+        timings[statistic] = time.perf_counter() - start
+        print(f"Vectorized {statistic}: {timings[statistic]:.2f}s")
+
+        if statistic == 'mean':
+            same = np.allclose(expected[columns], actual[columns], rtol=1e-12, atol=0, equal_nan=True)
+            print(f"Speed-up: {loop_time / max(timings['mean'], 1e-9):.1f}x")
+            print(f"Same values as the loop: {same}")
+
+    return timings
+
+if __name__ == "__main__":
+    cluster_counts = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+
+    for n_clusters in cluster_counts:
+        run_benchmark(n_clusters)
+        print()
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Declared storage types of the NASA POWER / SOTWIS tables, applied by DataStore
+# on every read and write:
+#   YEAR                      int16
+#   LAT, LON                  float32 (grid steps of 0.5 / 0.625 degrees are exact)
+#   SOTWIS bounding boxes     float64 (points are tested for containment against them)
+#   any other float column    float32 (monthly values, soil attributes, PROP, ...)
+#   any text column           categorical / dictionary-encoded (PARAMETER, SOIL codes, ids)
+# Missing values are always real nulls (NaN), never placeholder strings.
+
+PARTITION_COLUMN = 'YEAR'
+COORDINATE_COLUMNS = ['LAT', 'LON']
+BOX_COLUMNS = ['BOTTOM_LEFT_LON', 'BOTTOM_LEFT_LAT', 'UPPER_RIGHT_LON', 'UPPER_RIGHT_LAT']
+
+CATEGORY_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+def declared_dtype(name, dtype):
+    """
+    The pandas dtype a column named name currently holding dtype is stored as,
+    or None to keep it unchanged
+    """
+    if name == PARTITION_COLUMN:
+        return 'int16'
+    if name in BOX_COLUMNS:
+        return 'float64'
+    if pd.api.types.is_bool_dtype(dtype):
+        return None
+    if name in COORDINATE_COLUMNS or pd.api.types.is_float_dtype(dtype):
+        return 'float32'
+    if pd.api.types.is_numeric_dtype(dtype):
+        return None
+    return 'category'
+
+def declared_type(field):
+    """
+    The Arrow type an Arrow field is stored as
+    """
+    if field.name == PARTITION_COLUMN:
+        return pa.int16()
+    if field.name in BOX_COLUMNS:
+        return pa.float64()
+    if field.name in COORDINATE_COLUMNS or pa.types.is_floating(field.type):
+        return pa.float32()
+    if (pa.types.is_string(field.type) or pa.types.is_large_string(field.type)
+            or pa.types.is_dictionary(field.type)):
+        return CATEGORY_TYPE
+    return field.type
+
+def declared_schema(schema):
+    """
+    An Arrow schema with every field converted to its declared type
+    """
+    return pa.schema([pa.field(field.name, declared_type(field)) for field in schema])
+
+def to_category(values):
+    """
+    Text values as a categorical of strings, with empty strings and nulls as NaN
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype) and (
+            len(values.cat.categories) == 0 or pd.api.types.is_string_dtype(values.cat.categories)):
+        return values
+    values = values.astype(object)
+    present = values.notna() & (values != '')
+    text = values[present].astype(str)
+    return pd.Series(
+        pd.Categorical(text.reindex(values.index), categories=pd.unique(text.to_numpy(dtype=object))),
+        index=values.index, name=values.name
+    )
+
+def apply_schema(df):
+    """
+    Convert the columns of df to their declared dtypes. Columns that already
+    have them are left untouched, so this is cheap on tables read back from
+    the store. Object columns mixing numbers with empty strings become numeric.
+    """
+    converted = {}
+    for col, dtype in df.dtypes.items():
+        target = declared_dtype(col, dtype)
+        if target is None:
+            continue
+        if target == 'category' and dtype == object:
+            try:
+                numbers = pd.to_numeric(df[col].replace('', np.nan))
+            except (ValueError, TypeError):
+                pass
+            else:
+                converted[col] = numbers.astype('float32') if pd.api.types.is_float_dtype(numbers) else numbers
+                continue
+        if target == 'category':
+            column = df[col]
+            values = to_category(column)
+            if values is not column:
+                converted[col] = values
+        elif dtype != target:
+            converted[col] = df[col].astype(target)
+    if not converted:
+        return df
+    df = df.copy()
+    for col, values in converted.items():
+        df[col] = values
+    return df
+
+def arrow_table(df, schema=None):
+    """
+    A DataFrame as an Arrow table with the declared types. With a schema, the
+    table follows it column by column (e.g. for chunks of one Parquet file).
+    """
+    df = apply_schema(df)
+    if schema is None:
+        schema = declared_schema(pa.Schema.from_pandas(df, preserve_index=False))
+    else:
+        schema = pa.schema([schema.field(col) for col in df.columns])
+        df = df.copy()
+        for field in schema:
+            if pa.types.is_dictionary(field.type):
+                df[field.name] = to_category(df[field.name])
+            elif pa.types.is_floating(field.type) and isinstance(df[field.name].dtype, pd.CategoricalDtype):
+                df[field.name] = pd.to_numeric(df[field.name].astype(object))
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)